@@ -1,6 +1,141 @@
+import atexit
+import contextvars
+import fcntl
+import json
 import os
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+import time
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+from tools.metrics import observe_stage
+
+LOG_FOLDER = os.getenv("LOG_FOLDER", "/mirage/logs")
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Size of a log file before it is rotated, and rotated files kept
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))
+# json (one object per line) or text
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+
+# Id of the request being handled, added to every record logged for it
+request_id = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_STANDARD_ATTRIBUTES = set(logging.LogRecord("", 0, "", 0, "", (), None).__dict__) | {
+    "message",
+    "asctime",
+    "taskName",
+}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S")
+            + f".{int(record.msecs):03d}",
+            "logger": record.name,
+            "level": record.levelname,
+            "message": record.getMessage(),
+            "process": record.process,
+            "thread": record.threadName,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _STANDARD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+
+class _RequestIdFilter(logging.Filter):
+    # Runs before the record is queued, in the thread that logged it
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+class _SharedRotatingFileHandler(RotatingFileHandler):
+    """RotatingFileHandler for a file written by several processes (web
+    workers, the processor): rotation happens under a lock file, and a
+    process whose file was rotated by another one reopens it."""
+
+    def _reopen_if_rotated(self) -> bool:
+        if self.stream is None:
+            return False
+        try:
+            rotated = (
+                os.stat(self.baseFilename).st_ino
+                != os.fstat(self.stream.fileno()).st_ino
+            )
+        except FileNotFoundError:
+            rotated = True
+        if rotated:
+            self.stream.close()
+            self.stream = self._open()
+        return rotated
+
+    def emit(self, record):
+        self._reopen_if_rotated()
+        super().emit(record)
+
+    def doRollover(self):
+        with open(f"{self.baseFilename}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Unless another process rotated it while this one waited
+            if not self._reopen_if_rotated():
+                super().doRollover()
+
+
+def _configure(name: str, filename: str) -> logging.Logger:
+    """Logger whose records are queued by the caller and written to
+    ``filename`` by a background listener thread, so logging never waits
+    on disk I/O."""
+    os.makedirs(LOG_FOLDER, exist_ok=True)
+    logger = logging.getLogger(name)
+    logger.setLevel(LOG_LEVEL)
+
+    handler = _SharedRotatingFileHandler(
+        os.path.join(LOG_FOLDER, filename),
+        maxBytes=LOG_MAX_BYTES,
+        backupCount=LOG_BACKUP_COUNT,
+    )
+    if LOG_FORMAT == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(
+            logging.Formatter(
+                "%(asctime)s %(name)s %(levelname)s :: %(message)s",
+                datefmt="%Y-%m-%d %H:%M:%S",
+            )
+        )
+
+    records = queue.SimpleQueue()
+    queue_handler = QueueHandler(records)
+    queue_handler.addFilter(_RequestIdFilter())
+    logger.addHandler(queue_handler)
+    listener = QueueListener(records, handler)
+    listener.start()
+    # Write out whatever is still queued when the process exits
+    atexit.register(listener.stop)
+    return logger
+
+
+@contextmanager
+def timed(logger: logging.Logger, stage: str, **fields):
+    """Log how long the block took, as "<stage> took <n> ms" with the stage,
+    its elapsed_ms and ``fields`` as structured fields, and record it in the
+    stage duration histogram of /metrics."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        observe_stage(stage, seconds)
+        elapsed = round(seconds * 1000, 1)
+        logger.info(
+            f"{stage} took {elapsed} ms",
+            extra={"stage": stage, "elapsed_ms": elapsed, **fields},
+        )
 
 
 class HostingLoggerSingleton:
@@ -13,22 +148,7 @@ class HostingLoggerSingleton:
         return cls._instance
 
     def _initialize_logger(self):
-        self.logger = logging.getLogger("Mirage Hosting")
-        self.logger.setLevel(logging.DEBUG)
-
-        handler = RotatingFileHandler(
-            os.path.join("/mirage/logs", "hosting.log"),
-            maxBytes=10**6,
-            backupCount=5,
-        )
-        handler.setFormatter(
-            logging.Formatter(
-                "%(asctime)s %(name)s %(levelname)s :: %(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S",
-            )
-        )
-        handler.setLevel(logging.DEBUG)
-        self.logger.addHandler(handler)
+        self.logger = _configure("Mirage Hosting", "hosting.log")
 
     def get_logger(self):
         return self.logger
@@ -44,22 +164,7 @@ class ProcessingLoggerSingleton:
         return cls._instance
 
     def _initialize_logger(self):
-        self.logger = logging.getLogger("Mirage Processing")
-        self.logger.setLevel(logging.DEBUG)
-
-        handler = RotatingFileHandler(
-            os.path.join("/mirage/logs", "processing.log"),
-            maxBytes=10**6,
-            backupCount=5,
-        )
-        handler.setFormatter(
-            logging.Formatter(
-                "%(asctime)s %(name)s %(levelname)s :: %(message)s",
-                datefmt="%Y-%m-%d %H:%M:%S",
-            )
-        )
-        handler.setLevel(logging.DEBUG)
-        self.logger.addHandler(handler)
+        self.logger = _configure("Mirage Processing", "processing.log")
 
     def get_logger(self):
         return self.logger
@@ -0,0 +1,20 @@
+"""
+processor.py
+Description: The processing process of a multi-worker deployment.
+
+Web workers (MIRAGE_ROLE=web, e.g. gunicorn -w 4 wsgi:app) only serve
+requests: they queue jobs and read the shared catalog, and never load the
+embedding model. This process is the single one that does: it runs the
+queued jobs and watches the uploads folder.
+
+Usage: python processor.py
+"""
+
+import os
+
+os.environ["MIRAGE_ROLE"] = "processor"
+
+import wsgi
+
+if __name__ == "__main__":
+    wsgi.run_jobs()
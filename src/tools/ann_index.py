@@ -0,0 +1,260 @@
+"""
+ann_index.py
+Description: Inverted-file (IVF) approximate nearest-neighbour index over the
+embedding store.
+
+Unit vectors are partitioned with spherical k-means. A query only looks at the
+members of its ``nprobe`` closest partitions, so raising ``nprobe`` trades
+latency for recall. Candidates are meant to be verified exactly by the caller.
+"""
+
+import io
+import json
+import os
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+
+from mirage_logger import ProcessingLoggerSingleton
+
+INDEX_FILE = "ivf_index.npz"
+# Default number of partitions probed per query (the recall knob)
+NPROBE = 8
+# Retrain once the corpus has grown this much since the last training
+RETRAIN_FACTOR = 4
+KMEANS_ITERATIONS = 20
+KMEANS_SAMPLE_PER_LIST = 256
+
+
+class IVFIndex:
+    def __init__(self, folder: str):
+        self.path = os.path.join(folder, INDEX_FILE)
+        self.centroids = None
+        self.trained_size = 0
+        self.assignment = {}  # id -> partition
+        self.lists = []  # partition -> set of ids
+        if os.path.isfile(self.path):
+            self._load()
+
+    def __len__(self) -> int:
+        return len(self.assignment)
+
+    @property
+    def trained(self) -> bool:
+        return self.centroids is not None
+
+    def _load(self):
+        with np.load(self.path) as data:
+            self.centroids = data["centroids"]
+            self.trained_size = int(data["trained_size"])
+            ids = data["ids"].tolist()
+            lists = data["lists"].tolist()
+        self.assignment = dict(zip(ids, lists))
+        self.lists = [set() for _ in range(len(self.centroids))]
+        for id, partition in self.assignment.items():
+            self.lists[partition].add(id)
+
+    def save(self):
+        if not self.trained:
+            return
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            centroids=self.centroids,
+            trained_size=np.int64(self.trained_size),
+            ids=np.asarray(list(self.assignment.keys()), dtype="<U32"),
+            lists=np.asarray(list(self.assignment.values()), dtype=np.int32),
+        )
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(buffer.getvalue())
+        os.replace(self.path + ".tmp", self.path)
+
+    def train(self, matrix, n_lists: int = None, seed: int = 0):
+        """Fit partitions on unit rows of ``matrix`` with spherical k-means.
+        Without any rows the index stays untrained and callers search exactly."""
+        n = len(matrix)
+        if n == 0:
+            return
+        n_lists = min(n_lists or max(1, int(4 * np.sqrt(n))), n)
+        rng = np.random.default_rng(seed)
+
+        sample_size = min(n, n_lists * KMEANS_SAMPLE_PER_LIST)
+        sample = np.asarray(matrix[np.sort(rng.choice(n, sample_size, replace=False))])
+        centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+
+        for _ in range(KMEANS_ITERATIONS):
+            labels = _nearest(sample, centroids, 1)[:, 0]
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            counts = np.bincount(labels, minlength=n_lists)
+            # Re-seed empty partitions with random sample points
+            empty = counts == 0
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            centroids = sums / np.maximum(
+                np.linalg.norm(sums, axis=1, keepdims=True), 1e-8
+            )
+
+        self.centroids = centroids.astype(np.float32)
+        self.trained_size = n
+        self.assignment = {}
+        self.lists = [set() for _ in range(n_lists)]
+
+    def add(self, ids: list, matrix):
+        if not ids or not self.trained:
+            return
+        partitions = _nearest(matrix, self.centroids, 1)[:, 0].tolist()
+        for id, partition in zip(ids, partitions):
+            self.remove(id)
+            self.assignment[id] = partition
+            self.lists[partition].add(id)
+
+    def remove(self, id: str):
+        partition = self.assignment.pop(id, None)
+        if partition is not None:
+            self.lists[partition].discard(id)
+
+    def sync(self, ids: list, matrix, changed=()):
+        """Bring the index in line with the live (ids, matrix) of the store.
+        ``changed`` ids were embedded again and are re-assigned."""
+        logger = ProcessingLoggerSingleton().get_logger()
+        if not self.trained or len(ids) > RETRAIN_FACTOR * self.trained_size:
+            logger.info(f"Training IVF index on {len(ids)} embeddings...")
+            self.train(matrix)
+            self.add(ids, matrix)
+        else:
+            live = set(ids)
+            for id in [id for id in self.assignment if id not in live]:
+                self.remove(id)
+            changed = set(changed)
+            missing = [
+                row
+                for row, id in enumerate(ids)
+                if id not in self.assignment or id in changed
+            ]
+            self.add([ids[row] for row in missing], np.asarray(matrix[missing]))
+        self.save()
+
+    def probe(self, vectors, nprobe: int = NPROBE) -> np.ndarray:
+        """Return the ``nprobe`` closest partitions of every query vector."""
+        return _nearest(vectors, self.centroids, min(nprobe, len(self.centroids)))
+
+
+def _nearest(vectors, centroids, k: int, block: int = 8192) -> np.ndarray:
+    result = np.empty((len(vectors), k), dtype=np.int64)
+    for start in range(0, len(vectors), block):
+        sims = np.asarray(vectors[start : start + block]) @ centroids.T
+        if k == 1:
+            result[start : start + block, 0] = np.argmax(sims, axis=1)
+        else:
+            result[start : start + block] = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+    return result
+
+
+def candidate_pairs(
+    matrix,
+    ids,
+    query_rows,
+    index,
+    threshold,
+    nprobe=NPROBE,
+    memory_limit=256 * 1024**2,
+):
+    """Yield verified (i, j), i != j, pairs for query rows using IVF candidates.
+
+    Query rows are probed one block at a time, and within a block queries are
+    grouped by probed partition so every partition is verified with exact
+    matrix products against its members, each within ``memory_limit`` bytes.
+    """
+    if not query_rows or not index.trained:
+        return
+    row_of = {id: row for row, id in enumerate(ids)}
+    query_rows = np.asarray(query_rows, dtype=np.int64)
+    rows_per_block = max(1, memory_limit // (4 * matrix.shape[1]))
+
+    for start in range(0, len(query_rows), rows_per_block):
+        block = query_rows[start : start + rows_per_block]
+        vectors = np.asarray(matrix[block])
+        by_partition = {}
+        for q, partitions in enumerate(index.probe(vectors, nprobe).tolist()):
+            for partition in partitions:
+                by_partition.setdefault(partition, []).append(q)
+
+        for partition, queries in by_partition.items():
+            members = [row_of[id] for id in index.lists[partition] if id in row_of]
+            if not members:
+                continue
+            members = np.asarray(members, dtype=np.int64)
+            candidates = np.asarray(matrix[members]).T
+            queries_per_product = max(1, memory_limit // (4 * len(members)))
+            for first in range(0, len(queries), queries_per_product):
+                chunk = np.asarray(queries[first : first + queries_per_product])
+                sims = vectors[chunk] @ candidates
+                rows, cols = np.nonzero(sims >= threshold)
+                rows, cols = block[chunk[rows]], members[cols]
+                keep = rows != cols
+                yield from zip(rows[keep].tolist(), cols[keep].tolist())
+
+
+def recall_report(store, threshold, nprobes=(1, 2, 4, 8, 16, 32), sample=500):
+    """Compare IVF candidate generation with brute force on a sample of queries."""
+    ids, matrix = store.live_matrix()
+    index = IVFIndex(store.folder)
+    index.sync(ids, matrix)
+
+    rng = np.random.default_rng(0)
+    queries = np.sort(rng.choice(len(ids), min(sample, len(ids)), replace=False))
+
+    start = time.perf_counter()
+    sims = matrix.similarities(matrix[queries])
+    rows, cols = np.nonzero(sims >= threshold)
+    exact = {(int(queries[r]), int(c)) for r, c in zip(rows, cols) if queries[r] != c}
+    brute_force_ms = (time.perf_counter() - start) * 1000
+
+    report = {
+        "embeddings": len(ids),
+        "partitions": len(index.lists),
+        "queries": len(queries),
+        "pairs": len(exact),
+        "brute_force_ms": round(brute_force_ms, 2),
+        "nprobe": [],
+    }
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        found = set(
+            candidate_pairs(matrix, ids, queries.tolist(), index, threshold, nprobe)
+        )
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        report["nprobe"].append(
+            {
+                "nprobe": nprobe,
+                "recall": (len(found & exact) / len(exact)) if exact else 1.0,
+                "ms": round(elapsed_ms, 2),
+                "speedup": (
+                    round(brute_force_ms / elapsed_ms, 2) if elapsed_ms else None
+                ),
+            }
+        )
+    return report
+
+
+if __name__ == "__main__":
+    from tools.embedding_store import EmbeddingStore
+    from tools.find_similar import THRESHOLD
+
+    parser = ArgumentParser(prog="ann_index")
+    parser.add_argument(dest="folder")
+    parser.add_argument(dest="command", choices=["build", "report"])
+    parser.add_argument("--sample", type=int, default=500)
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.folder, read_only=True)
+    if args.command == "build":
+        ids, matrix = store.live_matrix()
+        index = IVFIndex(store.folder)
+        index.train(matrix)
+        index.add(ids, matrix)
+        index.save()
+        print(f"Indexed {len(index)} embeddings in {len(index.lists)} partitions.")
+    else:
+        print(json.dumps(recall_report(store, THRESHOLD, sample=args.sample), indent=2))
@@ -0,0 +1,295 @@
+"""
+backup.py
+Description: Incremental, content-addressed backups of the media folder.
+
+A backup repository holds
+- objects/<ab>/<sha256>: file content, split into fixed-size chunks, each
+  stored once no matter how many files or snapshots refer to it.
+- snapshots/<id>.json: one manifest per snapshot, mapping every backed-up
+  path to its size, mtime and list of chunk hashes.
+
+A snapshot only reads files whose size or mtime changed since the previous
+snapshot and only writes chunks the repository does not have yet, so
+appending to the embedding store costs one new chunk, not a new copy. The
+catalog is copied with SQLite's online backup API so the snapshot is
+consistent while the server keeps writing. Renditions and the display cache
+are left out; they are rebuilt with ``python -m tools.renditions``.
+
+Usage: python -m tools.backup <drive> snapshot|list|prune|verify|restore
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+from argparse import ArgumentParser
+from datetime import datetime
+
+from mirage_logger import ProcessingLoggerSingleton
+
+BACKUP_LOCATION = os.getenv("BACKUP_LOCATION", "/mirage/backup")
+# Snapshots kept by prune, newest first
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", 14))
+CHUNK_SIZE = 4 * 1024 * 1024
+# Folders of media/ that can be regenerated and are not backed up
+EXCLUDE = ("renditions", "display_cache", ".metrics")
+CATALOG = "catalog.db"
+
+
+class BackupLocked(Exception):
+    pass
+
+
+class BackupRepository:
+    def __init__(self, folder: str):
+        self.folder = folder
+        self.objects = os.path.join(folder, "objects")
+        self.snapshots = os.path.join(folder, "snapshots")
+        os.makedirs(self.objects, exist_ok=True)
+        os.makedirs(self.snapshots, exist_ok=True)
+        self._lock_file = None
+
+    # Locking
+    def lock(self):
+        """Take the repository lock; raises BackupLocked if another backup
+        process holds it."""
+        self._lock_file = open(os.path.join(self.folder, ".lock"), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.close()
+            self._lock_file = None
+            raise BackupLocked(f"Another backup is running on {self.folder}")
+
+    def unlock(self):
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    def __enter__(self):
+        self.lock()
+        return self
+
+    def __exit__(self, *exc):
+        self.unlock()
+
+    # Objects
+    def _object_path(self, digest: str) -> str:
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def _put_chunk(self, chunk: bytes) -> tuple:
+        """Store a chunk unless already present. Returns (hash, written)."""
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self._object_path(digest)
+        if os.path.exists(path):
+            return digest, False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        return digest, True
+
+    def _put_file(self, path: str) -> tuple:
+        chunks = []
+        written = 0
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                digest, new = self._put_chunk(chunk)
+                chunks.append(digest)
+                written += len(chunk) if new else 0
+        return chunks, written
+
+    # Snapshots
+    def list(self) -> list:
+        """Snapshot ids, oldest first."""
+        return sorted(
+            name[: -len(".json")]
+            for name in os.listdir(self.snapshots)
+            if name.endswith(".json")
+        )
+
+    def manifest(self, snapshot: str) -> dict:
+        with open(os.path.join(self.snapshots, f"{snapshot}.json"), "r") as f:
+            return json.load(f)
+
+    def snapshot(self, media_folder: str) -> dict:
+        """Back up ``media_folder`` and return the snapshot's statistics."""
+        processing = ProcessingLoggerSingleton().get_logger()
+        snapshots = self.list()
+        previous = self.manifest(snapshots[-1])["files"] if snapshots else {}
+        files = {}
+        stats = {"files": 0, "changed": 0, "bytes": 0, "written": 0}
+
+        for root, dirs, names in os.walk(media_folder):
+            rel_root = os.path.relpath(root, media_folder)
+            if rel_root == ".":
+                dirs[:] = [d for d in dirs if d not in EXCLUDE]
+            for name in names:
+                rel = os.path.normpath(os.path.join(rel_root, name))
+                if (
+                    rel == CATALOG
+                    or rel.startswith(f"{CATALOG}-")
+                    or name.endswith(".tmp")
+                ):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entry = previous.get(rel)
+                if (
+                    entry is None
+                    or entry["size"] != st.st_size
+                    or entry["mtime"] != st.st_mtime_ns
+                ):
+                    chunks, written = self._put_file(path)
+                    entry = {
+                        "size": st.st_size,
+                        "mtime": st.st_mtime_ns,
+                        "chunks": chunks,
+                    }
+                    stats["changed"] += 1
+                    stats["written"] += written
+                files[rel] = entry
+                stats["files"] += 1
+                stats["bytes"] += st.st_size
+
+        # Consistent copy of the live catalog
+        catalog = os.path.join(media_folder, CATALOG)
+        if os.path.isfile(catalog):
+            with tempfile.NamedTemporaryFile(dir=self.folder, suffix=".tmp") as tmp:
+                source = sqlite3.connect(catalog)
+                target = sqlite3.connect(tmp.name)
+                try:
+                    source.backup(target)
+                finally:
+                    target.close()
+                    source.close()
+                chunks, written = self._put_file(tmp.name)
+                size = os.path.getsize(tmp.name)
+            files[CATALOG] = {"size": size, "mtime": 0, "chunks": chunks}
+            stats["files"] += 1
+            stats["bytes"] += size
+            stats["written"] += written
+
+        snapshot = datetime.now().strftime("%Y%m%dT%H%M%S")
+        if snapshots and snapshot <= snapshots[-1]:
+            snapshot = f"{snapshots[-1]}.{len(snapshots)}"
+        path = os.path.join(self.snapshots, f"{snapshot}.json")
+        with open(path + ".tmp", "w") as f:
+            json.dump({"created": snapshot, "files": files}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        processing.info(f"Backup snapshot {snapshot}: {json.dumps(stats)}")
+        return {"snapshot": snapshot, **stats}
+
+    def prune(self, keep: int = BACKUP_KEEP) -> dict:
+        """Delete all but the ``keep`` newest snapshots, then every chunk no
+        remaining snapshot refers to."""
+        snapshots = self.list()
+        # The newest snapshot is always kept: the next one reuses its chunks
+        removed = snapshots[: max(len(snapshots) - max(keep, 1), 0)]
+        for snapshot in removed:
+            os.remove(os.path.join(self.snapshots, f"{snapshot}.json"))
+
+        referenced = {
+            digest
+            for snapshot in self.list()
+            for entry in self.manifest(snapshot)["files"].values()
+            for digest in entry["chunks"]
+        }
+        deleted = 0
+        for prefix in os.listdir(self.objects):
+            for name in os.listdir(os.path.join(self.objects, prefix)):
+                if name not in referenced:
+                    os.remove(os.path.join(self.objects, prefix, name))
+                    deleted += 1
+        return {"snapshots": len(removed), "chunks": deleted}
+
+    def verify(self, snapshot: str = None, full: bool = True) -> list:
+        """Check that every chunk of a snapshot (default: all) exists and,
+        with ``full``, still matches its hash. Returns the problems found."""
+        problems = []
+        checked = set()
+        for snap in [snapshot] if snapshot else self.list():
+            for rel, entry in self.manifest(snap)["files"].items():
+                for digest in entry["chunks"]:
+                    if digest in checked:
+                        continue
+                    checked.add(digest)
+                    path = self._object_path(digest)
+                    if not os.path.isfile(path):
+                        problems.append(f"{snap}: {rel}: missing chunk {digest}")
+                    elif full:
+                        with open(path, "rb") as f:
+                            if hashlib.sha256(f.read()).hexdigest() != digest:
+                                problems.append(
+                                    f"{snap}: {rel}: corrupt chunk {digest}"
+                                )
+        return problems
+
+    def restore(self, snapshot: str, target: str) -> int:
+        """Recreate the media folder of ``snapshot`` in ``target``."""
+        files = self.manifest(snapshot)["files"]
+        for rel, entry in files.items():
+            path = os.path.join(target, rel)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                for digest in entry["chunks"]:
+                    with open(self._object_path(digest), "rb") as chunk:
+                        f.write(chunk.read())
+            os.replace(path + ".tmp", path)
+            if entry["mtime"]:
+                os.utime(path, ns=(entry["mtime"], entry["mtime"]))
+        return len(files)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="backup")
+    parser.add_argument(dest="drive", help="DRIVE location, e.g. /mirage/DRIVE")
+    parser.add_argument(
+        dest="command", choices=["snapshot", "list", "prune", "verify", "restore"]
+    )
+    parser.add_argument("--repo", default=BACKUP_LOCATION, help="Backup repository")
+    parser.add_argument("--keep", type=int, default=BACKUP_KEEP)
+    parser.add_argument("--snapshot", help="Snapshot id (default: latest)")
+    parser.add_argument("--target", help="Folder to restore into")
+    parser.add_argument(
+        "--quick", action="store_true", help="Only check that chunks exist"
+    )
+    args = parser.parse_args()
+
+    repo = BackupRepository(args.repo)
+    try:
+        with repo:
+            if args.command == "snapshot":
+                stats = repo.snapshot(os.path.join(args.drive, "media"))
+                pruned = repo.prune(args.keep)
+                print(f"Snapshot {stats['snapshot']}: {stats}, pruned {pruned}.")
+            elif args.command == "list":
+                for snapshot in repo.list():
+                    print(snapshot)
+            elif args.command == "prune":
+                print(f"Pruned {repo.prune(args.keep)}.")
+            elif args.command == "verify":
+                problems = repo.verify(args.snapshot, full=not args.quick)
+                for problem in problems:
+                    print(problem)
+                print(f"{len(problems)} problems found.")
+                sys.exit(1 if problems else 0)
+            else:
+                snapshot = args.snapshot or repo.list()[-1]
+                if not args.target:
+                    parser.error("restore needs --target")
+                restored = repo.restore(snapshot, args.target)
+                print(f"Restored {restored} files of snapshot {snapshot}.")
+    except BackupLocked as e:
+        print(e)
+        sys.exit(2)
@@ -0,0 +1,416 @@
+"""
+catalog.py
+Description: SQLite catalog of uploaded media, replacing filename_mapping.json,
+metadata.json and trash.json.
+
+Every media item is one row keyed by its stored filename ("<id>.<ext>") and
+updated in place, so an upload, a processed file or a trash toggle costs one
+row write instead of a rewrite of the whole library. The database runs in WAL
+mode: readers never block the writer and a crash can only lose the last
+uncommitted transaction. Writes made inside ``with catalog.batch():`` are
+committed together. Each write stamps the row with the next value of a
+library-wide change counter (seq), kept in the meta table so that it never
+goes back when rows are removed.
+"""
+
+import base64
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from mirage_logger import ProcessingLoggerSingleton
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version
+MIGRATIONS = [
+    """
+    CREATE TABLE media (
+        name TEXT PRIMARY KEY,
+        id TEXT NOT NULL,
+        original_name TEXT NOT NULL,
+        metadata TEXT,
+        trash_expiry TEXT,
+        seq INTEGER NOT NULL DEFAULT 0
+    );
+    CREATE INDEX media_id ON media (id);
+    CREATE INDEX media_seq ON media (seq);
+    CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+    """,
+    """
+    ALTER TABLE media ADD COLUMN hash TEXT;
+    ALTER TABLE media ADD COLUMN size INTEGER;
+    CREATE INDEX media_hash ON media (hash);
+    """,
+    """
+    ALTER TABLE media ADD COLUMN create_date TEXT NOT NULL GENERATED ALWAYS AS
+        (COALESCE(json_extract(metadata, '$.CreateDate'), '')) VIRTUAL;
+    ALTER TABLE media ADD COLUMN mimetype TEXT GENERATED ALWAYS AS
+        (json_extract(metadata, '$.MIMEType')) VIRTUAL;
+    CREATE INDEX media_create_date ON media (create_date, name);
+    """,
+    """
+    CREATE TABLE jobs (
+        id INTEGER PRIMARY KEY,
+        pull_uploads INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        created REAL NOT NULL,
+        started REAL,
+        finished REAL,
+        error TEXT
+    );
+    CREATE INDEX jobs_status ON jobs (status);
+    CREATE TABLE job_files (
+        job_id INTEGER NOT NULL,
+        name TEXT NOT NULL,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        next_attempt REAL NOT NULL DEFAULT 0,
+        error TEXT,
+        updated REAL,
+        PRIMARY KEY (job_id, name)
+    );
+    CREATE INDEX job_files_state ON job_files (job_id, state);
+    """,
+    """
+    ALTER TABLE jobs ADD COLUMN automatic INTEGER NOT NULL DEFAULT 0;
+    CREATE INDEX job_files_name ON job_files (name, job_id);
+    """,
+    """
+    ALTER TABLE jobs ADD COLUMN not_before REAL NOT NULL DEFAULT 0;
+    """,
+    """
+    INSERT INTO meta (key, value) SELECT 'seq', COALESCE(MAX(seq), 0) FROM media;
+    """,
+]
+ITEM_COLUMNS = "name, original_name, metadata, trash_expiry"
+
+
+def encode_cursor(key: tuple) -> str:
+    """Opaque page cursor for a (create_date, name) sort key."""
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        create_date, name = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    return str(create_date), str(name)
+
+
+def _item(row) -> dict:
+    return {
+        "name": row["name"],
+        "original_name": row["original_name"],
+        "metadata": json.loads(row["metadata"]),
+        "trash_expiry": row["trash_expiry"],
+    }
+
+
+class Catalog:
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._migrate()
+
+    # Connections
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.depth = 0
+        return conn
+
+    @contextmanager
+    def batch(self):
+        """Group every write made in this block into one transaction."""
+        conn = self._connection()
+        with self._write_lock:
+            if self._local.depth == 0:
+                conn.execute("BEGIN IMMEDIATE")
+            self._local.depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._local.depth -= 1
+                if self._local.depth == 0:
+                    conn.execute("ROLLBACK")
+                raise
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.execute("COMMIT")
+
+    def _write(self, sql: str, params=()):
+        with self.batch() as catalog:
+            return catalog._connection().execute(sql, params)
+
+    def _query(self, sql: str, params=()) -> list:
+        return self._connection().execute(sql, params).fetchall()
+
+    # Statements of modules that keep their own tables here (jobs.py)
+    def query(self, sql: str, params=()) -> list:
+        return self._query(sql, params)
+
+    def execute(self, sql: str, params=()):
+        """Run a write, in the enclosing batch() if there is one."""
+        return self._write(sql, params)
+
+    def _next_seq(self) -> int:
+        """Advance the change counter, in the transaction of the write using it."""
+        return self._write(
+            "UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'seq' "
+            "RETURNING CAST(value AS INTEGER)"
+        ).fetchone()[0]
+
+    def execute_many(self, sql: str, rows):
+        with self.batch() as catalog:
+            return catalog._connection().executemany(sql, rows)
+
+    def _migrate(self):
+        conn = self._connection()
+        # Web workers and the processor open the catalog at the same time;
+        # the first one migrates, the others then find it up to date
+        with open(f"{self.path}-migrate.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            for i, script in enumerate(MIGRATIONS[version:], start=version + 1):
+                with self._write_lock:
+                    conn.executescript(
+                        f"BEGIN; {script}; PRAGMA user_version={i}; COMMIT;"
+                    )
+
+    # Import
+    def import_json(self, mapping_file: str, metadata_file: str, trash_file: str):
+        """One-time import of the JSON files used before the catalog existed."""
+        if self._query("SELECT 1 FROM meta WHERE key = 'json_imported'"):
+            return
+        processing = ProcessingLoggerSingleton().get_logger()
+
+        def load(path):
+            if not os.path.isfile(path):
+                return {}
+            with open(path, "r") as f:
+                return json.load(f)
+
+        mapping = load(mapping_file)
+        metadata = load(metadata_file)
+        trash = load(trash_file)
+        with self.batch():
+            # Another process may have imported them meanwhile
+            if self._query("SELECT 1 FROM meta WHERE key = 'json_imported'"):
+                return
+            for seq, (name, original_name) in enumerate(mapping.items(), start=1):
+                self._connection().execute(
+                    "INSERT OR IGNORE INTO media "
+                    "(name, id, original_name, metadata, trash_expiry, seq) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        name,
+                        name[:32],
+                        original_name,
+                        json.dumps(metadata[name]) if name in metadata else None,
+                        trash.get(name),
+                        seq,
+                    ),
+                )
+            self._connection().execute(
+                "INSERT INTO meta (key, value) VALUES ('json_imported', ?)",
+                (str(len(mapping)),),
+            )
+            self._connection().execute(
+                "UPDATE meta SET value = MAX(CAST(value AS INTEGER), ?) "
+                "WHERE key = 'seq'",
+                (len(mapping),),
+            )
+        processing.info(f"Imported {len(mapping)} items from JSON into the catalog.")
+
+    # Mapping
+    def add(self, name: str, original_name: str, hash: str = None, size: int = None):
+        """Record an upload, with the SHA-256 and size of its content."""
+        with self.batch():
+            self._write(
+                "INSERT INTO media (name, id, original_name, hash, size, seq) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET "
+                "original_name = excluded.original_name, hash = excluded.hash, "
+                "size = excluded.size, seq = excluded.seq",
+                (name, name[:32], original_name, hash, size, self._next_seq()),
+            )
+
+    def add_upload(self, name: str, original_name: str, hash: str, size: int):
+        """Record an upload unless its content is already in the catalog.
+        Returns the stored filename of the existing item, or None once added.
+
+        The lookup and the insert are one write transaction, so concurrent
+        uploads of the same content, in any process, add it only once.
+        """
+        with self.batch():
+            existing = self.find_hash(hash)
+            if existing is None:
+                self.add(name, original_name, hash=hash, size=size)
+            return existing
+
+    def remove(self, name: str):
+        """Forget an upload whose file never arrived."""
+        self._write("DELETE FROM media WHERE name = ? AND metadata IS NULL", (name,))
+
+    def find_hash(self, hash: str):
+        """Stored filename of the first upload with this SHA-256, or None."""
+        rows = self._query(
+            "SELECT name FROM media WHERE hash = ? ORDER BY rowid LIMIT 1", (hash,)
+        )
+        return rows[0]["name"] if rows else None
+
+    def set_hash(self, name: str, hash: str, size: int):
+        self._write(
+            "UPDATE media SET hash = ?, size = ? WHERE name = ?", (hash, size, name)
+        )
+
+    def missing_hashes(self) -> list:
+        return [
+            row["name"]
+            for row in self._query(
+                "SELECT name FROM media WHERE hash IS NULL ORDER BY rowid"
+            )
+        ]
+
+    def original_name(self, name: str):
+        rows = self._query("SELECT original_name FROM media WHERE name = ?", (name,))
+        return rows[0]["original_name"] if rows else None
+
+    def mapping(self) -> dict:
+        return {
+            row["name"]: row["original_name"]
+            for row in self._query(
+                "SELECT name, original_name FROM media ORDER BY rowid"
+            )
+        }
+
+    # Metadata
+    def set_metadata(self, name: str, metadata: dict):
+        with self.batch():
+            self._write(
+                "UPDATE media SET metadata = ?, seq = ? WHERE name = ?",
+                (json.dumps(metadata), self._next_seq(), name),
+            )
+
+    def metadata(self, name: str):
+        rows = self._query("SELECT metadata FROM media WHERE name = ?", (name,))
+        return json.loads(rows[0]["metadata"]) if rows and rows[0]["metadata"] else None
+
+    # Trash
+    def set_trash(self, name: str, expiry):
+        """Trash an item until ``expiry``, or restore it with ``expiry=None``."""
+        with self.batch():
+            self._write(
+                "UPDATE media SET trash_expiry = ?, seq = ? WHERE name = ?",
+                (expiry, self._next_seq(), name),
+            )
+
+    def is_trashed(self, name: str) -> bool:
+        return bool(
+            self._query(
+                "SELECT 1 FROM media WHERE name = ? AND trash_expiry IS NOT NULL",
+                (name,),
+            )
+        )
+
+    def trash(self) -> dict:
+        return {
+            row["name"]: row["trash_expiry"]
+            for row in self._query(
+                "SELECT name, trash_expiry FROM media "
+                "WHERE trash_expiry IS NOT NULL ORDER BY rowid"
+            )
+        }
+
+    # Listing
+    def items(self, trashed: bool = False) -> list:
+        """Processed items as dicts with name, original_name, metadata and
+        trash_expiry, in upload order."""
+        return [
+            _item(row)
+            for row in self._query(
+                f"SELECT {ITEM_COLUMNS} FROM media "
+                "WHERE metadata IS NOT NULL AND (trash_expiry IS NOT NULL) = ? "
+                "ORDER BY rowid",
+                (trashed,),
+            )
+        ]
+
+    def page(
+        self,
+        limit: int,
+        cursor: tuple = None,
+        mimetype: str = None,
+        date_from: str = None,
+        date_to: str = None,
+        trashed: bool = False,
+        descending: bool = True,
+    ):
+        """One page of processed items sorted by CreateDate.
+
+        ``cursor`` is the sort key returned with the previous page, mimetype a
+        full type ("image/png") or a major type ("video"), and the dates are
+        inclusive bounds in "YYYY:MM:DD HH:MM:SS" form. Returns the items and
+        the cursor of the next page, or None after the last one.
+        """
+        where = ["metadata IS NOT NULL", "(trash_expiry IS NOT NULL) = ?"]
+        params = [trashed]
+        if mimetype:
+            where.append("mimetype = ?" if "/" in mimetype else "mimetype LIKE ?")
+            params.append(mimetype if "/" in mimetype else f"{mimetype}/%")
+        if date_from:
+            where.append("create_date >= ?")
+            params.append(date_from)
+        if date_to:
+            where.append("create_date <= ?")
+            params.append(date_to)
+        if cursor:
+            where.append(f"(create_date, name) {'<' if descending else '>'} (?, ?)")
+            params += list(cursor)
+        order = "DESC" if descending else "ASC"
+        rows = self._query(
+            f"SELECT {ITEM_COLUMNS}, create_date FROM media "
+            f"WHERE {' AND '.join(where)} "
+            f"ORDER BY create_date {order}, name {order} LIMIT ?",
+            (*params, limit + 1),
+        )
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = (rows[-1]["create_date"], rows[-1]["name"])
+        return [_item(row) for row in rows], next_cursor
+
+    def changes(self, since: int, limit: int):
+        """Processed items added or changed (metadata, trash) after change
+        ``since``, in change order. Returns the items and the change to pass
+        as ``since`` next time."""
+        rows = self._query(
+            f"SELECT {ITEM_COLUMNS}, seq FROM media "
+            "WHERE seq > ? AND metadata IS NOT NULL ORDER BY seq LIMIT ?",
+            (since, limit),
+        )
+        return [_item(row) for row in rows], rows[-1]["seq"] if rows else since
+
+    def latest_seq(self) -> int:
+        rows = self._query(
+            "SELECT CAST(value AS INTEGER) AS seq FROM meta WHERE key = 'seq'"
+        )
+        return rows[0]["seq"]
+
+    def entries(self, since: int = 0) -> list:
+        """Every row (or every row changed after change ``since``) with its
+        MIME type, without decoding the metadata."""
+        return self._query(
+            "SELECT name, original_name, trash_expiry, mimetype FROM media "
+            "WHERE seq > ?",
+            (since,),
+        )
@@ -0,0 +1,289 @@
+"""
+date_inference.py
+Description: Capture-date inference for files without an EXIF date.
+
+Dates are resolved in three tiers:
+1. A deterministic parser for common filename conventions (camera, phone,
+   messenger and screenshot names, epoch-millisecond names).
+2. A persistent cache keyed by filename pattern (the name with every digit
+   masked). It holds either the positions of the year, month and day digits
+   learned from an earlier LLM answer, or the fact that names of that
+   pattern carry no date.
+3. The mirage-date-extractor model, queried concurrently with a timeout and
+   only once per unknown pattern in a batch.
+"""
+
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import requests
+
+from mirage_logger import ProcessingLoggerSingleton
+from tools.metrics import DATE_INFERENCE
+
+OLLAMA_URL = "http://ollama:11434"
+LLM_CONCURRENCY = int(os.getenv("DATE_LLM_CONCURRENCY", 4))
+LLM_TIMEOUT = float(os.getenv("DATE_LLM_TIMEOUT", 30))
+
+TIERS = ("parser", "cache", "llm", "fallback")
+# Returned by the LLM tier when the request itself failed; never cached
+_FAILED = "failed"
+
+# YYYY MM DD with one optional separator, optionally followed by HH MM SS
+_DATE_TIME = re.compile(
+    r"(?<!\d)(?P<y>(?:19|20)\d{2})(?P<sep>[-_.]?)(?P<m>0[1-9]|1[0-2])(?P=sep)"
+    r"(?P<d>0[1-9]|[12]\d|3[01])"
+    r"(?:(?:[-_. T]|\sat\s)(?P<H>[01]\d|2[0-3])[-_.:h ]?(?P<M>[0-5]\d)[-_.:m ]?"
+    r"(?P<S>[0-5]\d))?(?!\d)"
+)
+# Milliseconds since the epoch, as written by several messengers
+_EPOCH_MS = re.compile(r"(?<!\d)1[2-9]\d{11}(?!\d)")
+_DIGITS = re.compile(r"\d+")
+
+
+def _stem(filename: str) -> str:
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+def pattern_of(filename: str) -> str:
+    """Cache key of a filename: lowercase stem with every digit masked."""
+    return _DIGITS.sub(lambda m: "#" * len(m.group()), _stem(filename).lower())
+
+
+def _plausible(date: datetime) -> bool:
+    return datetime(1990, 1, 1) <= date <= datetime.now() + timedelta(days=1)
+
+
+def parse_filename_date(filename: str):
+    """Tier 1: return "YYYY:MM:DD HH:MM:SS" from well-known name formats, or None."""
+    stem = _stem(filename)
+    for match in _DATE_TIME.finditer(stem):
+        try:
+            date = datetime(
+                int(match["y"]),
+                int(match["m"]),
+                int(match["d"]),
+                int(match["H"] or 0),
+                int(match["M"] or 0),
+                int(match["S"] or 0),
+            )
+        except ValueError:
+            continue
+        if _plausible(date):
+            return date.strftime("%Y:%m:%d %H:%M:%S")
+
+    for match in _EPOCH_MS.finditer(stem):
+        date = datetime.fromtimestamp(int(match.group()) / 1000)
+        if _plausible(date) and date.year >= 2005:
+            return date.strftime("%Y:%m:%d %H:%M:%S")
+    return None
+
+
+def _learn_rule(filename: str, date: str):
+    """Find where the digits of an LLM answer ("YYYY:MM:DD") sit in a filename.
+
+    Returns [[run, start, length] for year, month, day], or None when the
+    positions are missing or ambiguous.
+    """
+    runs = _DIGITS.findall(_stem(filename))
+    y, m, d = date.split(":")
+    rule = []
+    for values in ((y, y[2:]), (m, m.lstrip("0")), (d, d.lstrip("0"))):
+        found = [
+            [run, start, len(value)]
+            for value in dict.fromkeys(values)
+            for run, digits in enumerate(runs)
+            for start in range(len(digits) - len(value) + 1)
+            if digits[start : start + len(value)] == value
+        ]
+        # Only keep fixed-width positions that are unambiguous
+        found = [f for f in found if f[2] == len(values[0]) or len(found) == 1]
+        if len(found) != 1:
+            return None
+        rule.append(found[0])
+    if len({tuple(r) for r in rule}) != 3:
+        return None
+    return rule
+
+
+def _apply_rule(filename: str, rule: list):
+    runs = _DIGITS.findall(_stem(filename))
+    try:
+        y, m, d = (
+            int(runs[run][start : start + length]) for run, start, length in rule
+        )
+        if y < 100:
+            y += 2000 if y <= datetime.now().year % 100 else 1900
+        date = datetime(y, m, d)
+    except (IndexError, ValueError):
+        return None
+    return date.strftime("%Y:%m:%d 00:00:00") if _plausible(date) else None
+
+
+class DateInferenceEngine:
+    def __init__(self, cache_file: str = None, use_llm: bool = True):
+        self.cache_file = cache_file
+        self.use_llm = use_llm
+        self._lock = threading.Lock()
+        # pattern -> {"rule": [...]} or {"date": None}
+        self._patterns = {}
+        self._hits = dict.fromkeys(TIERS, 0)
+        if cache_file and os.path.isfile(cache_file):
+            with open(cache_file, "r") as f:
+                self._patterns = json.load(f)
+
+    def infer(self, filename: str) -> str:
+        return self.infer_many([filename])[filename]
+
+    def infer_many(self, filenames: list) -> dict:
+        """Return {filename: "YYYY:MM:DD HH:MM:SS"} for every filename."""
+        results = {}
+        unresolved = {}
+        # Names the cache already knows to carry no date
+        known_undated = set()
+        for name in dict.fromkeys(filenames):
+            date = parse_filename_date(name)
+            if date is not None:
+                self._count("parser")
+                results[name] = date
+                continue
+            tier, date = self._from_cache(name)
+            if tier is not None:
+                self._count("cache")
+                results[name] = date
+                if date is None:
+                    known_undated.add(name)
+                continue
+            unresolved.setdefault(pattern_of(name), []).append(name)
+
+        if unresolved and self.use_llm:
+            # Ask once per pattern, then let the learned rule answer the rest
+            first = {p: names[0] for p, names in unresolved.items()}
+            answers = self._ask_llm(list(first.values()))
+            retry = []
+            for pattern, names in unresolved.items():
+                answer = answers.get(first[pattern])
+                if answer == _FAILED:
+                    answer = None
+                else:
+                    self._learn(first[pattern], answer)
+                results[first[pattern]] = answer
+                if answer is not None:
+                    self._count("llm")
+                for name in names[1:]:
+                    tier, date = self._from_cache(name)
+                    if tier is not None:
+                        self._count("cache")
+                        results[name] = date
+                        if date is None:
+                            known_undated.add(name)
+                    else:
+                        retry.append(name)
+            answers = self._ask_llm(retry)
+            for name in retry:
+                results[name] = answers.get(name)
+                if results[name] == _FAILED:
+                    results[name] = None
+                elif results[name] is not None:
+                    self._count("llm")
+
+        # Nothing worked: keep the previous behaviour of using today
+        for name in dict.fromkeys(filenames):
+            if results.get(name) is None:
+                if name not in known_undated:
+                    self._count("fallback")
+                results[name] = datetime.now().strftime("%Y:%m:%d 00:00:00")
+        return results
+
+    def _from_cache(self, filename: str):
+        with self._lock:
+            entry = self._patterns.get(pattern_of(filename))
+        if entry is None:
+            return None, None
+        if "rule" in entry:
+            date = _apply_rule(filename, entry["rule"])
+            return ("cache", date) if date is not None else (None, None)
+        return "cache", None
+
+    def _learn(self, filename: str, answer):
+        pattern = pattern_of(filename)
+        if answer is None:
+            entry = {"date": None}
+        else:
+            rule = _learn_rule(filename, answer[:10])
+            if rule is None:
+                return
+            entry = {"rule": rule}
+        with self._lock:
+            self._patterns[pattern] = entry
+
+    def _ask_llm(self, filenames: list) -> dict:
+        if not filenames:
+            return {}
+        with ThreadPoolExecutor(max_workers=LLM_CONCURRENCY) as pool:
+            return dict(zip(filenames, pool.map(_ask_llm, filenames)))
+
+    def _count(self, tier: str):
+        DATE_INFERENCE.inc(tier=tier)
+        with self._lock:
+            self._hits[tier] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = sum(self._hits.values())
+            return {
+                "total": total,
+                **{f"{tier}_hits": self._hits[tier] for tier in TIERS},
+                **{
+                    f"{tier}_rate": round(self._hits[tier] / total, 3) if total else 0
+                    for tier in TIERS
+                },
+            }
+
+    def save(self):
+        if not self.cache_file:
+            return
+        with self._lock:
+            with open(self.cache_file + ".tmp", "w") as f:
+                json.dump(self._patterns, f)
+            os.replace(self.cache_file + ".tmp", self.cache_file)
+
+    def log_stats(self):
+        ProcessingLoggerSingleton().get_logger().info(
+            f"Date inference: {json.dumps(self.stats())}"
+        )
+
+
+def _ask_llm(filename: str):
+    # Tier 3: returns "YYYY:MM:DD 00:00:00", None when the model found no
+    # date, or _FAILED when the request did not complete
+    logger = ProcessingLoggerSingleton().get_logger()
+    try:
+        response = requests.post(
+            f"{OLLAMA_URL}/api/generate",
+            json={
+                "model": "mirage-date-extractor",
+                "stream": False,
+                "prompt": filename,
+            },
+            timeout=LLM_TIMEOUT,
+        ).json()
+    except (requests.RequestException, ValueError) as e:
+        logger.warning(f"Date extraction request failed for {filename}: {e}")
+        return _FAILED
+
+    answer = str(response.get("response")).strip()
+    if (
+        response.get("done")
+        and str(response.get("done_reason")).strip().lower() == "stop"
+        and answer != "null"
+    ):
+        try:
+            return datetime.strptime(answer, "%Y:%m:%d").strftime("%Y:%m:%d 00:00:00")
+        except ValueError:
+            return None
+    return None
@@ -1,9 +1,15 @@
+import os
+import queue
+import threading
+import time
+import av
 import torch
-import imageio.v3 as iio
-from PIL import Image
-from os import path, makedirs
+from concurrent.futures import ThreadPoolExecutor
+from os import path
 from pillow_heif import register_heif_opener
 from mirage_logger import ProcessingLoggerSingleton
+from tools.metrics import QUEUE_DEPTH, observe_stage
+from tools.preprocess import decode_image, model_input
 
 import embedding_models.ResNet50_Embedding as ResNet50
 
@@ -13,68 +19,282 @@ transform = ResNet50.get_transforms()
 model = ResNet50.ResNet50_ImageEmbedder()
 model.eval()
 
+# Largest number of tensors sent through the model at once
+BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 16))
+# Seconds the model loop waits to fill a batch before running a partial one
+BATCH_TIMEOUT = float(os.getenv("EMBED_BATCH_TIMEOUT", 0.05))
+# Threads decoding and transforming media for the model loop
+DECODE_WORKERS = int(os.getenv("EMBED_DECODE_WORKERS", os.cpu_count() or 1))
+# Video frames sent to the model: "count" (VIDEO_MAX_FRAMES evenly spaced),
+# "fps" (VIDEO_SAMPLE_FPS frames per second), "keyframes" or "all"
+VIDEO_SAMPLING = os.getenv("VIDEO_SAMPLING", "count").lower()
+VIDEO_SAMPLING_MODES = ("count", "fps", "keyframes", "all")
+if VIDEO_SAMPLING not in VIDEO_SAMPLING_MODES:
+    raise ValueError(
+        f"VIDEO_SAMPLING must be one of {', '.join(VIDEO_SAMPLING_MODES)}, "
+        f"not {VIDEO_SAMPLING!r}"
+    )
+VIDEO_SAMPLE_FPS = float(os.getenv("VIDEO_SAMPLE_FPS", 1))
+VIDEO_MAX_FRAMES = int(os.getenv("VIDEO_MAX_FRAMES", 32))
 
-def create_embedding(file: str, embedding_folder: str, mimetype: str):
-    processing = ProcessingLoggerSingleton().get_logger()
-    processing.info(f"Creating embedding for {file}...")
+_STOP = object()
 
-    if mimetype.startswith("image/"):
-        return _create_embedding_for_image(file, embedding_folder)
-    elif mimetype.startswith("video/"):
-        return _create_embedding_for_video(file, embedding_folder)
-    else:
-        return False
-
-
-def _create_embedding_for_video(video_file: str, embedding_folder: str):
-    if not path.exists(embedding_folder):
-        makedirs(embedding_folder)
-
-    try:
-        embeddings = []
-        for frame in iio.imiter(video_file, plugin="pyav"):
-            with torch.no_grad():
-                # Transform images into tensors
-                img = Image.fromarray(frame)
-                t = transform(img)
-                # Create embedding vector
-                embedding = torch.squeeze(model(t.unsqueeze(0)))
-                # Append embedding to list
-                embeddings.append(embedding)
-
-        # Save embeddings to folder
-        torch.save(
-            torch.mean(torch.stack(embeddings), dim=0),
-            path.join(
-                embedding_folder, f"{path.basename(video_file).split('.')[0]}.pt"
-            ),
+
+class _Item:
+    def __init__(self, file: str, mimetype: str, callback, image=None):
+        self.file = file
+        self.mimetype = mimetype
+        self.callback = callback
+        self.image = image
+        self.sum = None
+        self.count = 0
+        self.error = None
+
+
+class EmbeddingPipeline:
+    """Decode workers feed a bounded queue that a single model loop drains in
+    dynamic batches. Results are written to the embedding store per item and
+    reported through the item's callback as ``callback(file, ok)``.
+    """
+
+    def __init__(
+        self,
+        store,
+        batch_size: int = BATCH_SIZE,
+        batch_timeout: float = BATCH_TIMEOUT,
+        workers: int = DECODE_WORKERS,
+    ):
+        self.store = store
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self._tensors = queue.Queue(maxsize=batch_size * 4)
+        self._decoders = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="embed-decode"
+        )
+        self._items = 0
+        self._frames = 0
+        self._batches = 0
+        self._model_seconds = 0.0
+        self._started = time.perf_counter()
+        self._model_thread = threading.Thread(
+            target=self._model_loop, name="embed-model", daemon=True
         )
-    except Exception as e:
-        print(e)
-        return False
-
-    return True
-
-
-def _create_embedding_for_image(image_file: str, embedding_folder: str) -> bool:
-    if not path.exists(embedding_folder):
-        makedirs(embedding_folder)
-
-    try:
-        with torch.no_grad():
-            # Transform images into tensors
-            img = Image.open(image_file)
-            t = transform(img)
-            # Create embedding vector
-            embedding = torch.squeeze(model(t.unsqueeze(0)))
-            # Save embedding to folder
-            torch.save(
-                embedding,
-                path.join(
-                    embedding_folder, f"{path.basename(image_file).split('.')[0]}.pt"
-                ),
+        self._model_thread.start()
+        QUEUE_DEPTH.track(self._tensors.qsize, queue="embed_tensors")
+
+    def submit(self, file: str, mimetype: str, callback=None, image=None):
+        """Queue a file. ``image`` is an already decoded and oriented PIL
+        image of it, used instead of decoding the file again."""
+        item = _Item(file, mimetype, callback, image)
+        self._decoders.submit(self._decode, item)
+
+    def close(self):
+        """Wait for every submitted item and log the measured throughput."""
+        self._decoders.shutdown(wait=True)
+        self._tensors.put(_STOP)
+        self._model_thread.join()
+        QUEUE_DEPTH.untrack(queue="embed_tensors")
+
+        processing = ProcessingLoggerSingleton().get_logger()
+        stats = self.stats()
+        processing.info(
+            f"Embedded {stats['items']} items ({stats['frames']} frames) in "
+            f"{stats['seconds']}s: {stats['frames_per_second']} images/sec, "
+            f"average batch {stats['average_batch']}, "
+            f"batch_size={self.batch_size}, batch_timeout={self.batch_timeout}."
+        )
+
+    def stats(self) -> dict:
+        elapsed = time.perf_counter() - self._started
+        return {
+            "items": self._items,
+            "frames": self._frames,
+            "batches": self._batches,
+            "seconds": round(elapsed, 2),
+            "model_seconds": round(self._model_seconds, 2),
+            "frames_per_second": round(self._frames / elapsed, 2) if elapsed else 0,
+            "average_batch": (
+                round(self._frames / self._batches, 2) if self._batches else 0
+            ),
+        }
+
+    def _decode(self, item: _Item):
+        try:
+            for t in _frames(item.file, item.mimetype, item.image):
+                self._tensors.put((item, t))
+        except Exception as e:
+            item.error = e
+        finally:
+            item.image = None
+            # Sentinel: every tensor of this item is already queued
+            self._tensors.put((item, None))
+
+    def _model_loop(self):
+        stop = False
+        while not stop:
+            entry = self._tensors.get()
+            if entry is _STOP:
+                break
+            batch = [entry]
+            size = 0 if entry[1] is None else 1
+            deadline = time.monotonic() + self.batch_timeout
+            while size < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = self._tensors.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stop = True
+                    break
+                batch.append(entry)
+                size += entry[1] is not None
+            self._run_batch(batch)
+
+    def _run_batch(self, batch: list):
+        tensors = [t for _, t in batch if t is not None]
+        embeddings = iter(())
+        if tensors:
+            start = time.perf_counter()
+            try:
+                with torch.no_grad():
+                    embeddings = iter(
+                        model(torch.stack(tensors)).reshape(len(tensors), -1)
+                    )
+            except Exception as e:
+                for item, t in batch:
+                    item.error = item.error or e
+            elapsed = time.perf_counter() - start
+            self._model_seconds += elapsed
+            observe_stage("model_batch", elapsed)
+            self._frames += len(tensors)
+            self._batches += 1
+
+        for item, t in batch:
+            if t is not None:
+                embedding = next(embeddings, None)
+                if embedding is not None:
+                    item.sum = embedding if item.sum is None else item.sum + embedding
+                    item.count += 1
+            else:
+                self._finish(item)
+
+    def _finish(self, item: _Item):
+        processing = ProcessingLoggerSingleton().get_logger()
+        ok = False
+        if item.error is None and item.count > 0:
+            try:
+                # Mean of all frames, a single frame for images
+                self.store.append(
+                    path.basename(item.file).split(".")[0],
+                    (item.sum / item.count).numpy(),
+                )
+                ok = True
+            except Exception as e:
+                item.error = e
+        if not ok:
+            processing.error(
+                f"Failed to create embedding for {item.file}: {item.error}"
             )
-            return True
-    except Exception as e:
-        print(e)
-        return False
+        self._items += 1
+        if item.callback is not None:
+            try:
+                item.callback(item.file, ok)
+            except Exception as e:
+                # The model thread must keep draining the tensor queue
+                processing.error(f"Embedding callback for {item.file} failed: {e}")
+
+
+def _frames(file: str, mimetype: str, image=None):
+    # Yield the model input tensors of a media file
+    if image is not None:
+        yield transform(image)
+    elif mimetype.startswith("image/"):
+        yield transform(model_input(decode_image(file)))
+    elif mimetype.startswith("video/"):
+        for frame in _sample_video(file):
+            # Let swscale downsize before the frame becomes a PIL image
+            scale = 256 / min(frame.width, frame.height)
+            if scale < 1:
+                frame = frame.reformat(
+                    width=round(frame.width * scale), height=round(frame.height * scale)
+                )
+            yield transform(frame.to_image())
+    else:
+        raise ValueError(f"Unsupported content type: {mimetype}")
+
+
+def _sample_video(file: str, mode: str = None):
+    # Yield the decoded video frames selected by the sampling mode
+    mode = mode or VIDEO_SAMPLING
+    if mode not in VIDEO_SAMPLING_MODES:
+        raise ValueError(f"Unsupported video sampling mode: {mode}")
+    with av.open(file) as container:
+        stream = container.streams.video[0]
+        stream.thread_type = "AUTO"
+
+        if mode == "all":
+            yield from container.decode(stream)
+            return
+        if mode == "keyframes":
+            # The decoder skips everything but keyframes without decoding them
+            stream.codec_context.skip_frame = "NONKEY"
+            yield from container.decode(stream)
+            return
+
+        start = float(stream.start_time * stream.time_base) if stream.start_time else 0
+        if stream.duration:
+            duration = float(stream.duration * stream.time_base)
+        elif container.duration:
+            duration = container.duration / av.time_base
+        else:
+            duration = None
+
+        if mode == "count" and duration:
+            step = duration / VIDEO_MAX_FRAMES
+            targets = [start + (i + 0.5) * step for i in range(VIDEO_MAX_FRAMES)]
+        elif duration:
+            step = 1 / VIDEO_SAMPLE_FPS
+            targets = [start + i * step for i in range(int(duration / step) + 1)]
+        else:
+            # Unknown length: one sequential pass keeping VIDEO_SAMPLE_FPS frames
+            next_time = None
+            for frame in container.decode(stream):
+                if frame.time is None:
+                    continue
+                if next_time is None or frame.time >= next_time:
+                    next_time = frame.time + 1 / VIDEO_SAMPLE_FPS
+                    yield frame
+            return
+
+        last = None
+        for target in targets:
+            if last is not None and last.time is not None and last.time >= target:
+                continue
+            # Jump to the keyframe before the target, then decode up to it
+            container.seek(int(target / stream.time_base), stream=stream, backward=True)
+            for frame in container.decode(stream):
+                if frame.time is None or frame.time >= target:
+                    last = frame
+                    yield frame
+                    break
+
+
+def create_embedding(file: str, store, mimetype: str) -> bool:
+    processing = ProcessingLoggerSingleton().get_logger()
+    processing.info(f"Creating embedding for {file}...")
+
+    results = create_embeddings([(file, mimetype)], store)
+    return results[file]
+
+
+def create_embeddings(files: list, store, **pipeline_options) -> dict:
+    """Embed a list of (file, mimetype) pairs. Returns {file: ok}."""
+    results = {}
+    pipeline = EmbeddingPipeline(store, **pipeline_options)
+    for file, mimetype in files:
+        pipeline.submit(file, mimetype, lambda f, ok: results.__setitem__(f, ok))
+    pipeline.close()
+    return results
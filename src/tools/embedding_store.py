@@ -0,0 +1,452 @@
+"""
+embedding_store.py
+Description: Append-only, memory-mapped store for media embeddings.
+
+Vectors are kept as unit-normalized float32 rows in one fixed-width matrix
+file, with a parallel fixed-width file holding the 32 character media id of
+every row. Re-embedding an id appends a new row that supersedes the old one,
+and deleting or trashing an id appends a tombstone record. Dead rows are only
+dropped by compact(), which rewrites the live rows into a new generation of
+files and switches to it atomically through store.json.
+
+One process writes the store at a time (the processor), holding .writer.lock
+for as long as it has the store open. Other processes open it read-only to
+inspect it; they never create, repair or change its files.
+"""
+
+import fcntl
+import json
+import os
+import sys
+import threading
+from argparse import ArgumentParser
+
+import numpy as np
+
+from mirage_logger import ProcessingLoggerSingleton
+
+ID_WIDTH = 32
+ID_RECORD = ID_WIDTH + 1  # id plus newline
+MANIFEST = "store.json"
+# Share of superseded rows past which the processor compacts when idle
+COMPACT_RATIO = float(os.getenv("EMBEDDING_COMPACT_RATIO", 0.25))
+
+
+class LiveMatrix:
+    """The live rows of a matrix that also holds dead ones, by position.
+
+    Indexing gathers only the requested rows, and similarities() multiplies
+    with every live row straight from the matrix and drops the dead columns
+    afterwards, so the live rows are never copied as a whole. A product thus
+    spans ``span`` columns, dead ones included, until the store is compacted.
+    """
+
+    def __init__(self, matrix, rows=None):
+        self.matrix = matrix
+        # Sorted row of every live position, None when every row is live
+        self.rows = None if rows is None or len(rows) == len(matrix) else rows
+        self.shape = (len(matrix if self.rows is None else self.rows), matrix.shape[1])
+        self.span = len(matrix)
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if self.rows is None:
+            return self.matrix[index]
+        return np.asarray(self.matrix[self.rows[index]])
+
+    def similarities(self, vectors, start: int = 0) -> np.ndarray:
+        """``vectors @ self[start:].T``"""
+        vectors = np.asarray(vectors)
+        if self.rows is None:
+            return vectors @ np.asarray(self.matrix[start:]).T
+        if start >= len(self):
+            return np.empty((len(vectors), 0), dtype=np.float32)
+        first = self.rows[start]
+        sims = vectors @ np.asarray(self.matrix[first:]).T
+        return sims[:, self.rows[start:] - first]
+
+
+class StoreLocked(Exception):
+    """The store is open for writing in another process."""
+
+
+class EmbeddingStore:
+    def __init__(
+        self,
+        folder: str,
+        dim: int = 2048,
+        read_only: bool = False,
+        wait: bool = True,
+    ):
+        """Open the store for writing, waiting for the writer lock unless
+        ``wait`` is False (then StoreLocked is raised), or ``read_only``."""
+        self.folder = folder
+        self.read_only = read_only
+        self._lock = threading.RLock()
+        self._writer_lock = None
+        if not read_only:
+            os.makedirs(folder, exist_ok=True)
+            self._lock_writer(wait)
+
+        manifest = os.path.join(folder, MANIFEST)
+        if os.path.isfile(manifest):
+            with open(manifest, "r") as f:
+                state = json.load(f)
+        else:
+            state = {"dim": dim, "generation": 0}
+            if not read_only:
+                self._write_manifest(state)
+        self.dim = state["dim"]
+        self._open_generation(state["generation"])
+
+    def _lock_writer(self, wait: bool):
+        self._writer_lock = open(os.path.join(self.folder, ".writer.lock"), "w")
+        try:
+            fcntl.flock(self._writer_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if not wait:
+                self._writer_lock.close()
+                raise StoreLocked(
+                    f"Embedding store {self.folder} is open for writing in "
+                    "another process."
+                )
+            ProcessingLoggerSingleton().get_logger().info(
+                "Embedding store is open in another process, waiting for its lock."
+            )
+            fcntl.flock(self._writer_lock, fcntl.LOCK_EX)
+
+    def _check_writable(self):
+        if self.read_only:
+            raise ValueError(f"Embedding store {self.folder} is open read-only")
+
+    # File layout
+    def _paths(self, generation: int):
+        return (
+            os.path.join(self.folder, f"vectors.{generation}.f32"),
+            os.path.join(self.folder, f"ids.{generation}.txt"),
+            os.path.join(self.folder, f"tombstones.{generation}.log"),
+        )
+
+    def _write_manifest(self, state: dict):
+        tmp = os.path.join(self.folder, MANIFEST + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, os.path.join(self.folder, MANIFEST))
+
+    def _open_generation(self, generation: int):
+        self.generation = generation
+        self._vectors_path, self._ids_path, self._tombstones_path = self._paths(
+            generation
+        )
+        if not self.read_only:
+            self._repair()
+
+        self._count = 0
+        self._ids = []
+        self._rows = {}
+        self._dead = set()
+        self._ids_offset = 0
+        self._tombstones_offset = 0
+        self._mmap = None
+        self._read_new_records()
+
+    def _repair(self):
+        # Only the writer: a crash between the vector and id writes leaves one
+        # file longer than the other; trim both back to the last complete row.
+        for p in (self._vectors_path, self._ids_path, self._tombstones_path):
+            open(p, "ab").close()
+        count = min(
+            os.path.getsize(self._vectors_path) // (self.dim * 4),
+            os.path.getsize(self._ids_path) // ID_RECORD,
+        )
+        for p, width in (
+            (self._vectors_path, self.dim * 4),
+            (self._ids_path, ID_RECORD),
+        ):
+            if os.path.getsize(p) != count * width:
+                os.truncate(p, count * width)
+
+    def _read_new_records(self):
+        # Pick up rows and tombstones appended since the last read. An id is
+        # only taken once its vector is on disk, which the writer ensures and
+        # a reader next to a running writer relies on.
+        data = _read_from(self._ids_path, self._ids_offset)
+        try:
+            vectors = os.path.getsize(self._vectors_path) // (self.dim * 4)
+        except FileNotFoundError:
+            vectors = 0
+        complete = len(data) - len(data) % ID_RECORD
+        complete = max(min(complete, (vectors - len(self._ids)) * ID_RECORD), 0)
+        for offset in range(0, complete, ID_RECORD):
+            uid = data[offset : offset + ID_WIDTH].decode("ascii")
+            self._rows[uid] = len(self._ids)
+            self._ids.append(uid)
+        self._ids_offset += complete
+        self._count = len(self._ids)
+
+        data = _read_from(self._tombstones_path, self._tombstones_offset)
+        complete = data.rfind(b"\n") + 1
+        for line in data[:complete].decode("ascii").splitlines():
+            if line.startswith("-"):
+                self._dead.add(line[1:])
+            elif line.startswith("+"):
+                self._dead.discard(line[1:])
+        self._tombstones_offset += complete
+
+    def refresh(self):
+        """Reload records written by another process since the last read."""
+        with self._lock:
+            with open(os.path.join(self.folder, MANIFEST), "r") as f:
+                generation = json.load(f)["generation"]
+            if generation != self.generation:
+                self._open_generation(generation)
+            else:
+                self._read_new_records()
+
+    # Reads
+    def __len__(self) -> int:
+        return len(self._rows) - len(self._dead & self._rows.keys())
+
+    def __contains__(self, uid: str) -> bool:
+        return uid in self._rows and uid not in self._dead
+
+    def matrix(self) -> np.ndarray:
+        """Read-only view of every row on disk, including superseded and dead ones."""
+        with self._lock:
+            if self._count == 0:
+                return np.empty((0, self.dim), dtype=np.float32)
+            if self._mmap is None or len(self._mmap) != self._count:
+                self._mmap = np.memmap(
+                    self._vectors_path,
+                    dtype=np.float32,
+                    mode="r",
+                    shape=(self._count, self.dim),
+                )
+            return self._mmap
+
+    def get(self, uid: str):
+        if uid not in self:
+            return None
+        return self.matrix()[self._rows[uid]]
+
+    def live(self):
+        """Return (ids, rows) of every live embedding in row order."""
+        with self._lock:
+            rows = sorted(
+                row for uid, row in self._rows.items() if uid not in self._dead
+            )
+            return [self._ids[row] for row in rows], np.asarray(rows, dtype=np.int64)
+
+    def live_matrix(self):
+        """Return (ids, LiveMatrix) of live embeddings, without copying them."""
+        ids, rows = self.live()
+        return ids, LiveMatrix(self.matrix(), rows)
+
+    # Writes
+    def append(self, uid: str, vector):
+        if len(uid) != ID_WIDTH:
+            raise ValueError(f"Invalid media ID for embedding store: {uid}")
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"Expected {self.dim}-d embedding, got {vector.shape[0]}")
+        vector = vector / max(float(np.linalg.norm(vector)), 1e-8)
+
+        self._check_writable()
+        with self._lock:
+            # Vector first, so a torn write never indexes a missing row
+            with open(self._vectors_path, "ab") as f:
+                f.write(vector.astype(np.float32).tobytes())
+            with open(self._ids_path, "ab") as f:
+                f.write(uid.encode("ascii") + b"\n")
+            self._read_new_records()
+            if uid in self._dead:
+                self.restore(uid)
+
+    def delete(self, uid: str):
+        with self._lock:
+            if uid in self._rows and uid not in self._dead:
+                self._append_tombstone(f"-{uid}")
+
+    def restore(self, uid: str):
+        with self._lock:
+            if uid in self._dead:
+                self._append_tombstone(f"+{uid}")
+
+    def sync_deleted(self, uids) -> int:
+        """Delete exactly ``uids``: tombstone the live ones and restore every
+        other deleted id. Returns the number of ids changed."""
+        uids = set(uids)
+        with self._lock:
+            deleted = (uids & self._rows.keys()) - self._dead
+            restored = self._dead - uids
+            for uid in deleted:
+                self._append_tombstone(f"-{uid}")
+            for uid in restored:
+                self._append_tombstone(f"+{uid}")
+        return len(deleted) + len(restored)
+
+    def _append_tombstone(self, record: str):
+        self._check_writable()
+        with open(self._tombstones_path, "ab") as f:
+            f.write(record.encode("ascii") + b"\n")
+        self._read_new_records()
+
+    def flush(self):
+        self._check_writable()
+        with self._lock:
+            for p in (self._vectors_path, self._ids_path, self._tombstones_path):
+                with open(p, "rb+") as f:
+                    os.fsync(f.fileno())
+
+    def superseded(self) -> int:
+        """Rows replaced by a later row of the same id."""
+        return self._count - len(self._rows)
+
+    def needs_compaction(self, ratio: float = COMPACT_RATIO) -> bool:
+        return self._count > 0 and self.superseded() > ratio * self._count
+
+    def compact(self, keep_deleted: bool = False) -> int:
+        """Drop superseded and tombstoned rows. Returns the number of rows removed.
+
+        With ``keep_deleted`` only superseded rows are dropped and deleted ids
+        keep their tombstoned row, so a trashed item can still be restored.
+        """
+        logger = ProcessingLoggerSingleton().get_logger()
+        self._check_writable()
+        with self._lock:
+            if keep_deleted:
+                rows = np.asarray(sorted(self._rows.values()), dtype=np.int64)
+                ids = [self._ids[row] for row in rows]
+                deleted = [uid for uid in ids if uid in self._dead]
+            else:
+                ids, rows = self.live()
+                deleted = []
+            removed = self._count - len(ids)
+            if removed == 0:
+                return 0
+
+            old = self._paths(self.generation)
+            new_generation = self.generation + 1
+            vectors_path, ids_path, tombstones_path = self._paths(new_generation)
+            matrix = self.matrix()
+            with open(vectors_path, "wb") as f:
+                for start in range(0, len(rows), 4096):
+                    f.write(np.asarray(matrix[rows[start : start + 4096]]).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            with open(ids_path, "wb") as f:
+                f.write("".join(f"{uid}\n" for uid in ids).encode("ascii"))
+                f.flush()
+                os.fsync(f.fileno())
+            with open(tombstones_path, "wb") as f:
+                f.write("".join(f"-{uid}\n" for uid in deleted).encode("ascii"))
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._mmap = None
+            self._write_manifest({"dim": self.dim, "generation": new_generation})
+            self._open_generation(new_generation)
+            for p in old:
+                os.remove(p)
+
+        logger.info(f"Compacted embedding store, removed {removed} rows.")
+        return removed
+
+    def migrate_from_pt(self, pt_folder: str) -> int:
+        """Import legacy per-item .pt embeddings, then retire the folder."""
+        if not os.path.isdir(pt_folder):
+            return 0
+
+        from torch import load as tload
+
+        logger = ProcessingLoggerSingleton().get_logger()
+        logger.info(f"Migrating .pt embeddings from {pt_folder}...")
+        migrated = 0
+        for root, _, files in os.walk(pt_folder):
+            for f in sorted(files):
+                uid = f.split(".")[0]
+                if not f.endswith(".pt") or uid in self._rows:
+                    continue
+                try:
+                    self.append(
+                        uid, tload(os.path.join(root, f), weights_only=True).numpy()
+                    )
+                    migrated += 1
+                except Exception as e:
+                    logger.error(f"Failed to migrate embedding {f}: {e}")
+        self.flush()
+
+        os.rename(pt_folder, pt_folder.rstrip(os.sep) + ".migrated")
+        logger.info(f"Migrated {migrated} embeddings into the embedding store.")
+        return migrated
+
+
+def _read_from(path: str, offset: int) -> bytes:
+    try:
+        with open(path, "rb") as f:
+            f.seek(offset)
+            return f.read()
+    except FileNotFoundError:
+        # A store that was never written, opened read-only
+        return b""
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(prog="embedding_store")
+    parser.add_argument(dest="folder")
+    parser.add_argument(
+        dest="command", choices=["compact", "migrate", "info", "reembed"]
+    )
+    parser.add_argument("--pt-folder", dest="pt_folder")
+    parser.add_argument(
+        "--catalog", help="Catalog for reembed (default: catalog.db next to folder)"
+    )
+    args = parser.parse_args()
+
+    # Only compact and migrate write; they refuse to run next to the processor
+    try:
+        store = EmbeddingStore(
+            args.folder,
+            read_only=args.command in ("info", "reembed"),
+            wait=False,
+        )
+    except StoreLocked as e:
+        print(f"{e} Stop the processor first.")
+        sys.exit(2)
+    if args.command == "compact":
+        print(f"Removed {store.compact()} rows.")
+    elif args.command == "migrate":
+        print(f"Migrated {store.migrate_from_pt(args.pt_folder)} embeddings.")
+    elif args.command == "reembed":
+        # Images embedded before inputs were EXIF-oriented and taken from the
+        # shared decode; the processor imports them again from the media
+        # folder, and each new embedding supersedes the old row
+        from tools.catalog import Catalog
+        from tools.jobs import JobQueue
+
+        catalog = Catalog(
+            args.catalog
+            or os.path.join(os.path.dirname(os.path.abspath(args.folder)), "catalog.db")
+        )
+        names = [
+            item["name"]
+            for item in catalog.items()
+            if item["name"][:32] in store
+            and item["metadata"].get("MIMEType", "").startswith("image/")
+        ]
+        job_id, names = JobQueue(catalog).create_for(names)
+        print(f"Queued {len(names)} images to embed again as job {job_id}.")
+    else:
+        print(
+            json.dumps(
+                {
+                    "generation": store.generation,
+                    "rows": store._count,
+                    "live": len(store),
+                }
+            )
+        )
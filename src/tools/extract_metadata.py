@@ -1,127 +1,199 @@
 import exiftool
-import requests
-from datetime import datetime
+import threading
+import time
 from mirage_logger import ProcessingLoggerSingleton
+from tools.date_inference import DateInferenceEngine
+from tools.metrics import observe_stage
 
+TAGS = [
+    "File:FileSize",
+    "File:MIMEType",
+    "File:ImageWidth",
+    "File:ImageHeight",
+    "PNG:ImageWidth",
+    "PNG:ImageHeight",
+    "QuickTime:ImageWidth",
+    "QuickTime:ImageHeight",
+    "EXIF:DateTimeOriginal",
+    "EXIF:DateTime",
+    "EXIF:DateTimeDigitized",
+    "EXIF:CreateDate",
+    "QuickTime:CreateDate",
+    "QuickTime:ModifyDate",
+    "QuickTime:TrackCreateDate",
+    "QuickTime:TrackModifyDate",
+    "QuickTime:MediaCreateDate",
+    "QuickTime:MediaModifyDate",
+    "GPSPosition",
+]
 
-def get_metadata(id_file_path: str, org_filename: str) -> dict:
+
+class ExifToolWorker:
+    """A long-lived exiftool process that reads tags for batches of files.
+
+    The process is started lazily and restarted after it crashes. A batch that
+    fails is retried file by file so one unreadable file only fails itself.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._et = None
+
+    def _helper(self):
+        if self._et is None or not self._et.running:
+            self._et = exiftool.ExifToolHelper()
+            self._et.run()
+        return self._et
+
+    def _restart(self):
+        try:
+            if self._et is not None:
+                self._et.terminate()
+        except Exception:
+            pass
+        self._et = None
+
+    def get_tags(self, files: list) -> list:
+        """Return one tag dict, or the raised exception, per file."""
+        logger = ProcessingLoggerSingleton().get_logger()
+        with self._lock:
+            try:
+                return self._helper().get_tags(files, tags=TAGS)
+            except Exception as e:
+                logger.warning(f"exiftool batch of {len(files)} failed: {e}")
+                self._restart()
+
+            results = []
+            for f in files:
+                try:
+                    results.append(self._helper().get_tags([f], tags=TAGS)[0])
+                except Exception as e:
+                    self._restart()
+                    results.append(e)
+            return results
+
+    def close(self):
+        with self._lock:
+            self._restart()
+
+
+def get_metadata(
+    id_file_path: str,
+    org_filename: str,
+    worker: ExifToolWorker = None,
+    dates: DateInferenceEngine = None,
+) -> dict:
+    owned = worker is None
+    worker = worker or ExifToolWorker()
+    try:
+        result = get_metadata_batch([(id_file_path, org_filename)], worker, dates)[0]
+    finally:
+        if owned:
+            worker.close()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def get_metadata_batch(
+    files: list, worker: ExifToolWorker, dates: DateInferenceEngine = None
+) -> list:
+    """Read and normalize metadata for (file path, original filename) pairs
+    with a single exiftool call. Returns a dict, or the exception, per file.
+    Files without an EXIF date get one inferred from their original filename.
+    """
     logger = ProcessingLoggerSingleton().get_logger()
-    logger.info(f"Getting metadata for {org_filename}.")
+    logger.info(f"Getting metadata for {len(files)} files.")
+    start = time.perf_counter()
+    tags = worker.get_tags([f for f, _ in files])
+    observe_stage("exiftool", time.perf_counter() - start)
 
-    def is_valid_date_format(date_string):
+    results = []
+    for metadata in tags:
+        if isinstance(metadata, Exception):
+            results.append(metadata)
+            continue
         try:
-            datetime.strptime(date_string, "%Y:%m:%d")
-            return True
-        except ValueError:
-            return False
-
-    with exiftool.ExifToolHelper() as et:
-        metadata = et.get_tags(
-            [id_file_path],
-            tags=[
-                "File:FileSize",
-                "File:MIMEType",
-                "File:ImageWidth",
-                "File:ImageHeight",
-                "PNG:ImageWidth",
-                "PNG:ImageHeight",
-                "QuickTime:ImageWidth",
-                "QuickTime:ImageHeight",
-                "EXIF:DateTimeOriginal",
-                "EXIF:DateTime",
-                "EXIF:DateTimeDigitized",
-                "EXIF:CreateDate",
-                "QuickTime:CreateDate",
-                "QuickTime:ModifyDate",
-                "QuickTime:TrackCreateDate",
-                "QuickTime:TrackModifyDate",
-                "QuickTime:MediaCreateDate",
-                "QuickTime:MediaModifyDate",
-                "GPSPosition",
-            ],
-        )[0]
-
-        del metadata["SourceFile"]
-
-        metadata["FileSize"] = metadata.pop("File:FileSize")
-        metadata["MIMEType"] = metadata.pop("File:MIMEType")
-
-        if "File:ImageWidth" in metadata:
-            metadata["Width"] = metadata.pop("File:ImageWidth")
-        elif "PNG:ImageWidth" in metadata:
-            metadata["Width"] = metadata.pop("PNG:ImageWidth")
-        elif "QuickTime:ImageWidth" in metadata:
-            metadata["Width"] = metadata.pop("QuickTime:ImageWidth")
-
-        metadata.pop("File:ImageWidth", None)
-        metadata.pop("PNG:ImageWidth", None)
-        metadata.pop("QuickTime:ImageWidth", None)
-
-        if "File:ImageHeight" in metadata:
-            metadata["Height"] = metadata.pop("File:ImageHeight")
-        elif "PNG:ImageHeight" in metadata:
-            metadata["Height"] = metadata.pop("PNG:ImageHeight")
-        elif "QuickTime:ImageHeight" in metadata:
-            metadata["Height"] = metadata.pop("QuickTime:ImageHeight")
-
-        metadata.pop("File:ImageHeight", None)
-        metadata.pop("PNG:ImageHeight", None)
-        metadata.pop("QuickTime:ImageHeight", None)
-
-        if "EXIF:DateTimeOriginal" in metadata:
-            metadata["CreateDate"] = metadata.pop("EXIF:DateTimeOriginal")
-        elif "EXIF:DateTime" in metadata:
-            metadata["CreateDate"] = metadata.pop("EXIF:DateTime")
-        elif "EXIF:DateTimeDigitized" in metadata:
-            metadata["CreateDate"] = metadata.pop("EXIF:DateTimeDigitized")
-        elif "EXIF:CreateDate" in metadata:
-            metadata["CreateDate"] = metadata.pop("EXIF:CreateDate")
-        elif "QuickTime:CreateDate" in metadata:
-            metadata["CreateDate"] = metadata.pop("QuickTime:CreateDate")
-        elif "QuickTime:ModifyDate" in metadata:
-            metadata["CreateDate"] = metadata.pop("QuickTime:ModifyDate")
-        elif "QuickTime:TrackCreateDate" in metadata:
-            metadata["CreateDate"] = metadata.pop("QuickTime:TrackCreateDate")
-        elif "QuickTime:TrackModifyDate" in metadata:
-            metadata["CreateDate"] = metadata.pop("QuickTime:TrackModifyDate")
-        elif "QuickTime:MediaCreateDate" in metadata:
-            metadata["CreateDate"] = metadata.pop("QuickTime:MediaCreateDate")
-        elif "QuickTime:MediaModifyDate" in metadata:
-            metadata["CreateDate"] = metadata.pop("QuickTime:MediaModifyDate")
-
-        metadata.pop("EXIF:DateTimeOriginal", None)
-        metadata.pop("EXIF:DateTime", None)
-        metadata.pop("EXIF:DateTimeDigitized", None)
-        metadata.pop("EXIF:CreateDate", None)
-        metadata.pop("QuickTime:CreateDate", None)
-        metadata.pop("QuickTime:ModifyDate", None)
-        metadata.pop("QuickTime:TrackCreateDate", None)
-        metadata.pop("QuickTime:TrackModifyDate", None)
-        metadata.pop("QuickTime:MediaCreateDate", None)
-        metadata.pop("QuickTime:MediaModifyDate", None)
-
-        if "CreateDate" not in metadata:
-            response = requests.post(
-                f"http://ollama:11434/api/generate",
-                json={
-                    "model": "mirage-date-extractor",
-                    "stream": False,
-                    "prompt": org_filename,
-                },
-            )
-            if (
-                response.json()["done"]
-                and str(response.json()["done_reason"]).strip().lower() == "stop"
-                and str(response.json()["response"]).strip() != "null"
-                and is_valid_date_format(str(response.json()["response"]).strip())
-            ):
-                metadata["CreateDate"] = datetime.strptime(
-                    str(response.json()["response"]).strip(), "%Y:%m:%d"
-                ).strftime("%Y:%m:%d 00:00:00")
-            else:
-                metadata["CreateDate"] = datetime.now().strftime("%Y:%m:%d 00:00:00")
-
-        if "Composite:GPSPosition" in metadata:
-            metadata["GPSPosition"] = metadata.pop("Composite:GPSPosition")
-
-        return metadata
+            results.append(_normalize(metadata))
+        except Exception as e:
+            results.append(e)
+
+    undated = [
+        org_filename
+        for (_, org_filename), metadata in zip(files, results)
+        if isinstance(metadata, dict) and "CreateDate" not in metadata
+    ]
+    if undated:
+        start = time.perf_counter()
+        inferred = (dates or DateInferenceEngine()).infer_many(undated)
+        observe_stage("date_inference", time.perf_counter() - start)
+        for (_, org_filename), metadata in zip(files, results):
+            if isinstance(metadata, dict) and "CreateDate" not in metadata:
+                metadata["CreateDate"] = inferred[org_filename]
+    return results
+
+
+def _normalize(metadata: dict) -> dict:
+    del metadata["SourceFile"]
+
+    metadata["FileSize"] = metadata.pop("File:FileSize")
+    metadata["MIMEType"] = metadata.pop("File:MIMEType")
+
+    if "File:ImageWidth" in metadata:
+        metadata["Width"] = metadata.pop("File:ImageWidth")
+    elif "PNG:ImageWidth" in metadata:
+        metadata["Width"] = metadata.pop("PNG:ImageWidth")
+    elif "QuickTime:ImageWidth" in metadata:
+        metadata["Width"] = metadata.pop("QuickTime:ImageWidth")
+
+    metadata.pop("File:ImageWidth", None)
+    metadata.pop("PNG:ImageWidth", None)
+    metadata.pop("QuickTime:ImageWidth", None)
+
+    if "File:ImageHeight" in metadata:
+        metadata["Height"] = metadata.pop("File:ImageHeight")
+    elif "PNG:ImageHeight" in metadata:
+        metadata["Height"] = metadata.pop("PNG:ImageHeight")
+    elif "QuickTime:ImageHeight" in metadata:
+        metadata["Height"] = metadata.pop("QuickTime:ImageHeight")
+
+    metadata.pop("File:ImageHeight", None)
+    metadata.pop("PNG:ImageHeight", None)
+    metadata.pop("QuickTime:ImageHeight", None)
+
+    if "EXIF:DateTimeOriginal" in metadata:
+        metadata["CreateDate"] = metadata.pop("EXIF:DateTimeOriginal")
+    elif "EXIF:DateTime" in metadata:
+        metadata["CreateDate"] = metadata.pop("EXIF:DateTime")
+    elif "EXIF:DateTimeDigitized" in metadata:
+        metadata["CreateDate"] = metadata.pop("EXIF:DateTimeDigitized")
+    elif "EXIF:CreateDate" in metadata:
+        metadata["CreateDate"] = metadata.pop("EXIF:CreateDate")
+    elif "QuickTime:CreateDate" in metadata:
+        metadata["CreateDate"] = metadata.pop("QuickTime:CreateDate")
+    elif "QuickTime:ModifyDate" in metadata:
+        metadata["CreateDate"] = metadata.pop("QuickTime:ModifyDate")
+    elif "QuickTime:TrackCreateDate" in metadata:
+        metadata["CreateDate"] = metadata.pop("QuickTime:TrackCreateDate")
+    elif "QuickTime:TrackModifyDate" in metadata:
+        metadata["CreateDate"] = metadata.pop("QuickTime:TrackModifyDate")
+    elif "QuickTime:MediaCreateDate" in metadata:
+        metadata["CreateDate"] = metadata.pop("QuickTime:MediaCreateDate")
+    elif "QuickTime:MediaModifyDate" in metadata:
+        metadata["CreateDate"] = metadata.pop("QuickTime:MediaModifyDate")
+
+    metadata.pop("EXIF:DateTimeOriginal", None)
+    metadata.pop("EXIF:DateTime", None)
+    metadata.pop("EXIF:DateTimeDigitized", None)
+    metadata.pop("EXIF:CreateDate", None)
+    metadata.pop("QuickTime:CreateDate", None)
+    metadata.pop("QuickTime:ModifyDate", None)
+    metadata.pop("QuickTime:TrackCreateDate", None)
+    metadata.pop("QuickTime:TrackModifyDate", None)
+    metadata.pop("QuickTime:MediaCreateDate", None)
+    metadata.pop("QuickTime:MediaModifyDate", None)
+
+    if "Composite:GPSPosition" in metadata:
+        metadata["GPSPosition"] = metadata.pop("Composite:GPSPosition")
+
+    return metadata
@@ -1,72 +1,226 @@
-from torch import load as tload
-from torch.nn.functional import cosine_similarity
+import numpy as np
 from json import dump, load
-from os import path, walk
+from os import path, replace
+from mirage_logger import ProcessingLoggerSingleton
+from tools.ann_index import NPROBE, candidate_pairs
+from tools.embedding_store import LiveMatrix
 
 # .832104802131654 - resnet50
 THRESHOLD = 0.832104802131654
-
-
-def find_similar(vector_folder, filename_mapping_json, media_folder, output):
-    clusters = {}
-    files = [
-        path.join(root, f) for root, _, files in walk(vector_folder) for f in files
-    ]
-
-    for file in files:
-        similar_images = _calculate_cosine_delta(file, files)
-        clusters[file] = list(similar_images.keys())
-
-    def get_cluster(node):
-        cluster = set()
-        stack = [node]
-
-        while stack:
-            current_node = stack.pop()
-            cluster.add(current_node)
-
-            for neighbor in clusters[current_node]:
-                if neighbor not in cluster:
-                    stack.append(neighbor)
-
-        return cluster
-
+# Upper bound (bytes) for one block of the similarity matrix
+BLOCK_MEMORY_LIMIT = 256 * 1024**2
+# Corpus size from which candidates come from the ANN index, when one is given
+ANN_MIN_SIZE = 50_000
+
+
+class UnionFind:
+    def __init__(self, parent: dict = None):
+        self.parent = dict(parent or {})
+
+    def add(self, x):
+        self.parent.setdefault(x, x)
+
+    def find(self, x):
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        # Path compression keeps the persisted trees flat
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+    def discard(self, members):
+        # Only valid for whole components, since it drops their parents
+        for x in members:
+            self.parent.pop(x, None)
+
+
+def find_similar(
+    store,
+    filename_mapping_json,
+    media_folder,
+    output,
+    state_file=None,
+    memory_limit=BLOCK_MEMORY_LIMIT,
+    index=None,
+    nprobe=NPROBE,
+    changed=(),
+):
+    """Group similar embeddings of ``store`` into ``output``.
+
+    ``changed`` holds the ids whose embeddings were replaced since the last
+    run (re-imported items); they leave their old groups and are compared
+    again like new ones.
+    """
+    logger = ProcessingLoggerSingleton().get_logger()
+    # Live rows of the embedding store are already unit-normalized
+    ids, matrix = store.live_matrix()
+    row_of = {id: row for row, id in enumerate(ids)}
+
+    state = _load_state(state_file)
+    uf = UnionFind(state["parent"])
+    clustered = set(state["clustered"])
+    replaced = clustered & row_of.keys() & set(changed)
+
+    # Past ANN_MIN_SIZE, candidates come from the index and are verified exactly
+    use_index = index is not None and len(ids) >= ANN_MIN_SIZE
+    if use_index:
+        index.sync(ids, matrix, changed=replaced)
+
+    if not clustered:
+        # Nothing clustered yet: one pass over the upper triangle
+        for id in ids:
+            uf.add(id)
+        if use_index:
+            pairs = candidate_pairs(
+                matrix,
+                ids,
+                list(range(len(ids))),
+                index,
+                THRESHOLD,
+                nprobe,
+                memory_limit,
+            )
+        else:
+            pairs = similar_pairs(matrix, THRESHOLD, memory_limit)
+        for i, j in pairs:
+            uf.union(ids[i], ids[j])
+        logger.info(f"Clustered {len(ids)} embeddings from scratch.")
+    else:
+        # Removed items may have been the only link inside their group, and
+        # replaced ones may no longer belong to it, so re-cluster the other
+        # members of those groups among themselves.
+        removed = clustered - row_of.keys()
+        if removed or replaced:
+            roots = {uf.find(id) for id in removed | replaced}
+            affected = [id for id in list(uf.parent) if uf.find(id) in roots]
+            uf.discard(affected)
+            clustered -= removed | replaced
+            survivors = sorted(row_of[id] for id in affected if id in clustered)
+            for id in (ids[row] for row in survivors):
+                uf.add(id)
+            for i, j in similar_pairs(
+                np.asarray(matrix[survivors]), THRESHOLD, memory_limit
+            ):
+                uf.union(ids[survivors[i]], ids[survivors[j]])
+
+        # Compare only the new and replaced embeddings against the whole corpus
+        new_rows = [row for row, id in enumerate(ids) if id not in clustered]
+        for id in (ids[row] for row in new_rows):
+            uf.add(id)
+        if use_index:
+            pairs = candidate_pairs(
+                matrix, ids, new_rows, index, THRESHOLD, nprobe, memory_limit
+            )
+        else:
+            pairs = query_pairs(matrix, new_rows, THRESHOLD, memory_limit)
+        for i, j in pairs:
+            uf.union(ids[i], ids[j])
+        logger.info(
+            f"Clustered {len(new_rows)} new or replaced embeddings, "
+            f"re-clustered groups of {len(removed)} removed and "
+            f"{len(replaced)} replaced embeddings."
+        )
+
+    clustered = set(ids)
+    if state_file is not None:
+        _save_state(state_file, uf, clustered)
+
+    # Resolve the stored filename of every embedding id
+    original_names = {
+        key.split(".")[0]: val for key, val in filename_mapping_json.items()
+    }
+
+    # Groups are ordered by their first member, members keep store order
     groups = {}
-    checked = set()
-    for k, _ in clusters.items():
-        if k not in checked:
-            cluster = get_cluster(k)
-            groups[len(groups)] = cluster
-            checked.update(cluster)
-
-    # save images to the .tmp/session folder in their respective groups
+    for id in ids:
+        groups.setdefault(uf.find(id), []).append(id)
+
     similarity_results = []
-    for _, similarImageEmbedIds in groups.items():
+    for group in groups.values():
         imageList = []
-        # Group similar images with real path
-        for embedId in similarImageEmbedIds:
-            id = path.basename(embedId).split(".")[0]
-            org_path = [val for key, val in filename_mapping_json.items() if id in key]
+        for id in group:
             imageList.append(
-                path.join(media_folder, f"{id}.{org_path[0].split('.')[-1]}")
+                path.join(media_folder, f"{id}.{original_names[id].split('.')[-1]}")
             )
 
         similarity_results.append([path.basename(i) for i in imageList])
 
-    with open(output, "w") as f:
+    with open(output + ".tmp", "w") as f:
         dump(similarity_results, f)
-
-
-def _calculate_cosine_delta(target, batch):
-    result = {target: 1.0}
-    target_tensor = tload(target, weights_only=True).unsqueeze(dim=0)
-
-    for k in batch:
-        if k != target:
-            cos_sim = cosine_similarity(
-                target_tensor, tload(k, weights_only=True).unsqueeze(dim=0)
-            )[0].item()
-            if cos_sim >= THRESHOLD:
-                result[k] = cos_sim
-
-    return result
+    replace(output + ".tmp", output)
+
+
+def _load_state(state_file) -> dict:
+    empty = {"threshold": THRESHOLD, "parent": {}, "clustered": []}
+    if state_file is None or not path.isfile(state_file):
+        return empty
+    with open(state_file, "r") as f:
+        state = load(f)
+    # Groups built with another threshold cannot be extended
+    if state.get("threshold") != THRESHOLD:
+        return empty
+    return state
+
+
+def _save_state(state_file, uf: UnionFind, clustered: set):
+    with open(state_file + ".tmp", "w") as f:
+        dump(
+            {
+                "threshold": THRESHOLD,
+                "parent": {id: uf.find(id) for id in clustered},
+                "clustered": sorted(clustered),
+            },
+            f,
+        )
+    replace(state_file + ".tmp", state_file)
+
+
+def similar_pairs(matrix, threshold=THRESHOLD, memory_limit=BLOCK_MEMORY_LIMIT):
+    """Yield (i, j), i < j, for every pair of unit rows with similarity >= threshold.
+
+    The upper triangle of ``matrix @ matrix.T`` is computed one block of rows
+    at a time so that no block exceeds ``memory_limit`` bytes.
+    """
+    if not isinstance(matrix, LiveMatrix):
+        matrix = LiveMatrix(matrix)
+    n = len(matrix)
+    if n < 2:
+        return
+    # Blocks are multiplied with the dead rows too, so size them by the span
+    rows_per_block = max(1, memory_limit // (4 * matrix.span))
+
+    for start in range(0, n, rows_per_block):
+        end = min(start + rows_per_block, n)
+        sims = matrix.similarities(matrix[start:end], start)
+        rows, cols = np.nonzero(sims >= threshold)
+        cols += start
+        rows += start
+        keep = cols > rows
+        yield from zip(rows[keep].tolist(), cols[keep].tolist())
+
+
+def query_pairs(
+    matrix, query_rows, threshold=THRESHOLD, memory_limit=BLOCK_MEMORY_LIMIT
+):
+    """Yield (i, j), i != j, for every query row i with similarity >= threshold to row j."""
+    if not isinstance(matrix, LiveMatrix):
+        matrix = LiveMatrix(matrix)
+    n = len(matrix)
+    if n < 2 or not query_rows:
+        return
+    rows_per_block = max(1, memory_limit // (4 * matrix.span))
+    query_rows = np.asarray(query_rows, dtype=np.int64)
+
+    for start in range(0, len(query_rows), rows_per_block):
+        block = query_rows[start : start + rows_per_block]
+        sims = matrix.similarities(matrix[block])
+        rows, cols = np.nonzero(sims >= threshold)
+        rows = block[rows]
+        keep = cols != rows
+        yield from zip(rows[keep].tolist(), cols[keep].tolist())
@@ -0,0 +1,330 @@
+"""
+ingest.py
+Description: Staged ingestion pipeline used by process_media.
+
+Uploaded files flow through a metadata stage, a preview stage, the batched
+embedding stage and a single commit stage, connected by bounded queues so that
+exiftool, ffmpeg, the model and disk I/O all overlap. The preview stage
+decodes each file once and derives its blurhash, renditions and model input
+from that decoded image. A file whose
+metadata cannot be read or that cannot be embedded is reported to
+``on_failure`` and left in uploads/ without stopping the rest of the import.
+"""
+
+import os
+import queue
+import threading
+import time
+
+from mirage_logger import ProcessingLoggerSingleton
+from tools.embedder import EmbeddingPipeline
+from tools.extract_metadata import ExifToolWorker, get_metadata_batch
+from tools.metrics import FILES, QUEUE_DEPTH, observe_stage
+from tools.preprocess import DECODE_SIZE, blurhash_of, decode, model_input
+
+# Threads per stage and capacity of the queues between them
+METADATA_WORKERS = int(os.getenv("INGEST_METADATA_WORKERS", 4))
+PREVIEW_WORKERS = int(os.getenv("INGEST_PREVIEW_WORKERS", os.cpu_count() or 1))
+QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 64))
+# Files read by one exiftool call
+METADATA_BATCH_SIZE = int(os.getenv("INGEST_METADATA_BATCH_SIZE", 32))
+
+
+class IngestPipeline:
+    def __init__(
+        self,
+        store,
+        original_name,
+        on_commit,
+        on_failure,
+        dates=None,
+        renditions=None,
+        on_progress=None,
+        exiftool_workers: list = None,
+        metadata_workers: int = METADATA_WORKERS,
+        preview_workers: int = PREVIEW_WORKERS,
+        queue_size: int = QUEUE_SIZE,
+    ):
+        """
+        original_name(file) returns the uploaded filename of a stored file.
+        on_commit(records) is called from the commit stage with a batch of
+        finished records and returns those it could not commit, with their
+        "error" set; on_failure(record) is called with every record that
+        failed.
+        dates is the DateInferenceEngine used for files without an EXIF date,
+        renditions the RenditionCache filled by the preview stage.
+        on_progress(record, stage) is called when a record has its metadata
+        ("metadata") and its embedding ("embedded").
+        exiftool_workers are ExifToolWorkers kept by the caller across runs,
+        one per metadata thread; without them each run starts its own.
+        Records are dicts with "file", "name", "metadata" and "error", and
+        "timings", the milliseconds the file spent in each stage.
+        """
+        self.store = store
+        self.original_name = original_name
+        self.on_commit = on_commit
+        self.on_failure = on_failure
+        self.dates = dates
+        self.renditions = renditions
+        self.on_progress = on_progress
+        self.exiftool_workers = exiftool_workers
+        self.metadata_workers = (
+            len(exiftool_workers) if exiftool_workers else metadata_workers
+        )
+        self.preview_workers = preview_workers
+        self._metadata_queue = queue.Queue(maxsize=queue_size)
+        self._preview_queue = queue.Queue(maxsize=queue_size)
+        self._commit_queue = queue.Queue(maxsize=queue_size)
+        self._embedding_slots = threading.BoundedSemaphore(queue_size)
+        self._done = threading.Condition()
+        self._finished = 0
+        self._failed = 0
+        self._stage_ms = {}
+
+    def run(self, files: list) -> dict:
+        """Ingest files and block until every one is committed or failed."""
+        processing = ProcessingLoggerSingleton().get_logger()
+        self._embedder = EmbeddingPipeline(self.store)
+        threads = [
+            threading.Thread(
+                target=self._metadata_worker,
+                args=(self.exiftool_workers[i] if self.exiftool_workers else None,),
+                name=f"ingest-metadata-{i}",
+            )
+            for i in range(self.metadata_workers)
+        ]
+        threads += [
+            threading.Thread(target=self._preview_worker, name=f"ingest-preview-{i}")
+            for i in range(self.preview_workers)
+        ]
+        committer = threading.Thread(target=self._commit_worker, name="ingest-commit")
+        for t in threads + [committer]:
+            t.start()
+        stages = {
+            "ingest_metadata": self._metadata_queue,
+            "ingest_preview": self._preview_queue,
+            "ingest_commit": self._commit_queue,
+        }
+        for name, q in stages.items():
+            QUEUE_DEPTH.track(q.qsize, queue=name)
+
+        for f in files:
+            self._metadata_queue.put(
+                {
+                    "file": f,
+                    "name": os.path.basename(f),
+                    "metadata": None,
+                    "error": None,
+                    "timings": {},
+                    "queued": time.perf_counter(),
+                }
+            )
+
+        with self._done:
+            self._done.wait_for(lambda: self._finished == len(files))
+
+        for _ in range(self.metadata_workers):
+            self._metadata_queue.put(None)
+        for _ in range(self.preview_workers):
+            self._preview_queue.put(None)
+        for t in threads:
+            t.join()
+        self._embedder.close()
+        self._commit_queue.put(None)
+        committer.join()
+        for name in stages:
+            QUEUE_DEPTH.untrack(queue=name)
+
+        processing.info(
+            f"Ingested {len(files) - self._failed} files, {self._failed} failed.",
+            extra={
+                "committed": len(files) - self._failed,
+                "failed": self._failed,
+                **{
+                    f"{stage}_total_ms": round(ms, 1)
+                    for stage, ms in self._stage_ms.items()
+                },
+            },
+        )
+        return {"committed": len(files) - self._failed, "failed": self._failed}
+
+    # Stages
+    def _metadata_worker(self, worker: ExifToolWorker = None):
+        # Every metadata thread uses one long-lived exiftool process
+        owned = worker is None
+        worker = worker or ExifToolWorker()
+        try:
+            stop = False
+            while not stop:
+                batch = [self._metadata_queue.get()]
+                while batch[-1] is not None and len(batch) < METADATA_BATCH_SIZE:
+                    try:
+                        batch.append(self._metadata_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if batch[-1] is None:
+                    stop = True
+                    batch.pop()
+                if batch:
+                    self._read_metadata(batch, worker)
+        finally:
+            if owned:
+                worker.close()
+
+    def _read_metadata(self, batch: list, worker: ExifToolWorker):
+        processing = ProcessingLoggerSingleton().get_logger()
+        files = []
+        for record in list(batch):
+            try:
+                files.append((record["file"], self.original_name(record["file"])))
+            except Exception as e:
+                batch.remove(record)
+                self._fail(record, "metadata", e)
+        start = time.perf_counter()
+        try:
+            results = get_metadata_batch(files, worker, self.dates) if files else []
+        except Exception as e:
+            results = [e] * len(batch)
+        # One exiftool call reads the whole batch
+        elapsed = (time.perf_counter() - start) / max(len(batch), 1)
+        for record, result in zip(batch, results):
+            self._time(record, "metadata", elapsed)
+            if isinstance(result, Exception):
+                self._fail(record, "metadata", result)
+                continue
+            processing.info(f"Read metadata of {record['name']}.")
+            record["metadata"] = result
+            self._progress(record, "metadata")
+            self._preview_queue.put(record)
+
+    def _preview_worker(self):
+        processing = ProcessingLoggerSingleton().get_logger()
+        decode_size = self.renditions.sizes[-1] if self.renditions else DECODE_SIZE
+        while (record := self._preview_queue.get()) is not None:
+            start = time.perf_counter()
+            content_type = record["metadata"]["MIMEType"]
+            try:
+                img = decode(record["file"], content_type, decode_size)
+                observe_stage("decode", time.perf_counter() - start)
+            except Exception as e:
+                # Without a preview the file is still imported; the embedder
+                # reports on its own whether it can read it
+                img = None
+                processing.error(f"Failed to decode {record['name']}: {e}")
+
+            if img is not None:
+                try:
+                    started = time.perf_counter()
+                    record["metadata"]["BlurHash"] = blurhash_of(img)
+                    observe_stage("blurhash", time.perf_counter() - started)
+                except Exception as e:
+                    # A missing blurhash does not block the import
+                    processing.error(
+                        f"Failed to create blurhash for {record['name']}: {e}"
+                    )
+                if self.renditions is not None:
+                    try:
+                        started = time.perf_counter()
+                        self.renditions.generate(record["name"].split(".")[0], img)
+                        observe_stage("renditions", time.perf_counter() - started)
+                    except Exception as e:
+                        # Renditions are regenerated on demand when missing
+                        processing.error(
+                            f"Failed to create renditions for {record['name']}: {e}"
+                        )
+
+            self._time(record, "preview", time.perf_counter() - start)
+
+            # Bound the number of files waiting on the embedding stage
+            self._embedding_slots.acquire()
+            self._embedder.submit(
+                record["file"],
+                content_type,
+                lambda f, ok, record=record, submitted=time.perf_counter(): (
+                    self._embedded(record, ok, submitted)
+                ),
+                # Videos are embedded from their own sampled frames
+                image=(
+                    model_input(img)
+                    if img is not None and content_type.startswith("image/")
+                    else None
+                ),
+            )
+            del img
+
+    def _embedded(self, record: dict, ok: bool, submitted: float):
+        self._embedding_slots.release()
+        self._time(record, "embed", time.perf_counter() - submitted)
+        if not ok:
+            # Left in uploads/ and retried like any other failed file
+            record["error"] = "embedding failed"
+        else:
+            self._progress(record, "embedded")
+        self._commit_queue.put(record)
+
+    def _progress(self, record: dict, stage: str):
+        if self.on_progress is None:
+            return
+        try:
+            self.on_progress(record, stage)
+        except Exception as e:
+            # Progress reporting never fails the file itself
+            ProcessingLoggerSingleton().get_logger().error(
+                f"Failed to report {stage} of {record['name']}: {e}"
+            )
+
+    def _commit_worker(self):
+        stop = False
+        while not stop:
+            records = [self._commit_queue.get()]
+            # Drain whatever else is ready so it is committed together
+            while True:
+                try:
+                    records.append(self._commit_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in records:
+                stop = True
+                records = [r for r in records if r is not None]
+
+            for record in records:
+                record["timings"]["total_ms"] = round(
+                    (time.perf_counter() - record["queued"]) * 1000, 1
+                )
+            failed = [r for r in records if r["error"] is not None]
+            ready = [r for r in records if r["error"] is None]
+            if ready:
+                try:
+                    failed += self.on_commit(ready) or []
+                except Exception as e:
+                    for record in ready:
+                        record["error"] = f"commit: {e}"
+                    failed += ready
+            for record in failed:
+                try:
+                    self.on_failure(record)
+                except Exception as e:
+                    # Still counted as finished, so run() returns
+                    ProcessingLoggerSingleton().get_logger().error(
+                        f"Failed to record the failure of {record['name']}: {e}"
+                    )
+
+            FILES.inc(len(records) - len(failed), result="committed")
+            FILES.inc(len(failed), result="failed")
+            with self._done:
+                self._finished += len(records)
+                self._failed += len(failed)
+                self._done.notify_all()
+
+    def _time(self, record: dict, stage: str, seconds: float):
+        ms = round(seconds * 1000, 1)
+        record["timings"][f"{stage}_ms"] = ms
+        observe_stage(stage, seconds)
+        with self._done:
+            self._stage_ms[stage] = self._stage_ms.get(stage, 0) + ms
+
+    def _fail(self, record: dict, stage: str, error: Exception):
+        processing = ProcessingLoggerSingleton().get_logger()
+        processing.error(f"Failed to ingest {record['name']} at {stage}: {error}")
+        record["error"] = f"{stage}: {error}"
+        self._commit_queue.put(record)
@@ -0,0 +1,290 @@
+"""
+jobs.py
+Description: Durable processing jobs with per-file state, kept in the catalog.
+
+POST /start queues a job instead of starting a thread. A single runner works
+through the queue, holding a lock file so that only one process ever writes
+to the media folder; it is woken directly in a single-process deployment and
+polls the queue when the web workers run in other processes. When a job
+starts, the uploads it covers are recorded as job files, and every file then
+moves through queued -> metadata -> embedded -> committed (or failed). A
+failed file is queued again after an exponential backoff, up to
+JOB_MAX_ATTEMPTS times; while a job only waits for retries, it is deferred
+and the runner moves on to the next job. A file is only ever pending in one
+unfinished job. After a restart, files that were in flight are queued again
+and the interrupted job continues where it stopped. Automatic jobs, queued by
+the uploads watcher, leave out files that already failed for good; a job
+requested through /start retries them.
+"""
+
+import fcntl
+import os
+import time
+
+# Attempts per file before it is marked failed, and the first retry delay in
+# seconds (doubled after every further failure)
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", 30))
+# Seconds between checks for jobs queued by another process (web workers)
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 2))
+
+FILE_STATES = ("queued", "metadata", "embedded", "committed", "failed")
+# Job statuses before "done" or "failed"
+ACTIVE_STATUSES = ("queued", "running", "similar")
+
+
+class ProcessingLock:
+    """Exclusive, process-wide lock held by whoever runs jobs."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    def acquire(self, blocking: bool = True) -> bool:
+        self._file = open(self.path, "w")
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            self._file.close()
+            self._file = None
+            return False
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class JobQueue:
+    def __init__(self, catalog):
+        self.catalog = catalog
+
+    # Jobs
+    def create(self, pull_uploads: bool, automatic: bool = False) -> int:
+        """Queue a job, or return the job that is already waiting to start.
+
+        A queued job lists uploads/ only when it starts, so it also covers
+        everything uploaded until then. At most one job is ever waiting,
+        which is what bounds the work queued by the watcher.
+        """
+        with self.catalog.batch():
+            rows = self.catalog.query(
+                "SELECT id FROM jobs WHERE status = 'queued' AND pull_uploads >= ? "
+                "ORDER BY id LIMIT 1",
+                (pull_uploads,),
+            )
+            if rows:
+                if not automatic:
+                    self.catalog.execute(
+                        "UPDATE jobs SET automatic = 0 WHERE id = ?", (rows[0]["id"],)
+                    )
+                return rows[0]["id"]
+            return self.catalog.execute(
+                "INSERT INTO jobs (pull_uploads, automatic, status, created) "
+                "VALUES (?, ?, 'queued', ?)",
+                (pull_uploads, automatic, time.time()),
+            ).lastrowid
+
+    def create_for(self, names: list):
+        """Queue a job over the given stored filenames, e.g. items of the media
+        folder to import again. Returns the job and the files it covers."""
+        with self.catalog.batch():
+            job_id = self.catalog.execute(
+                "INSERT INTO jobs (pull_uploads, automatic, status, created) "
+                "VALUES (0, 0, 'queued', ?)",
+                (time.time(),),
+            ).lastrowid
+            return job_id, self.start(job_id, names)
+
+    def next_job(self):
+        """Oldest unfinished job that is not deferred, or None."""
+        rows = self.catalog.query(
+            "SELECT * FROM jobs WHERE status IN (?, ?, ?) AND not_before <= ? "
+            "ORDER BY id LIMIT 1",
+            (*ACTIVE_STATUSES, time.time()),
+        )
+        return dict(rows[0]) if rows else None
+
+    def defer(self, job_id: int, until: float):
+        """Leave a job waiting for its retries until ``until``."""
+        self.catalog.execute(
+            "UPDATE jobs SET not_before = ? WHERE id = ?", (until, job_id)
+        )
+
+    def job(self, job_id: int):
+        rows = self.catalog.query("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return dict(rows[0]) if rows else None
+
+    def latest_job(self):
+        rows = self.catalog.query("SELECT * FROM jobs ORDER BY id DESC LIMIT 1")
+        return dict(rows[0]) if rows else None
+
+    def start(self, job_id: int, names: list) -> list:
+        """Record the files of a job and mark it running. Returns the files
+        the job covers, leaving out those still pending in another job."""
+        now = time.time()
+        with self.catalog.batch():
+            skipped = self.pending_names()
+            if self.job(job_id)["automatic"]:
+                skipped |= self.failed_names()
+            names = [name for name in names if name not in skipped]
+            self.catalog.execute_many(
+                "INSERT OR IGNORE INTO job_files (job_id, name, state, updated) "
+                "VALUES (?, ?, 'queued', ?)",
+                [(job_id, name, now) for name in names],
+            )
+            self.catalog.execute(
+                "UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+                (now, job_id),
+            )
+        return names
+
+    def pending_names(self) -> set:
+        """Files not yet committed or failed by an unfinished job."""
+        return {
+            row["name"]
+            for row in self.catalog.query(
+                "SELECT DISTINCT name FROM job_files "
+                "WHERE state NOT IN ('committed', 'failed') AND job_id IN "
+                "(SELECT id FROM jobs WHERE status IN (?, ?, ?))",
+                ACTIVE_STATUSES,
+            )
+        }
+
+    def committed_names(self, job_id: int) -> list:
+        return [
+            row["name"]
+            for row in self.catalog.query(
+                "SELECT name FROM job_files WHERE job_id = ? AND state = 'committed'",
+                (job_id,),
+            )
+        ]
+
+    def failed_names(self) -> set:
+        """Files whose latest job gave up on them."""
+        return {
+            row["name"]
+            for row in self.catalog.query(
+                "SELECT name, state, MAX(job_id) FROM job_files GROUP BY name"
+            )
+            if row["state"] == "failed"
+        }
+
+    def set_status(self, job_id: int, status: str, error: str = None):
+        finished = time.time() if status not in ACTIVE_STATUSES else None
+        self.catalog.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?",
+            (status, error, finished, job_id),
+        )
+
+    def recover(self) -> int:
+        """Queue again every file that was in flight when the server stopped."""
+        return self.catalog.execute(
+            "UPDATE job_files SET state = 'queued', next_attempt = 0 "
+            "WHERE state IN ('metadata', 'embedded') AND job_id IN "
+            "(SELECT id FROM jobs WHERE status IN (?, ?, ?))",
+            ACTIVE_STATUSES,
+        ).rowcount
+
+    # Files
+    def due_files(self, job_id: int):
+        """Queued files ready to run now, and when the next retry is due
+        (None when nothing else is queued)."""
+        now = time.time()
+        rows = self.catalog.query(
+            "SELECT name, next_attempt FROM job_files "
+            "WHERE job_id = ? AND state = 'queued'",
+            (job_id,),
+        )
+        ready = [row["name"] for row in rows if row["next_attempt"] <= now]
+        waiting = [row["next_attempt"] for row in rows if row["next_attempt"] > now]
+        return ready, min(waiting) if waiting else None
+
+    def set_state(self, job_id: int, names: list, state: str):
+        now = time.time()
+        with self.catalog.batch():
+            self.catalog.execute_many(
+                "UPDATE job_files SET state = ?, updated = ? "
+                "WHERE job_id = ? AND name = ?",
+                [(state, now, job_id, name) for name in names],
+            )
+
+    def fail(self, job_id: int, name: str, error: str) -> bool:
+        """Record a failed attempt. Returns True when the file will be retried."""
+        now = time.time()
+        with self.catalog.batch():
+            rows = self.catalog.query(
+                "SELECT attempts FROM job_files WHERE job_id = ? AND name = ?",
+                (job_id, name),
+            )
+            attempts = (rows[0]["attempts"] if rows else 0) + 1
+            retry = attempts < JOB_MAX_ATTEMPTS
+            self.catalog.execute(
+                "UPDATE job_files SET state = ?, attempts = ?, next_attempt = ?, "
+                "error = ?, updated = ? WHERE job_id = ? AND name = ?",
+                (
+                    "queued" if retry else "failed",
+                    attempts,
+                    now + JOB_RETRY_DELAY * 2 ** (attempts - 1) if retry else 0,
+                    error,
+                    now,
+                    job_id,
+                    name,
+                ),
+            )
+        return retry
+
+    # Reporting
+    def depths(self) -> dict:
+        """Jobs waiting to start, and files of unfinished jobs waiting in
+        each state before "committed"."""
+        depths = {f"files_{state}": 0 for state in FILE_STATES[:3]}
+        depths["jobs"] = self.catalog.query(
+            "SELECT COUNT(*) AS n FROM jobs WHERE status = 'queued'"
+        )[0]["n"]
+        for row in self.catalog.query(
+            "SELECT state, COUNT(*) AS n FROM job_files WHERE job_id IN "
+            "(SELECT id FROM jobs WHERE status IN (?, ?, ?)) GROUP BY state",
+            ACTIVE_STATUSES,
+        ):
+            if f"files_{row['state']}" in depths:
+                depths[f"files_{row['state']}"] = row["n"]
+        return depths
+
+    def status(self, job_id: int = None):
+        """Per-state file counts and throughput of a job (default: latest)."""
+        job = self.job(job_id) if job_id is not None else self.latest_job()
+        if job is None:
+            return None
+        counts = dict.fromkeys(FILE_STATES, 0)
+        for row in self.catalog.query(
+            "SELECT state, COUNT(*) AS n FROM job_files WHERE job_id = ? "
+            "GROUP BY state",
+            (job["id"],),
+        ):
+            counts[row["state"]] = row["n"]
+        retrying = self.catalog.query(
+            "SELECT COUNT(*) AS n FROM job_files "
+            "WHERE job_id = ? AND state = 'queued' AND attempts > 0",
+            (job["id"],),
+        )[0]["n"]
+        total = sum(counts.values())
+        elapsed = (
+            (job["finished"] or time.time()) - job["started"] if job["started"] else 0
+        )
+        return {
+            "id": job["id"],
+            "status": job["status"],
+            "error": job["error"],
+            "files": total,
+            "states": counts,
+            "retrying": retrying,
+            "elapsed": round(elapsed, 1),
+            "files_per_second": (
+                round(counts["committed"] / elapsed, 2) if elapsed else 0
+            ),
+            "progress": (
+                (counts["committed"] + counts["failed"]) / total if total else 1
+            ),
+        }
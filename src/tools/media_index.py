@@ -0,0 +1,111 @@
+"""
+media_index.py
+Description: In-memory media id -> stored file index used by every id-based route.
+
+The index is built once at startup from a single listing of the media folder,
+reconciled against the catalog, and then kept current by ingestion and trash
+operations, so a lookup never touches the filesystem. Changes made by other
+processes (web workers, the processor) are picked up by refresh(), which
+costs one indexed query when nothing changed.
+"""
+
+import os
+import threading
+from collections import namedtuple
+
+from mirage_logger import HostingLoggerSingleton
+
+MediaEntry = namedtuple(
+    "MediaEntry", ["name", "extension", "mimetype", "original_name", "trashed"]
+)
+
+
+class MediaIndex:
+    def __init__(self, folder: str, catalog):
+        self.folder = folder
+        self.catalog = catalog
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._seq = 0
+
+    def build(self):
+        """Index every file of the media folder that the catalog knows about."""
+        hosting = HostingLoggerSingleton().get_logger()
+        # Read first, so a change made while building is refreshed later
+        seq = self.catalog.latest_seq()
+        rows = {row["name"]: row for row in self.catalog.entries()}
+        entries = {}
+        unknown = 0
+        for name in os.listdir(self.folder):
+            row = rows.get(name)
+            if row is None or row["mimetype"] is None:
+                unknown += 1
+                continue
+            entries[name[:32]] = self._entry(row)
+        missing = len(rows) - len(entries)
+
+        with self._lock:
+            self._entries = entries
+            self._seq = seq
+        hosting.info(
+            f"Indexed {len(entries)} media files "
+            f"({unknown} files not in the catalog, {missing} catalog rows without a file)."
+        )
+
+    def refresh(self) -> int:
+        """Apply catalog changes made since the last build or refresh.
+        Returns the number of entries updated."""
+        seq = self.catalog.latest_seq()
+        if seq == self._seq:
+            return 0
+        with self._lock:
+            rows = [
+                row
+                for row in self.catalog.entries(since=self._seq)
+                if row["mimetype"] is not None
+            ]
+            for row in rows:
+                self._entries[row["name"][:32]] = self._entry(row)
+            self._seq = max(seq, self._seq)
+        return len(rows)
+
+    def _entry(self, row) -> MediaEntry:
+        return MediaEntry(
+            name=row["name"],
+            extension=os.path.splitext(row["name"])[1].lstrip("."),
+            mimetype=row["mimetype"],
+            original_name=row["original_name"],
+            trashed=row["trash_expiry"] is not None,
+        )
+
+    def __contains__(self, uid: str) -> bool:
+        return uid in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, uid: str):
+        return self._entries.get(uid)
+
+    def path(self, entry: MediaEntry) -> str:
+        return os.path.join(self.folder, entry.name)
+
+    def add(self, name: str, mimetype: str, original_name: str, trashed=False):
+        with self._lock:
+            self._entries[name[:32]] = MediaEntry(
+                name=name,
+                extension=os.path.splitext(name)[1].lstrip("."),
+                mimetype=mimetype,
+                original_name=original_name,
+                trashed=trashed,
+            )
+
+    def set_trashed(self, uid: str, trashed: bool):
+        with self._lock:
+            entry = self._entries.get(uid)
+            if entry is not None:
+                self._entries[uid] = entry._replace(trashed=trashed)
+
+    def discard(self, uid: str):
+        with self._lock:
+            self._entries.pop(uid, None)
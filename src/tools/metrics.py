@@ -0,0 +1,400 @@
+"""
+metrics.py
+Description: Lightweight counters, gauges and histograms served in the
+Prometheus text format by /metrics.
+
+Updating a metric is a dict update under a lock; nothing is formatted or
+written until /metrics is scraped. With several processes (web workers and
+the processor, see MIRAGE_ROLE) each one writes its metrics to a snapshot
+file in a shared folder every METRICS_INTERVAL seconds, and only when they
+changed. The worker answering a scrape merges its own metrics with the
+others' snapshots: counters and histograms are summed, and a gauge series
+comes from the first process reporting it, the answering one first. When a
+process is gone (a restarted worker), its counters and histograms are folded
+into a retired snapshot before its file is removed, so the merged totals
+never go down.
+"""
+
+import bisect
+import fcntl
+import json
+import os
+import resource
+import socket
+import threading
+import time
+import uuid
+
+# Seconds between snapshots written for the other processes
+METRICS_INTERVAL = float(os.getenv("METRICS_INTERVAL", 15))
+
+# Upper bounds in seconds, from a fast request to a long import stage
+BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    300,
+    1800,
+)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._functions = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def track(self, function, **labels):
+        """Read the series from ``function()`` whenever metrics are collected."""
+        with self._lock:
+            self._functions[self._key(labels)] = function
+
+    def untrack(self, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._functions.pop(key, None)
+            self._values.pop(key, None)
+
+    def samples(self) -> list:
+        """[(label values, value)] of every series."""
+        with self._lock:
+            functions = list(self._functions.items())
+        for key, function in functions:
+            try:
+                value = function()
+            except Exception:
+                continue
+            with self._lock:
+                self._values[key] = value
+        with self._lock:
+            return [
+                (key, list(value) if isinstance(value, list) else value)
+                for key, value in self._values.items()
+            ]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        global _changed
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        _changed = True
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        """Record one observation. A series is a list of per-bucket counts
+        (the last one for +Inf), then the sum."""
+        global _changed
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = [0] * (len(self.buckets) + 2)
+            series[index] += 1
+            series[-1] += value
+        _changed = True
+
+
+REGISTRY = []
+# Set by every counter or histogram update, cleared by each snapshot
+_changed = True
+
+HTTP_REQUESTS = Counter(
+    "mirage_http_requests_total",
+    "HTTP requests handled.",
+    ("endpoint", "method", "status"),
+)
+HTTP_SECONDS = Histogram(
+    "mirage_http_request_duration_seconds",
+    "Time to handle an HTTP request.",
+    ("endpoint", "method"),
+)
+STAGE_SECONDS = Histogram(
+    "mirage_stage_duration_seconds",
+    "Time spent in a processing stage, per file or per call.",
+    ("stage",),
+)
+FILES = Counter(
+    "mirage_files_total",
+    "Files finished by imports.",
+    ("result",),
+)
+UPLOADS = Counter(
+    "mirage_uploads_total",
+    "Uploads received.",
+    ("result",),
+)
+CACHE_REQUESTS = Counter(
+    "mirage_cache_requests_total",
+    "Rendition and display image lookups.",
+    ("cache", "result"),
+)
+DATE_INFERENCE = Counter(
+    "mirage_date_inference_total",
+    "Dates inferred from filenames, per tier that answered.",
+    ("tier",),
+)
+QUEUE_DEPTH = Gauge(
+    "mirage_queue_depth",
+    "Items waiting in a queue.",
+    ("queue",),
+)
+RESIDENT_MEMORY = Gauge(
+    "process_resident_memory_bytes",
+    "Resident memory of the process.",
+    ("process",),
+)
+CPU_SECONDS = Counter(
+    "process_cpu_seconds_total",
+    "User and system CPU time of the process.",
+    ("process",),
+)
+
+
+def observe_stage(stage: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+# Name of this process in gauges and snapshot files
+PROCESS = f"{socket.gethostname()}-{os.getpid()}"
+# Unique even when a restarted process reuses the pid of a gone one
+SNAPSHOT = f"{PROCESS}-{uuid.uuid4().hex[:8]}.json"
+# Folded totals of the processes that are gone
+RETIRED = "retired.json"
+
+
+def _resident_memory() -> int:
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Peak instead of current resident memory, in KiB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return round(usage.ru_utime + usage.ru_stime, 3)
+
+
+RESIDENT_MEMORY.track(_resident_memory, process=PROCESS)
+CPU_SECONDS.track(_cpu_seconds, process=PROCESS)
+
+
+def collect() -> dict:
+    """Every metric of this process as a JSON-serializable dict."""
+    return {
+        metric.name: [
+            [dict(zip(metric.labels, key)), value] for key, value in metric.samples()
+        ]
+        for metric in REGISTRY
+    }
+
+
+# Snapshots
+def write_snapshot(folder: str):
+    global _changed
+    _changed = False
+    path = os.path.join(folder, SNAPSHOT)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump({"time": time.time(), "metrics": collect()}, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def start_snapshots(folder: str, interval: float = METRICS_INTERVAL):
+    """Write this process's snapshot every ``interval`` seconds when it
+    changed, for whichever process answers the next scrape."""
+    os.makedirs(folder, exist_ok=True)
+
+    def run():
+        last = 0
+        while True:
+            time.sleep(interval)
+            # Resource gauges change all the time; refresh them once a minute
+            if _changed or time.monotonic() - last > 60:
+                last = time.monotonic()
+                try:
+                    write_snapshot(folder)
+                except OSError:
+                    pass
+
+    threading.Thread(target=run, name="metrics-snapshots", daemon=True).start()
+
+
+def _retire(folder: str, path: str):
+    # Add the counters and histograms of a gone process to the retired
+    # snapshot, then remove its file. Series of one process (its CPU time)
+    # simply end with it.
+    with open(os.path.join(folder, ".retired.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            with open(path, "r") as f:
+                metrics = json.load(f)["metrics"]
+        except FileNotFoundError:
+            # Retired by another worker while this one waited
+            return
+        except (OSError, ValueError, KeyError):
+            metrics = {}
+        retired_path = os.path.join(folder, RETIRED)
+        try:
+            with open(retired_path, "r") as f:
+                retired = json.load(f)["metrics"]
+        except (OSError, ValueError, KeyError):
+            retired = {}
+        for metric in REGISTRY:
+            if metric.type == "gauge" or "process" in metric.labels:
+                continue
+            samples = _merge(metric, [retired, metrics])
+            if samples:
+                retired[metric.name] = [[labels, value] for labels, value in samples]
+        with open(f"{retired_path}.tmp", "w") as f:
+            json.dump({"time": time.time(), "metrics": retired}, f)
+        os.replace(f"{retired_path}.tmp", retired_path)
+        os.remove(path)
+
+
+def _read_snapshots(folder: str, interval: float) -> list:
+    # Snapshots of the other live processes and the retired totals; a
+    # process that stopped writing for a few intervals is gone
+    snapshots = []
+    if not folder or not os.path.isdir(folder):
+        return snapshots
+    names = [
+        name
+        for name in os.listdir(folder)
+        if name.endswith(".json") and name != SNAPSHOT
+    ]
+    # Fold the gone ones first, so their counts are in the totals read below
+    now = time.time()
+    for name in names:
+        path = os.path.join(folder, name)
+        try:
+            if name != RETIRED and now - os.path.getmtime(path) > max(
+                interval * 8, 120
+            ):
+                _retire(folder, path)
+        except OSError:
+            continue
+    # Shared lock: no file moves into the retired totals while they are read
+    with open(os.path.join(folder, ".retired.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        for name in dict.fromkeys(names + [RETIRED]):
+            try:
+                with open(os.path.join(folder, name), "r") as f:
+                    snapshots.append(json.load(f)["metrics"])
+            except (OSError, ValueError, KeyError):
+                continue
+    return snapshots
+
+
+# Exposition
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels: dict, extra: dict = None) -> str:
+    labels = {**labels, **(extra or {})}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items()) + "}"
+
+
+def _merge(metric: _Metric, sources: list) -> list:
+    """[(labels, value)] of one metric across processes."""
+    merged = {}
+    for samples in sources:
+        for labels, value in samples.get(metric.name, []):
+            key = tuple(sorted(labels.items()))
+            if key not in merged:
+                merged[key] = value
+            elif metric.type == "gauge":
+                # This process's own value comes first and is the freshest
+                continue
+            elif metric.type == "counter":
+                merged[key] += value
+            else:
+                merged[key] = [a + b for a, b in zip(merged[key], value)]
+    return [(dict(key), value) for key, value in merged.items()]
+
+
+def render(folder: str = None, interval: float = METRICS_INTERVAL) -> str:
+    """Metrics of this process and of the snapshots in ``folder``, in the
+    Prometheus text exposition format."""
+    sources = [collect()] + _read_snapshots(folder, interval)
+    lines = []
+    for metric in REGISTRY:
+        samples = _merge(metric, sources)
+        if not samples:
+            continue
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for labels, value in sorted(samples, key=lambda s: sorted(s[0].items())):
+            if metric.type != "histogram":
+                lines.append(f"{metric.name}{_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + ("+Inf",), value[:-1]):
+                cumulative += count
+                lines.append(
+                    f"{metric.name}_bucket{_labels(labels, {'le': bound})} "
+                    f"{cumulative}"
+                )
+            lines.append(f"{metric.name}_sum{_labels(labels)} {value[-1]}")
+            lines.append(f"{metric.name}_count{_labels(labels)} {cumulative}")
+
+    # Hit ratios derived from the merged cache counters
+    ratios = {}
+    for labels, value in _merge(CACHE_REQUESTS, sources):
+        counts = ratios.setdefault(labels["cache"], {"hit": 0, "total": 0})
+        counts["total"] += value
+        counts["hit"] += value if labels["result"] != "miss" else 0
+    if ratios:
+        lines.append(
+            "# HELP mirage_cache_hit_ratio "
+            "Share of cache lookups answered without rendering."
+        )
+        lines.append("# TYPE mirage_cache_hit_ratio gauge")
+        for cache, counts in sorted(ratios.items()):
+            lines.append(
+                f"mirage_cache_hit_ratio{_labels({'cache': cache})} "
+                f"{round(counts['hit'] / counts['total'], 4)}"
+            )
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,77 @@
+"""
+preprocess.py
+Description: Decode-once preprocessing of uploaded media for ingestion.
+
+Every image is decoded a single time, at reduced size where the format allows
+it (JPEG DCT scaling through draft mode, reducing resampling otherwise), and
+oriented with its EXIF tag. The blurhash input, the preview renditions and
+the embedding model input are all derived from that one oriented image.
+Videos get the same treatment for the single frame used by the blurhash and
+the renditions.
+"""
+
+import io
+
+import blurhash
+import ffmpeg
+from PIL import Image, ImageOps
+
+# Longest side of the decoded image when no rendition size asks for more
+DECODE_SIZE = 1600
+# Shorter side of the model input, before the model's own resize and crop
+MODEL_SIZE = 256
+# Longest side of the blurhash input; a blurhash only keeps a few components
+BLURHASH_SIZE = 64
+
+
+def decode_image(file: str, max_size: int = DECODE_SIZE) -> Image.Image:
+    """Decode an image once, scaled to fit ``max_size`` and EXIF-oriented."""
+    with Image.open(file) as img:
+        # JPEG decodes straight at 1/2, 1/4 or 1/8 scale
+        img.draft("RGB", (max_size, max_size))
+        if img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        # Reduces by an integer factor first, then resamples what is left
+        img.thumbnail((max_size, max_size))
+        img = ImageOps.exif_transpose(img)
+    return img if img.mode == "RGB" else img.convert("RGB")
+
+
+def decode_video_frame(file: str, max_size: int = DECODE_SIZE) -> Image.Image:
+    """Decode the preview frame of a video, scaled to fit ``max_size``."""
+    try:
+        out, _ = (
+            ffmpeg.input(file, ss=0.1)
+            .output("pipe:", vframes=1, format="image2", vcodec="png")
+            .run(capture_stdout=True, capture_stderr=True)
+        )
+    except ffmpeg.Error as e:
+        raise RuntimeError(e.stderr.decode(errors="replace")) from e
+    with Image.open(io.BytesIO(out)) as img:
+        img = img.convert("RGB")
+    img.thumbnail((max_size, max_size))
+    return img
+
+
+def decode(file: str, mimetype: str, max_size: int = DECODE_SIZE) -> Image.Image:
+    if mimetype.startswith("image/"):
+        return decode_image(file, max_size)
+    elif mimetype.startswith("video/"):
+        return decode_video_frame(file, max_size)
+    raise ValueError(f"Unsupported content type: {mimetype}")
+
+
+def blurhash_of(img: Image.Image) -> str:
+    small = img.copy()
+    small.thumbnail((BLURHASH_SIZE, BLURHASH_SIZE))
+    return blurhash.encode(small, x_components=4, y_components=3)
+
+
+def model_input(img: Image.Image) -> Image.Image:
+    """Copy of ``img`` just large enough for the embedding model."""
+    scale = MODEL_SIZE / min(img.size)
+    if scale >= 1:
+        return img.copy()
+    return img.resize(
+        (round(img.width * scale), round(img.height * scale)), Image.Resampling.BILINEAR
+    )
@@ -0,0 +1,361 @@
+"""
+renditions.py
+Description: Cache of downscaled renditions (thumbnails and previews) of media.
+
+Renditions are created once at ingest time, one file per size in
+<folder>/<size>/<id>.<ext>, and regenerated lazily when a request finds one
+missing. Changing RENDITION_SIZES or RENDITION_FORMAT only needs a purge
+followed by a rebuild.
+
+Full-screen display images are served from a separate DisplayCache: one
+image per (id, size, format), with the size rounded up to a DISPLAY_STEP
+bucket and the format negotiated from the Accept header. It keeps recently
+served images in memory and every rendered image on disk, both bounded in
+bytes and evicted least recently used first.
+"""
+
+import io
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+from argparse import ArgumentParser
+from collections import OrderedDict
+
+from PIL import Image, ImageOps
+
+from mirage_logger import ProcessingLoggerSingleton
+from tools.metrics import CACHE_REQUESTS
+from tools.preprocess import decode, decode_image
+
+# Longest side, in pixels, of every rendition
+RENDITION_SIZES = tuple(
+    int(size) for size in os.getenv("RENDITION_SIZES", "256,640,1600").split(",")
+)
+RENDITION_FORMAT = os.getenv("RENDITION_FORMAT", "JPEG").upper()
+RENDITION_QUALITY = int(os.getenv("RENDITION_QUALITY", 85))
+# Rendition served for ?thumbnail=true
+THUMBNAIL_SIZE = 640
+
+# Display images: bucket width in pixels, and byte budgets of both tiers
+DISPLAY_STEP = 320
+DISPLAY_MEMORY_CACHE = int(os.getenv("DISPLAY_MEMORY_CACHE_MB", 64)) * 1024 * 1024
+DISPLAY_DISK_CACHE = int(os.getenv("DISPLAY_DISK_CACHE_MB", 2048)) * 1024 * 1024
+
+_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp", "AVIF": "avif"}
+MIMETYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "AVIF": "image/avif"}
+
+
+def negotiate_format(accepted) -> str:
+    """Best display format listed explicitly in an Accept header.
+
+    ``accepted`` is the list of accepted MIME types. Wildcards are ignored so
+    that clients which never asked for WebP or AVIF keep receiving JPEG.
+    """
+    Image.init()
+    for format in ("AVIF", "WEBP"):
+        if MIMETYPES[format] in accepted and format in Image.SAVE:
+            return format
+    return "JPEG"
+
+
+def _temporary(path: str):
+    """New file next to ``path`` to be renamed over it, unique to the caller
+    even when several threads or workers render the same image."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    return os.fdopen(fd, "wb"), tmp
+
+
+def _forget_idle(locks: dict):
+    # Drop the per-image locks nobody holds; a held one still guards a render
+    for key in [key for key, lock in locks.items() if not lock.locked()]:
+        del locks[key]
+
+
+class RenditionCache:
+    def __init__(
+        self,
+        folder: str,
+        sizes: tuple = RENDITION_SIZES,
+        format: str = RENDITION_FORMAT,
+    ):
+        self.folder = folder
+        self.sizes = tuple(sorted(sizes))
+        self.format = format
+        self.mimetype = MIMETYPES[format]
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        for size in self.sizes:
+            os.makedirs(os.path.join(folder, str(size)), exist_ok=True)
+
+    def path(self, uid: str, size: int) -> str:
+        return os.path.join(self.folder, str(size), f"{uid}.{_EXTENSIONS[self.format]}")
+
+    def size_for(self, requested: int) -> int:
+        """Smallest rendition at least as large as ``requested``."""
+        for size in self.sizes:
+            if size >= requested:
+                return size
+        return self.sizes[-1]
+
+    def get(self, uid: str, size: int, file: str, mimetype: str) -> str:
+        """Path of a rendition, regenerating every size of ``uid`` on a miss."""
+        path = self.path(uid, size)
+        if os.path.isfile(path):
+            CACHE_REQUESTS.inc(cache="renditions", result="hit")
+            return path
+        with self._lock_for(uid):
+            if not os.path.isfile(path):
+                CACHE_REQUESTS.inc(cache="renditions", result="miss")
+                ProcessingLoggerSingleton().get_logger().info(
+                    f"Rendition cache miss for {uid} at {size}px, regenerating."
+                )
+                self.generate_from_file(uid, file, mimetype)
+            else:
+                CACHE_REQUESTS.inc(cache="renditions", result="hit")
+        return path
+
+    def generate_from_file(self, uid: str, file: str, mimetype: str):
+        self.generate(uid, decode(file, mimetype, self.sizes[-1]))
+
+    def generate(self, uid: str, img: Image.Image):
+        """Write every size of ``uid`` from a decoded, oriented image, largest
+        first."""
+        # A copy: thumbnail() below works in place
+        img = img.convert("RGB")
+        for size in reversed(self.sizes):
+            # Each size is derived from the previous, already smaller one
+            img.thumbnail((size, size))
+            path = self.path(uid, size)
+            # Another thread or worker may be rendering it too
+            f, tmp = _temporary(path)
+            with f:
+                img.save(f, format=self.format, quality=RENDITION_QUALITY)
+            os.replace(tmp, path)
+
+    def remove(self, uid: str):
+        for size in self.sizes:
+            try:
+                os.remove(self.path(uid, size))
+            except FileNotFoundError:
+                pass
+
+    def purge(self):
+        """Delete every rendition, including sizes no longer configured."""
+        shutil.rmtree(self.folder, ignore_errors=True)
+        for size in self.sizes:
+            os.makedirs(os.path.join(self.folder, str(size)), exist_ok=True)
+
+    def rebuild(self, items) -> int:
+        """Regenerate renditions for (uid, file, mimetype) items. Returns failures."""
+        processing = ProcessingLoggerSingleton().get_logger()
+        failed = 0
+        for uid, file, mimetype in items:
+            try:
+                self.generate_from_file(uid, file, mimetype)
+            except Exception as e:
+                failed += 1
+                processing.error(f"Failed to rebuild renditions for {uid}: {e}")
+        return failed
+
+    def _lock_for(self, uid: str) -> threading.Lock:
+        with self._locks_lock:
+            if len(self._locks) > 1024:
+                _forget_idle(self._locks)
+            return self._locks.setdefault(uid, threading.Lock())
+
+
+class DisplayCache:
+    def __init__(
+        self,
+        folder: str,
+        renditions: RenditionCache,
+        memory_limit: int = DISPLAY_MEMORY_CACHE,
+        disk_limit: int = DISPLAY_DISK_CACHE,
+    ):
+        self.folder = folder
+        self.renditions = renditions
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk = OrderedDict()
+        self._disk_bytes = 0
+        self._hits = {"memory": 0, "disk": 0, "miss": 0}
+        self._render_locks = {}
+        self._written = 0
+        os.makedirs(folder, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        # Rebuild the disk tier's LRU order from the last access times. Other
+        # web workers share the folder, so it is scanned again after a while
+        # to account for the files they wrote.
+        files = []
+        now = time.time()
+        for entry in os.scandir(self.folder):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith(".tmp"):
+                    # Left by a crash, unless another worker is writing it
+                    if now - stat.st_mtime > 60:
+                        os.remove(entry.path)
+                    continue
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+        disk = OrderedDict((name, size) for _, name, size in sorted(files))
+        with self._lock:
+            self._disk = disk
+            self._disk_bytes = sum(disk.values())
+            self._written = 0
+
+    def size_for(self, requested: int) -> int:
+        """Bucket of a requested longest side, 0 for full resolution."""
+        if requested <= 0:
+            return 0
+        return math.ceil(requested / DISPLAY_STEP) * DISPLAY_STEP
+
+    def get(self, uid: str, size: int, format: str, file: str, mimetype: str):
+        """Encoded display image of ``uid``, rendered on a miss."""
+        name = f"{uid}_{size}.{_EXTENSIONS[format]}"
+        with self._lock:
+            data = self._memory.get(name)
+            if data is not None:
+                self._memory.move_to_end(name)
+                self._hits["memory"] += 1
+                CACHE_REQUESTS.inc(cache="display", result="memory")
+                return data
+
+        with self._lock_for(name):
+            path = os.path.join(self.folder, name)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)
+                tier = "disk"
+            except FileNotFoundError:
+                data = self._render(uid, size, format, file, mimetype)
+                f, tmp = _temporary(path)
+                with f:
+                    f.write(data)
+                os.replace(tmp, path)
+                tier = "miss"
+
+        if self._written > self.disk_limit // 16:
+            self._scan()
+        CACHE_REQUESTS.inc(cache="display", result=tier)
+        with self._lock:
+            self._hits[tier] += 1
+            if tier == "miss":
+                self._written += len(data)
+            if name not in self._disk:
+                self._disk_bytes += len(data)
+            self._disk[name] = len(data)
+            self._disk.move_to_end(name)
+            self._remember(name, data)
+            evicted = self._evict_disk()
+        for old in evicted:
+            try:
+                os.remove(os.path.join(self.folder, old))
+            except FileNotFoundError:
+                pass
+        return data
+
+    def _render(self, uid: str, size: int, format: str, file: str, mimetype: str):
+        source = file
+        if size and size <= self.renditions.sizes[-1]:
+            # The largest ingest-time rendition is enough and far cheaper to decode
+            source = self.renditions.get(uid, self.renditions.sizes[-1], file, mimetype)
+        if size:
+            img = decode_image(source, size)
+        else:
+            with Image.open(source) as img:
+                img = ImageOps.exif_transpose(img).convert("RGB")
+        out = io.BytesIO()
+        img.save(out, format=format, quality=RENDITION_QUALITY)
+        return out.getvalue()
+
+    def _remember(self, name: str, data: bytes):
+        # Huge full-resolution images would flush everything else out
+        if len(data) > self.memory_limit // 8:
+            return
+        if name not in self._memory:
+            self._memory_bytes += len(data)
+        self._memory[name] = data
+        self._memory.move_to_end(name)
+        while self._memory_bytes > self.memory_limit:
+            _, old = self._memory.popitem(last=False)
+            self._memory_bytes -= len(old)
+
+    def _evict_disk(self) -> list:
+        evicted = []
+        while self._disk_bytes > self.disk_limit and len(self._disk) > 1:
+            name, size = self._disk.popitem(last=False)
+            self._disk_bytes -= size
+            self._memory_bytes -= len(self._memory.pop(name, b""))
+            evicted.append(name)
+        return evicted
+
+    def remove(self, uid: str):
+        with self._lock:
+            names = [name for name in self._disk if name.startswith(f"{uid}_")]
+            for name in names:
+                self._disk_bytes -= self._disk.pop(name)
+                self._memory_bytes -= len(self._memory.pop(name, b""))
+        for name in names:
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = sum(self._hits.values())
+            return {
+                "memory_hits": self._hits["memory"],
+                "disk_hits": self._hits["disk"],
+                "misses": self._hits["miss"],
+                "hit_ratio": (
+                    round(1 - self._hits["miss"] / requests, 3) if requests else 0
+                ),
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_entries": len(self._disk),
+                "disk_bytes": self._disk_bytes,
+            }
+
+    def _lock_for(self, name: str) -> threading.Lock:
+        with self._lock:
+            if len(self._render_locks) > 1024:
+                _forget_idle(self._render_locks)
+            return self._render_locks.setdefault(name, threading.Lock())
+
+
+if __name__ == "__main__":
+    from tools.catalog import Catalog
+
+    parser = ArgumentParser(prog="renditions")
+    parser.add_argument(dest="drive", help="DRIVE location, e.g. /mirage/DRIVE")
+    parser.add_argument(dest="command", choices=["purge", "rebuild"])
+    args = parser.parse_args()
+
+    cache = RenditionCache(os.path.join(args.drive, "media", "renditions"))
+    if args.command == "purge":
+        cache.purge()
+        print("Purged rendition cache.")
+    else:
+        catalog = Catalog(os.path.join(args.drive, "media", "catalog.db"))
+        items = [
+            (
+                item["name"][:32],
+                os.path.join(args.drive, "media", "media", item["name"]),
+                item["metadata"]["MIMEType"],
+            )
+            for item in catalog.items() + catalog.items(trashed=True)
+        ]
+        failed = cache.rebuild(items)
+        print(f"Rebuilt renditions for {len(items) - failed} items, {failed} failed.")
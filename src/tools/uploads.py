@@ -0,0 +1,271 @@
+"""
+uploads.py
+Description: Streaming upload support for the /upload route.
+
+Werkzeug's multipart parser writes every uploaded file part, chunk by chunk,
+into the stream returned by ``Request._get_file_stream``. UploadRequest
+returns a HashingFile there, so the body goes straight to a temporary file
+next to uploads/ while its SHA-256 and size are computed, without the file
+ever being held in memory. The finished file is then renamed into uploads/.
+
+Large files can instead be sent through a resumable, tus-style protocol
+backed by UploadSessions: a session is created with the total length, chunks
+are appended with PATCH at the offset the server reports, and the upload is
+finalized once every byte has arrived. Sessions live in uploads/.sessions
+and are garbage-collected when abandoned.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+import uuid
+from argparse import ArgumentParser
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Largest accepted upload in bytes, 0 for no limit
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 0))
+# What to do with an upload whose content is already in the library:
+# "link" answers with the existing item, "reject" answers 409
+DUPLICATE_UPLOADS = os.getenv("DUPLICATE_UPLOADS", "link").lower()
+# Hours after its last chunk before an unfinished resumable upload is removed
+SESSION_EXPIRY = float(os.getenv("UPLOAD_SESSION_EXPIRY", 24))
+PARTIAL_FOLDER = ".partial"
+SESSIONS_FOLDER = ".sessions"
+CHUNK_SIZE = 1024 * 1024
+
+
+class SessionError(Exception):
+    """A resumable upload request that does not match the session state."""
+
+    def __init__(self, message: str, status: int):
+        super().__init__(message)
+        self.status = status
+
+
+class HashingFile:
+    """Temporary file that hashes and counts everything written to it."""
+
+    def __init__(self, folder: str, max_size: int = MAX_UPLOAD_SIZE):
+        fd, self.path = tempfile.mkstemp(dir=folder, suffix=".part")
+        self._file = os.fdopen(fd, "w+b")
+        self._hash = hashlib.sha256()
+        self.max_size = max_size
+        self.size = 0
+        self.committed = False
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            self.discard()
+            raise RequestEntityTooLarge(
+                f"Uploads are limited to {self.max_size} bytes."
+            )
+        self._hash.update(data)
+        return self._file.write(data)
+
+    def hexdigest(self) -> str:
+        return self._hash.hexdigest()
+
+    def commit(self, destination: str):
+        """Flush the file to disk and atomically move it to ``destination``."""
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
+        os.replace(self.path, destination)
+        self.committed = True
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __getattr__(self, name):
+        # read, seek, tell, ... of the underlying file
+        return getattr(self._file, name)
+
+
+class UploadRequest(Request):
+    """Request whose uploaded files are streamed into HashingFiles.
+
+    Every file part gets one, including parts the route never looks at and
+    a part cut off by a dropped connection; whichever were not committed
+    are removed when the request is closed.
+    """
+
+    partial_folder = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._hashing_files = []
+
+    def _get_file_stream(
+        self, total_content_length, content_type, filename=None, content_length=None
+    ):
+        stream = HashingFile(self.partial_folder)
+        self._hashing_files.append(stream)
+        return stream
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for stream in self._hashing_files:
+                if not stream.committed:
+                    stream.discard()
+            self._hashing_files = []
+
+
+class UploadSessions:
+    """Resumable uploads, one <id>.json (name, length) and <id>.part each."""
+
+    def __init__(self, folder: str, max_size: int = MAX_UPLOAD_SIZE):
+        self.folder = folder
+        self.max_size = max_size
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, session_id: str, ext: str) -> str:
+        if len(session_id) != 32 or not session_id.isalnum():
+            raise SessionError("Invalid upload session", 404)
+        return os.path.join(self.folder, f"{session_id}.{ext}")
+
+    def create(self, original_name: str, length: int) -> str:
+        if length < 0:
+            raise SessionError("Invalid Upload-Length", 400)
+        if self.max_size and length > self.max_size:
+            raise SessionError(f"Uploads are limited to {self.max_size} bytes.", 413)
+        session_id = uuid.uuid4().hex
+        open(self._path(session_id, "part"), "wb").close()
+        with open(self._path(session_id, "json"), "w") as f:
+            json.dump({"original_name": original_name, "length": length}, f)
+        return session_id
+
+    def info(self, session_id: str) -> dict:
+        """Original name, total length and current offset of a session."""
+        try:
+            with open(self._path(session_id, "json"), "r") as f:
+                info = json.load(f)
+            info["offset"] = os.path.getsize(self._path(session_id, "part"))
+        except FileNotFoundError:
+            raise SessionError("Upload session not found", 404)
+        return info
+
+    def append(self, session_id: str, offset: int, stream) -> int:
+        """Append ``stream`` at ``offset`` and return the new offset.
+
+        Whatever was received is kept when the connection drops, so the
+        client resumes from the offset reported afterwards.
+        """
+        info = self.info(session_id)
+        with open(self._path(session_id, "part"), "ab") as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise SessionError("Upload session is busy", 423)
+            current = f.seek(0, os.SEEK_END)
+            if offset != current:
+                raise SessionError(f"Upload-Offset must be {current}", 409)
+            try:
+                while chunk := stream.read(CHUNK_SIZE):
+                    if current + len(chunk) > info["length"]:
+                        raise SessionError("Upload exceeds Upload-Length", 413)
+                    f.write(chunk)
+                    current += len(chunk)
+            finally:
+                f.flush()
+                os.fsync(f.fileno())
+        return current
+
+    def digest(self, session_id: str):
+        """SHA-256 and size of a complete upload."""
+        info = self.info(session_id)
+        if info["offset"] != info["length"]:
+            raise SessionError("Upload is not complete", 409)
+        return file_sha256(self._path(session_id, "part")), info["length"]
+
+    def finish(self, session_id: str, destination: str):
+        """Move a complete upload to ``destination`` and close the session."""
+        os.replace(self._path(session_id, "part"), destination)
+        os.remove(self._path(session_id, "json"))
+
+    def remove(self, session_id: str):
+        for ext in ("part", "json"):
+            try:
+                os.remove(self._path(session_id, ext))
+            except FileNotFoundError:
+                pass
+
+    def collect(self, max_age: float = SESSION_EXPIRY) -> int:
+        """Remove sessions without a chunk for ``max_age`` hours."""
+        cutoff = time.time() - max_age * 3600
+        last_write = {}
+        for name in os.listdir(self.folder):
+            session_id = os.path.splitext(name)[0]
+            try:
+                mtime = os.path.getmtime(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                continue
+            last_write[session_id] = max(mtime, last_write.get(session_id, 0))
+        expired = [s for s, mtime in last_write.items() if mtime < cutoff]
+        for session_id in expired:
+            for name in (f"{session_id}.part", f"{session_id}.json"):
+                try:
+                    os.remove(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    pass
+        return len(expired)
+
+
+def file_sha256(path: str, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def clear_partial(folder: str, max_age: float = 0) -> int:
+    """Remove temporary files left behind by interrupted uploads, keeping
+    those written to in the last ``max_age`` seconds (uploads still being
+    received by another worker)."""
+    removed = 0
+    cutoff = time.time() - max_age
+    for name in os.listdir(folder):
+        path = os.path.join(folder, name)
+        try:
+            if os.path.getmtime(path) <= cutoff:
+                os.remove(path)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+if __name__ == "__main__":
+    from tools.catalog import Catalog
+
+    parser = ArgumentParser(prog="uploads")
+    parser.add_argument(dest="drive", help="DRIVE location, e.g. /mirage/DRIVE")
+    parser.add_argument(dest="command", choices=["backfill"])
+    args = parser.parse_args()
+
+    # Hash items uploaded before hashes were recorded, so they are deduplicated
+    catalog = Catalog(os.path.join(args.drive, "media", "catalog.db"))
+    hashed = 0
+    for name in catalog.missing_hashes():
+        for folder in (
+            os.path.join(args.drive, "media", "media"),
+            os.path.join(args.drive, "uploads"),
+        ):
+            path = os.path.join(folder, name)
+            if os.path.isfile(path):
+                catalog.set_hash(name, file_sha256(path), os.path.getsize(path))
+                hashed += 1
+                break
+    print(f"Hashed {hashed} items.")
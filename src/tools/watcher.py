@@ -0,0 +1,167 @@
+"""
+watcher.py
+Description: Watches the uploads folder and triggers imports automatically.
+
+New files are noticed through inotify (called through ctypes, no extra
+dependency) or, where inotify is unavailable such as on some network or
+Docker Desktop mounts, by polling the folder. Arrivals are grouped into
+micro-batches: the batch is handed to ``on_batch`` once WATCH_BATCH_SIZE
+files have arrived or WATCH_BATCH_WINDOW seconds after the first one, so a
+burst of uploads becomes one import rather than one per file.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+from mirage_logger import ProcessingLoggerSingleton
+
+# auto (inotify when available), inotify or poll
+WATCH_MODE = os.getenv("WATCH_MODE", "auto").lower()
+WATCH_BATCH_SIZE = int(os.getenv("WATCH_BATCH_SIZE", 64))
+WATCH_BATCH_WINDOW = float(os.getenv("WATCH_BATCH_WINDOW", 2))
+WATCH_POLL_INTERVAL = float(os.getenv("WATCH_POLL_INTERVAL", 5))
+
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_Q_OVERFLOW = 0x00004000
+_IN_ISDIR = 0x40000000
+_EVENT = struct.Struct("iIII")
+
+
+class _Inotify:
+    def __init__(self, folder: str):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(
+            self.fd, os.fsencode(folder), _IN_CLOSE_WRITE | _IN_MOVED_TO
+        )
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {folder}")
+
+    def read(self, timeout: float):
+        """Names of files finished within ``timeout`` seconds, or None when
+        events were lost and the folder must be rescanned."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                return None
+            if not mask & _IN_ISDIR:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class UploadWatcher:
+    def __init__(
+        self,
+        folder: str,
+        on_batch,
+        batch_size: int = WATCH_BATCH_SIZE,
+        batch_window: float = WATCH_BATCH_WINDOW,
+        mode: str = WATCH_MODE,
+    ):
+        """on_batch(names) is called from the watcher thread with every new
+        micro-batch of upload filenames."""
+        self.folder = folder
+        self.on_batch = on_batch
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        self.mode = mode
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run, name="upload-watcher", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _scan(self) -> set:
+        return {
+            entry.name
+            for entry in os.scandir(self.folder)
+            if entry.is_file() and not entry.name.startswith(".")
+        }
+
+    def _run(self):
+        processing = ProcessingLoggerSingleton().get_logger()
+        inotify = None
+        if self.mode != "poll":
+            try:
+                inotify = _Inotify(self.folder)
+            except (OSError, AttributeError) as e:
+                if self.mode == "inotify":
+                    raise
+                processing.warning(f"inotify unavailable ({e}), polling uploads.")
+        processing.info(
+            f"Watching {self.folder} with {'inotify' if inotify else 'polling'}."
+        )
+
+        # Files already waiting are the first batch
+        seen = self._scan()
+        pending = set(seen)
+        first_arrival = time.monotonic() if pending else None
+        try:
+            while not self._stop.is_set():
+                if first_arrival is not None:
+                    timeout = max(
+                        first_arrival + self.batch_window - time.monotonic(), 0
+                    )
+                else:
+                    timeout = WATCH_POLL_INTERVAL
+
+                if inotify is not None:
+                    names = inotify.read(min(timeout, WATCH_POLL_INTERVAL))
+                    if names is None:
+                        names = self._scan()
+                    names = {n for n in names if not n.startswith(".")}
+                else:
+                    self._stop.wait(min(timeout, WATCH_POLL_INTERVAL))
+                    current = self._scan()
+                    names = current - seen
+                    seen = current
+
+                if names - pending:
+                    pending |= names
+                    first_arrival = first_arrival or time.monotonic()
+
+                if pending and (
+                    len(pending) >= self.batch_size
+                    or time.monotonic() - first_arrival >= self.batch_window
+                ):
+                    batch, pending, first_arrival = sorted(pending), set(), None
+                    try:
+                        self.on_batch(batch)
+                    except Exception as e:
+                        processing.error(f"Failed to queue uploaded files: {e}")
+        finally:
+            if inotify is not None:
+                inotify.close()
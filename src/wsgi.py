@@ -8,23 +8,40 @@ and handles authentication. It also includes functionality for processing media
 generating thumbnails, and managing metadata. The application is designed to run in a Docker container.
 """
 
+import base64
 import io
 import json
 import os
 import shutil
+import subprocess
+import sys
 import threading
 import uuid
 import requests as r
 import time
-from mirage_logger import HostingLoggerSingleton, ProcessingLoggerSingleton
+from mirage_logger import (
+    HostingLoggerSingleton,
+    ProcessingLoggerSingleton,
+    request_id,
+    timed,
+)
+from tools.catalog import Catalog, decode_cursor, encode_cursor
+from tools.uploads import (
+    DUPLICATE_UPLOADS,
+    MAX_UPLOAD_SIZE,
+    PARTIAL_FOLDER,
+    SESSIONS_FOLDER,
+    SessionError,
+    UploadRequest,
+    UploadSessions,
+    clear_partial,
+)
 from datetime import datetime, timedelta
-import blurhash
 import ffmpeg
 from dotenv import load_dotenv
-from flask import Flask, abort, jsonify, request, url_for
+from flask import Flask, Response, abort, g, jsonify, request, send_file, url_for
 from flask_cors import CORS
 from flask_httpauth import HTTPBasicAuth
-from PIL import Image
 from pillow_heif import register_heif_opener
 from werkzeug.security import check_password_hash, generate_password_hash
 from werkzeug.utils import secure_filename
@@ -33,7 +50,6 @@ from werkzeug.utils import secure_filename
 load_dotenv()
 
 # Configure logging
-os.makedirs("/mirage/logs", exist_ok=True)
 hosting = HostingLoggerSingleton().get_logger()
 processing = ProcessingLoggerSingleton().get_logger()
 
@@ -42,13 +58,9 @@ register_heif_opener()
 
 # Initialize Flask app
 app = Flask(__name__)
+app.request_class = UploadRequest
 CORS(app)
 
-# Status for processing
-pending = 1
-total = 1
-processing_similar_bool = False
-
 # Authentication setup
 auth = HTTPBasicAuth()
 users = {os.getenv("USERNAME"): generate_password_hash(os.getenv("PASSWORD"))}
@@ -63,9 +75,35 @@ def verify_password(username, password):
 
 
 app.config["DRIVE_LOCATION"] = "/mirage/DRIVE"
+# Deployment role: "all" serves requests and runs imports in one process
+# (flask run). Several web workers (e.g. gunicorn) run as "web" next to one
+# "processor" (python processor.py), the only process that loads the
+# embedding model and writes imports to the media folder.
+MIRAGE_ROLE = os.getenv("MIRAGE_ROLE", "all").lower()
+PROCESSES = MIRAGE_ROLE in ("all", "processor")
+# Let a fronting web server (e.g. nginx) send downloads with X-Sendfile
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "false").lower() == "true"
 os.makedirs(os.path.join(app.config["DRIVE_LOCATION"], "uploads"), exist_ok=True)
 os.makedirs(os.path.join(app.config["DRIVE_LOCATION"], "media", "media"), exist_ok=True)
 
+# Uploads are streamed into uploads/.partial and renamed into uploads/
+UploadRequest.partial_folder = os.path.join(
+    app.config["DRIVE_LOCATION"], "uploads", PARTIAL_FOLDER
+)
+os.makedirs(UploadRequest.partial_folder, exist_ok=True)
+# Other workers may be receiving uploads while this one starts
+if removed := clear_partial(
+    UploadRequest.partial_folder, max_age=0 if MIRAGE_ROLE == "all" else 3600
+):
+    hosting.info(f"Removed {removed} partial uploads from an earlier run.")
+
+# Resumable uploads keep their data in uploads/.sessions until finished
+upload_sessions = UploadSessions(
+    os.path.join(app.config["DRIVE_LOCATION"], "uploads", SESSIONS_FOLDER)
+)
+if removed := upload_sessions.collect():
+    hosting.info(f"Removed {removed} abandoned upload sessions.")
+
 # Encryption setup
 # if not os.path.isfile("./key.pem"):
 #     key = Fernet.generate_key()
@@ -76,90 +114,172 @@ os.makedirs(os.path.join(app.config["DRIVE_LOCATION"], "media", "media"), exist_
 #         key = f.read()
 # cipher_suite = Fernet(key)
 
-# JSON file path for storing filename mappings and metadata
-MAPPING_FILE = os.path.join(
-    app.config["DRIVE_LOCATION"], "media", "filename_mapping.json"
+# Catalog of filename mappings, metadata and trash
+catalog = Catalog(os.path.join(app.config["DRIVE_LOCATION"], "media", "catalog.db"))
+catalog.import_json(
+    mapping_file=os.path.join(
+        app.config["DRIVE_LOCATION"], "media", "filename_mapping.json"
+    ),
+    metadata_file=os.path.join(app.config["DRIVE_LOCATION"], "media", "metadata.json"),
+    trash_file=os.path.join(app.config["DRIVE_LOCATION"], "media", "trash.json"),
 )
-if not os.path.isfile(MAPPING_FILE):
-    with open(MAPPING_FILE, "w") as f:
-        json.dump({}, f)
-    processing.info("Created new filename_mapping.json file.")
-METADATA_FILE = os.path.join(app.config["DRIVE_LOCATION"], "media", "metadata.json")
-if not os.path.isfile(METADATA_FILE):
-    with open(METADATA_FILE, "w") as f:
-        json.dump({}, f)
-    processing.info("Created new metadata.json file.")
-TRASH_FILE = os.path.join(app.config["DRIVE_LOCATION"], "media", "trash.json")
-if not os.path.isfile(TRASH_FILE):
-    with open(TRASH_FILE, "w") as f:
-        json.dump({}, f)
-    processing.info("Created new trash.json file.")
-
-
-# Save mappings to the JSON file
-def save_dictionary(json_file, dictionary):
-    with open(json_file, "w") as f:
-        json.dump(dictionary, f)
-
-
-# Initialize the dictionaries
-with open(MAPPING_FILE, "r") as f:
-    filename_mapping = json.load(f)
-processing.info("Loaded filename mappings from JSON file.")
-with open(METADATA_FILE, "r") as f:
-    metadata = json.load(f)
-processing.info("Loaded metadata from JSON file.")
-with open(TRASH_FILE, "r") as f:
-    trash = json.load(f)
-processing.info("Loaded trash from JSON file.")
-
-# Wait for the Ollama server to be ready
-while True:
-    try:
-        res = r.get("http://ollama:11434")
-        if res.status_code == 200:
-            processing.info("Ollama server is ready.")
-            break
-    except r.exceptions.ConnectionError:
-        pass
-    processing.info("Waiting for Ollama server to start... (15s)")
-    time.sleep(15)
-
-# Build model
-processing.info("Building mirage-date-extractor model...")
-res = r.post(
-    f"http://ollama:11434/api/create",
-    json={
-        "name": "mirage-date-extractor",
-        "from": "gemma2:2b",
-        "system": 'Given a file name, extract the date in the format of "YYYY:MM:DD". Only return the date and no other information or data. If the date cannot be extracted, return "null".',
-    },
+processing.info("Opened media catalog.")
+
+# Prepare the date extraction model for imports
+if PROCESSES:
+    # Wait for the Ollama server to be ready
+    while True:
+        try:
+            res = r.get("http://ollama:11434")
+            if res.status_code == 200:
+                processing.info("Ollama server is ready.")
+                break
+        except r.exceptions.ConnectionError:
+            pass
+        processing.info("Waiting for Ollama server to start... (15s)")
+        time.sleep(15)
+
+    # Build model
+    processing.info("Building mirage-date-extractor model...")
+    res = r.post(
+        f"http://ollama:11434/api/create",
+        json={
+            "name": "mirage-date-extractor",
+            "from": "gemma2:2b",
+            "system": 'Given a file name, extract the date in the format of "YYYY:MM:DD". Only return the date and no other information or data. If the date cannot be extracted, return "null".',
+        },
+    )
+    if res.ok:
+        processing.info("Model built")
+    else:
+        print(f"Failed to create model: {res.status_code}")
+        print(res.text)
+
+    # Clean up
+    processing.info("Cleaning up...")
+    r.delete(
+        f"http://ollama:11434/api/delete",
+        json={"model": "gemma2:2b"},
+    )
+
+# Import serving tools
+from tools.renditions import (
+    MIMETYPES,
+    THUMBNAIL_SIZE,
+    DisplayCache,
+    RenditionCache,
+    negotiate_format,
+)
+from tools.media_index import MediaIndex
+from tools.jobs import ACTIVE_STATUSES, JOB_POLL_INTERVAL, JobQueue, ProcessingLock
+from tools.watcher import UploadWatcher
+from tools import metrics
+
+if PROCESSES:
+    # Import processing tools; only this process loads the embedding model
+    from tools.embedder import *
+    from tools.extract_metadata import *
+    from tools.find_similar import *
+    from tools.ingest import METADATA_WORKERS, IngestPipeline
+    from tools.date_inference import DateInferenceEngine
+    from tools.embedding_store import EmbeddingStore
+    from tools.ann_index import IVFIndex
+
+    # Open the embedding store, importing any legacy per-file .pt embeddings
+    embedding_store = EmbeddingStore(
+        os.path.join(app.config["DRIVE_LOCATION"], "media", "embedding_store")
+    )
+    embedding_store.migrate_from_pt(
+        os.path.join(app.config["DRIVE_LOCATION"], "media", "embeddings")
+    )
+    embedding_store.sync_deleted(name[:32] for name in catalog.trash())
+    processing.info(f"Loaded embedding store with {len(embedding_store)} embeddings.")
+    ann_index = IVFIndex(embedding_store.folder)
+    # exiftool processes kept across imports, one per metadata thread
+    exiftool_workers = [ExifToolWorker() for _ in range(METADATA_WORKERS)]
+
+# Thumbnails and previews generated at ingest time
+renditions = RenditionCache(
+    os.path.join(app.config["DRIVE_LOCATION"], "media", "renditions")
+)
+# Full-screen images sized and encoded for the viewer
+display_cache = DisplayCache(
+    os.path.join(app.config["DRIVE_LOCATION"], "media", "display_cache"), renditions
 )
-if res.ok:
-    processing.info("Model built")
-else:
-    print(f"Failed to create model: {res.status_code}")
-    print(res.text)
-
-# Clean up
-processing.info("Cleaning up...")
-r.delete(
-    f"http://ollama:11434/api/delete",
-    json={"model": "gemma2:2b"},
+
+# Media id -> stored file lookup for the id-based routes
+media_index = MediaIndex(
+    os.path.join(app.config["DRIVE_LOCATION"], "media", "media"), catalog
 )
+media_index.build()
+
+# Processing jobs, run one at a time by the job runner
+job_queue = JobQueue(catalog)
+job_wakeup = threading.Event()
 
-# Import processing tools
-from tools.embedder import *
-from tools.extract_metadata import *
-from tools.find_similar import *
+# Least seconds between two backup snapshots taken after imports
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", 3600))
 
-processing.info("READY")
+# Default number of items per /list page
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", 200))
+
+# Processes share their metrics through snapshots, merged by /metrics
+METRICS_FOLDER = os.path.join(app.config["DRIVE_LOCATION"], "media", ".metrics")
+if MIRAGE_ROLE != "all":
+    metrics.start_snapshots(METRICS_FOLDER)
+
+processing.info(f"READY ({MIRAGE_ROLE})")
+
+
+# Tag every record logged for a request with its id (X-Request-ID when the
+# client or proxy sends one) and time the request
+@app.before_request
+def start_request():
+    g.request_start = time.perf_counter()
+    g.request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex[:16]
+    g.request_id_token = request_id.set(g.request_id)
+
+
+# One structured record per request with its status and duration
+@app.after_request
+def finish_request(response):
+    seconds = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or "unmatched"
+    metrics.HTTP_SECONDS.observe(seconds, endpoint=endpoint, method=request.method)
+    metrics.HTTP_REQUESTS.inc(
+        endpoint=endpoint, method=request.method, status=response.status_code
+    )
+    elapsed = round(seconds * 1000, 1)
+    hosting.info(
+        f"{request.method} {request.path} {response.status_code} {elapsed} ms",
+        extra={
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint,
+            "status": response.status_code,
+            "elapsed_ms": elapsed,
+        },
+    )
+    response.headers["X-Request-ID"] = g.request_id
+    return response
+
+
+@app.teardown_request
+def end_request(exc):
+    if "request_id_token" in g:
+        request_id.reset(g.request_id_token)
+
+
+# Pick up media imported or trashed by other processes
+@app.before_request
+def refresh_media_index():
+    media_index.refresh()
 
 
 # Route to check if the server is running
 @app.route("/")
 def index():
-    processing.info("Health check - Server is running.")
+    processing.debug("Health check - Server is running.")
     return {"status": "Server is running!"}, 200
 
 
@@ -167,103 +287,255 @@ def index():
 @app.route("/upload", methods=["POST"])
 @auth.login_required
 def upload_file():
+    # Refuse oversized uploads before reading the body
+    if MAX_UPLOAD_SIZE and (request.content_length or 0) > MAX_UPLOAD_SIZE + 64 * 1024:
+        hosting.warning(f"Upload of {request.content_length} bytes refused.")
+        return abort(413)
     if "file" not in request.files:
         hosting.warning("No file part in the request.")
         return "No file part", 400
     file = request.files["file"]
     if file.filename == "":
+        file.stream.discard()
         hosting.warning("No file selected for upload.")
         return "No selected file", 400
     if file:
-        original_filename = secure_filename(file.filename)
-        uid = uuid.uuid4().hex
-        unique_filename = f'{uid}.{original_filename.split(".")[-1]}'
-        # encrypted_data = cipher_suite.encrypt(file.read())
-        file_path = os.path.join(
-            app.config["DRIVE_LOCATION"], "uploads", unique_filename
+        # The body was already streamed to disk and hashed while parsing
+        return save_upload(
+            file.filename,
+            file.stream.hexdigest(),
+            file.stream.size,
+            commit=file.stream.commit,
+            discard=file.stream.discard,
         )
 
-        # Save the file
-        with open(file_path, "wb") as f:
-            f.write(file.read())
-        hosting.info(
-            f"File {original_filename} uploaded and saved as {unique_filename}."
-        )
 
-        # Update the mapping and save it to the JSON file
-        filename_mapping[unique_filename] = original_filename
-        save_dictionary(MAPPING_FILE, filename_mapping)
-        processing.info(f"Filename mapping for {unique_filename} saved.")
-
-        return {
-            "status": "Resource uploaded",
-            "url": url_for("download_file", unique_id=uid, _external=True),
-        }, 201
-
-
-# Function to process media files
-def process_media(pull_uploads: bool):
-    global pending, total, processing_similar_bool
-    processing.info("STARTED PROCESSING MEDIA")
-    processing.info(f"Pull uploads: {pull_uploads}")
-
-    if pull_uploads:
-        files = [
-            os.path.join(app.config["DRIVE_LOCATION"], "uploads", f)
-            for f in os.listdir(os.path.join(app.config["DRIVE_LOCATION"], "uploads"))
-        ]
-        pending = 0
-        total = len(files)
-        processing.info(f"Found {total} files to process.")
-
-        for f in files:
-            current_file_in_process = os.path.basename(f)
-            processing.info(f"Processing file {current_file_in_process}.")
-            # Create metadata
-            metadata[os.path.basename(f)] = get_metadata(
-                id_file_path=f,
-                org_filename=filename_mapping[os.path.basename(f)],
+# Record a received upload in the catalog and store it in uploads/.
+# commit(path) moves the received file to path, discard() drops it.
+def save_upload(filename, sha256, size, commit, discard):
+    original_filename = secure_filename(filename)
+    uid = uuid.uuid4().hex
+    unique_filename = f'{uid}.{original_filename.split(".")[-1]}'
+    # encrypted_data = cipher_suite.encrypt(file.read())
+    file_path = os.path.join(app.config["DRIVE_LOCATION"], "uploads", unique_filename)
+
+    # Identical content is never stored or processed twice. The row comes
+    # first, so the uploads watcher never finds a file the catalog lacks.
+    existing = catalog.add_upload(
+        unique_filename, original_filename, hash=sha256, size=size
+    )
+    if existing is not None:
+        discard()
+        metrics.UPLOADS.inc(result="duplicate")
+        hosting.info(f"Upload of {filename} is a duplicate of {existing}.")
+        response = {
+            "status": "Resource already exists",
+            "url": url_for("download_file", unique_id=existing[:32], _external=True),
+        }
+        return response, 409 if DUPLICATE_UPLOADS == "reject" else 200
+    processing.info(f"Filename mapping for {unique_filename} saved.")
+
+    try:
+        commit(file_path)
+    except Exception:
+        catalog.remove(unique_filename)
+        raise
+    metrics.UPLOADS.inc(result="created")
+    hosting.info(
+        f"File {original_filename} uploaded and saved as {unique_filename} "
+        f"({size} bytes, sha256 {sha256})."
+    )
+
+    return {
+        "status": "Resource uploaded",
+        "url": url_for("download_file", unique_id=uid, _external=True),
+    }, 201
+
+
+# Route to start a resumable upload. Upload-Length holds the size in bytes,
+# Upload-Metadata "filename <base64 name>" the original filename.
+@app.route("/uploads", methods=["POST"])
+@auth.login_required
+def create_upload_session():
+    metadata = dict(
+        item.strip().split(" ", 1)
+        for item in request.headers.get("Upload-Metadata", "").split(",")
+        if " " in item.strip()
+    )
+    try:
+        filename = base64.b64decode(metadata.get("filename", "")).decode()
+        length = int(request.headers["Upload-Length"])
+    except (KeyError, ValueError):
+        return {"status": "Upload-Length and a filename are required"}, 400
+    if not filename:
+        return {"status": "Upload-Length and a filename are required"}, 400
+
+    upload_sessions.collect()
+    try:
+        session_id = upload_sessions.create(filename, length)
+    except SessionError as e:
+        return {"status": str(e)}, e.status
+    hosting.info(
+        f"Upload session {session_id} created for {filename} ({length} bytes)."
+    )
+    return (
+        {"status": "Upload session created"},
+        201,
+        {
+            "Location": url_for(
+                "upload_session", session_id=session_id, _external=True
+            ),
+            "Tus-Resumable": "1.0.0",
+        },
+    )
+
+
+# Route to query (HEAD), continue (PATCH) or cancel (DELETE) a resumable upload
+@app.route("/uploads/<session_id>", methods=["HEAD", "PATCH", "DELETE"])
+@auth.login_required
+def upload_session(session_id):
+    try:
+        if request.method == "DELETE":
+            upload_sessions.remove(session_id)
+            hosting.info(f"Upload session {session_id} cancelled.")
+            return "", 204
+        info = upload_sessions.info(session_id)
+        if request.method == "HEAD":
+            return (
+                "",
+                200,
+                {
+                    "Upload-Offset": str(info["offset"]),
+                    "Upload-Length": str(info["length"]),
+                    "Cache-Control": "no-store",
+                    "Tus-Resumable": "1.0.0",
+                },
             )
 
-            content_type = metadata[os.path.basename(f)]["MIMEType"]
-            if content_type.startswith("image/"):
-                metadata[os.path.basename(f)]["BlurHash"] = blurhash.encode(
-                    f, x_components=4, y_components=3
-                )
-            elif content_type.startswith("video/"):
+        if request.mimetype != "application/offset+octet-stream":
+            return {"status": "Unsupported Content-Type"}, 415
+        try:
+            offset = int(request.headers["Upload-Offset"])
+        except (KeyError, ValueError):
+            return {"status": "Upload-Offset is required"}, 400
+        offset = upload_sessions.append(session_id, offset, request.stream)
+        if offset < info["length"]:
+            return "", 204, {"Upload-Offset": str(offset), "Tus-Resumable": "1.0.0"}
+
+        # Every byte arrived: finalize into uploads/ like a regular upload
+        hosting.info(f"Upload session {session_id} complete.")
+        sha256, size = upload_sessions.digest(session_id)
+        response, status = save_upload(
+            info["original_name"],
+            sha256,
+            size,
+            commit=lambda path: upload_sessions.finish(session_id, path),
+            discard=lambda: upload_sessions.remove(session_id),
+        )
+        return response, status, {"Upload-Offset": str(offset)}
+    except SessionError as e:
+        hosting.warning(f"Upload session {session_id}: {e}")
+        return {"status": str(e)}, e.status
+
+
+# Route to check whether content is already in the library
+@app.route("/hash/<sha256>", methods=["GET"])
+@auth.login_required
+def find_hash(sha256):
+    sha256 = sha256.lower()
+    if len(sha256) != 64 or any(c not in "0123456789abcdef" for c in sha256):
+        return {"status": "Invalid SHA-256"}, 400
+    existing = catalog.find_hash(sha256)
+    if existing is None:
+        return {"status": "Resource not found"}, 404
+    return {
+        "id": existing[:32],
+        "url": url_for("download_file", unique_id=existing[:32], _external=True),
+    }, 200
+
+
+# Run queued jobs one after the other, forever. Only the process holding the
+# processing lock writes to the media folder.
+def run_jobs():
+    lock = ProcessingLock(
+        os.path.join(app.config["DRIVE_LOCATION"], "media", ".processing.lock")
+    )
+    if not lock.acquire(blocking=False):
+        processing.info("Another process is running jobs, waiting for its lock.")
+        lock.acquire()
+    processing.info("Job runner started.")
+    if recovered := job_queue.recover():
+        processing.info(f"Queued {recovered} files again that were interrupted.")
+    backup, backup_started, backup_pending = None, float("-inf"), False
+    while True:
+        job = job_queue.next_job()
+        if job is None:
+            # Drop superseded embedding rows while nothing reads the store;
+            # a running backup may still be copying its files
+            if embedding_store.needs_compaction() and (
+                backup is None or backup.poll() is not None
+            ):
                 try:
-                    out, _ = (
-                        ffmpeg.input(f, ss=0.1)
-                        .output("pipe:", vframes=1, format="image2", vcodec="png")
-                        .run(capture_stdout=True, capture_stderr=True)
-                    )
-                    with Image.open(io.BytesIO(out)) as img:
-                        img.thumbnail((640, 640))
-                        rgb_v = img.convert("RGB")
-                        metadata[os.path.basename(f)]["BlurHash"] = blurhash.encode(
-                            rgb_v, x_components=4, y_components=3
-                        )
-                except ffmpeg.Error as e:
-                    print(e)
+                    with timed(processing, "compact"):
+                        embedding_store.compact(keep_deleted=True)
                 except Exception as e:
-                    print(e)
-            else:
-                print(f"Unsupported content type: {content_type}")
-            save_dictionary(METADATA_FILE, metadata)
-            # Create embedding
-            create_embedding(
-                file=f,
-                embedding_folder=os.path.join(
-                    app.config["DRIVE_LOCATION"], "media", "embeddings"
-                ),
-                mimetype=metadata[os.path.basename(f)]["MIMEType"],
-            )
-            # Move file to media folder
-            shutil.move(f, os.path.join(app.config["DRIVE_LOCATION"], "media", "media"))
-            pending += 1
+                    processing.error(f"Failed to compact the embedding store: {e}")
+            # Back up the 'media' folder once the queue is idle, so a stream
+            # of small automatic imports is covered by one snapshot
+            if (
+                backup_pending
+                and time.monotonic() - backup_started >= BACKUP_INTERVAL
+                and (backup is None or backup.poll() is not None)
+            ):
+                backup, backup_started = start_backup(), time.monotonic()
+                backup_pending = False
+            # Jobs queued by web workers in other processes are found by polling
+            job_wakeup.wait(JOB_POLL_INTERVAL)
+            job_wakeup.clear()
+            continue
+        try:
+            with timed(processing, "job", job=job["id"]):
+                finished = process_media(job)
+            if finished:
+                job_queue.set_status(job["id"], "done")
+                backup_pending = True
+        except Exception as e:
+            processing.error(f"Job {job['id']} failed: {e}")
+            job_queue.set_status(job["id"], "failed", str(e))
+
+
+# Function to process media files. Returns False when the job was deferred
+# until its failed files are due for a retry.
+def process_media(job: dict) -> bool:
+    job_id = job["id"]
+    processing.info(f"STARTED PROCESSING MEDIA (job {job_id})")
+    processing.info(f"Pull uploads: {bool(job['pull_uploads'])}")
+
+    if job["status"] == "queued":
+        names = []
+        if job["pull_uploads"]:
+            names = [
+                f
+                for f in os.listdir(
+                    os.path.join(app.config["DRIVE_LOCATION"], "uploads")
+                )
+                if not f.startswith(".")
+            ]
+        names = job_queue.start(job_id, names)
+        processing.info(f"Found {len(names)} files to process.")
+    else:
+        processing.info(f"Resuming job {job_id}.")
+
+    if job["status"] != "similar":
+        with timed(processing, "ingest", job=job_id):
+            retry_at = ingest(job_id)
+        if retry_at is not None:
+            # Other jobs run while this one waits for its retries
+            job_queue.defer(job_id, retry_at)
             processing.info(
-                f"File {current_file_in_process} processed and moved to media folder."
+                f"Job {job_id} waits {round(retry_at - time.time())} s for retries."
             )
+            return False
 
     # Unload mirage-date-extractor model
     processing.info(f"Unload mirage-date-extractor model")
@@ -272,29 +544,138 @@ def process_media(pull_uploads: bool):
         json={"model": "mirage-date-extractor", "keep_alive": 0},
     )
 
-    processing_similar_bool = True
-    pending = 99
-    total = 100
+    job_queue.set_status(job_id, "similar")
     processing.info("Finding similar photos and videos.")
-    find_similar(
-        vector_folder=os.path.join(app.config["DRIVE_LOCATION"], "media", "embeddings"),
-        filename_mapping_json=filename_mapping,
-        media_folder=os.path.join(app.config["DRIVE_LOCATION"], "media", "media"),
-        output=os.path.join(app.config["DRIVE_LOCATION"], "media", "similar.json"),
-    )
+    # Trashed items are left out of the similarity search
+    embedding_store.sync_deleted(name[:32] for name in catalog.trash())
+    embedding_store.flush()
+    with timed(processing, "similar", job=job_id):
+        find_similar(
+            store=embedding_store,
+            filename_mapping_json=catalog.mapping(),
+            media_folder=os.path.join(app.config["DRIVE_LOCATION"], "media", "media"),
+            output=os.path.join(app.config["DRIVE_LOCATION"], "media", "similar.json"),
+            state_file=os.path.join(
+                app.config["DRIVE_LOCATION"], "media", "similar_state.json"
+            ),
+            index=ann_index,
+            # Items imported again (embedding_store reembed) are regrouped
+            changed=[name[:32] for name in job_queue.committed_names(job_id)],
+        )
     processing.info("Similar photos and videos process completed.")
-    processing_similar_bool = False
-    pending = 1
-    total = 1
-
-    # Create copy of 'media' folder stored elsewhere
-    shutil.make_archive(
-        os.path.join("/mirage/backup", "Mirage-Backup"),
-        "zip",
-        os.path.join(app.config["DRIVE_LOCATION"], "media"),
-    )
-    processing.info("Created backup archive of the media folder.")
     processing.info("FINISHED PROCESSING MEDIA")
+    return True
+
+
+# Import the queued files of a job that are due. Returns when the next failed
+# file is due for a retry, None once every file is committed or out of
+# attempts.
+def ingest(job_id: int):
+    uploads_folder = os.path.join(app.config["DRIVE_LOCATION"], "uploads")
+    media_folder = os.path.join(app.config["DRIVE_LOCATION"], "media", "media")
+
+    # Commit a batch of finished files: move them to the media folder, then
+    # save the metadata of those that moved. Returns the files that did not.
+    def commit_files(records):
+        moved, failed = [], []
+        for record in records:
+            destination = os.path.join(media_folder, record["name"])
+            try:
+                if record["file"] != destination:
+                    shutil.move(record["file"], destination)
+                moved.append(record)
+            except OSError as e:
+                record["error"] = f"commit: {e}"
+                failed.append(record)
+        with catalog.batch():
+            for record in moved:
+                catalog.set_metadata(record["name"], record["metadata"])
+            job_queue.set_state(
+                job_id, [record["name"] for record in moved], "committed"
+            )
+        for record in moved:
+            media_index.add(
+                record["name"],
+                record["metadata"]["MIMEType"],
+                catalog.original_name(record["name"]),
+            )
+            processing.info(
+                f"File {record['name']} processed and moved to media folder.",
+                extra={"job": job_id, "file": record["name"], **record["timings"]},
+            )
+        return failed
+
+    # A file whose commit was interrupted after its move, or an item queued
+    # to be imported again (embedding_store reembed), is read from the media
+    # folder
+    def source(name):
+        path = os.path.join(uploads_folder, name)
+        moved = os.path.join(media_folder, name)
+        if not os.path.exists(path) and os.path.exists(moved):
+            return moved
+        return path
+
+    # Failed files stay in uploads and are retried after a backoff
+    def fail_file(record):
+        retry = job_queue.fail(job_id, record["name"], record["error"])
+        processing.error(
+            f"File {record['name']} failed: {record['error']}"
+            + (" Retrying later." if retry else " Giving up.")
+        )
+
+    dates = DateInferenceEngine(
+        os.path.join(app.config["DRIVE_LOCATION"], "media", "date_cache.json")
+    )
+    while True:
+        names, retry_at = job_queue.due_files(job_id)
+        if not names:
+            break
+        IngestPipeline(
+            store=embedding_store,
+            original_name=lambda f: catalog.original_name(os.path.basename(f)),
+            on_commit=commit_files,
+            on_failure=fail_file,
+            on_progress=lambda record, stage: job_queue.set_state(
+                job_id, [record["name"]], stage
+            ),
+            dates=dates,
+            renditions=renditions,
+            exiftool_workers=exiftool_workers,
+        ).run([source(name) for name in names])
+        dates.save()
+    dates.log_stats()
+    return retry_at
+
+
+# Take an incremental backup snapshot in a child process, so the copy
+# neither blocks nor shares the GIL with the server. Returns the process.
+def start_backup():
+    backup = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "tools.backup",
+            app.config["DRIVE_LOCATION"],
+            "snapshot",
+        ],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+    )
+    processing.info(f"Started backup process {backup.pid}.")
+    started = time.perf_counter()
+
+    def wait():
+        output = backup.communicate()[0].strip()
+        metrics.observe_stage("backup", time.perf_counter() - started)
+        if backup.returncode == 0:
+            processing.info(f"Backup finished: {output}")
+        else:
+            processing.error(f"Backup exited with {backup.returncode}: {output}")
+
+    threading.Thread(target=wait, name="backup-wait", daemon=True).start()
+    return backup
 
 
 # Route to start importing, tagging, and categorizing files
@@ -304,70 +685,100 @@ def start_process():
     pull_uploads = request.args.get("pull_uploads", "false").lower() == "true"
     processing.info(f"Received request to start process. pull_uploads={pull_uploads}")
 
-    thread = threading.Thread(target=process_media, args=(pull_uploads,))
-    thread.start()
-    processing.info("Background processing thread started.")
+    job_id = job_queue.create(pull_uploads)
+    job_wakeup.set()
+    processing.info(f"Job {job_id} queued.")
 
     return {
-        "status": url_for("process_status", _external=True),
+        "status": url_for("process_status", job=job_id, _external=True),
+        "job": job_id,
     }, 202
 
 
-# Route to get the status of the processing
+# Route to get the status of the processing: the latest job, or ?job=<id>
 @app.route("/status", methods=["GET"])
 @auth.login_required
 def process_status():
-    global pending, total
-    progress = (pending / total) if total != 0 else 1
-    hosting.info(f"Status requested. Progress: {progress}%")
+    status = job_queue.status(request.args.get("job", type=int))
+    if status is None:
+        return jsonify({"progress": 1, "processing_similar": False, "job": None}), 200
+    active = status["status"] in ACTIVE_STATUSES
+    progress = status["progress"]
+    if status["status"] == "similar":
+        progress = 0.99
+    elif active:
+        progress = min(progress, 0.98)
+    hosting.debug(f"Status requested. Progress: {progress}%")
 
     return jsonify(
         {
             "progress": progress,
-            "processing_similar": processing_similar_bool,
+            "processing_similar": status["status"] == "similar",
+            "job": status,
         }
-    ), (425 if progress < 1 else 200)
+    ), (425 if active else 200)
 
 
-# Generate a thumbnail for an image file
-def generate_image_thumbnail(image_bytes, image_name="NULL") -> bytes:
+# Serve a thumbnail of an image or video from the rendition cache
+def send_thumbnail(unique_id, file_path, content_type, original_filename):
+    if not content_type.startswith(("image/", "video/")):
+        hosting.warning(f"Unsupported content type for thumbnail: {content_type}")
+        return abort(415)
+    size = request.args.get("size", THUMBNAIL_SIZE, type=int)
     try:
-        with Image.open(io.BytesIO(image_bytes)) as img:
-            img.thumbnail((640, 640))
-            rgb_v = img.convert("RGB")
-            img_io = io.BytesIO()
-            rgb_v.save(img_io, format="JPEG")
-            img_io.seek(0)
-        hosting.info("Generated image thumbnail.")
-        return img_io.getvalue()
+        rendition = renditions.get(
+            unique_id, renditions.size_for(size), file_path, content_type
+        )
+    except ffmpeg.Error as e:
+        hosting.error(f"Error generating video thumbnail: {file_path}: {e.stderr}")
+        return abort(500)
     except Exception as e:
-        hosting.error(f"Unexpected error generating image thumbnail: {image_name}: {e}")
+        hosting.error(f"Unexpected error generating thumbnail: {file_path}: {e}")
         return abort(500)
 
+    hosting.debug(f"Thumbnail of {original_filename} served from rendition cache.")
+    return send_file(
+        rendition,
+        mimetype=renditions.mimetype,
+        as_attachment=True,
+        download_name=os.path.basename(original_filename),
+    )
 
-# Extract a thumbnail from a video file and return it as bytes
-def generate_video_thumbnail(video_path: str) -> bytes:
-    try:
-        out, _ = (
-            ffmpeg.input(video_path, ss=0.1)
-            .output("pipe:", vframes=1, format="image2", vcodec="png")
-            .run(capture_stdout=True, capture_stderr=True)
+
+# Serve an image sized to ?width=/?height= (full resolution without either),
+# in the best format the client accepts, through the display cache
+def send_display_image(unique_id, file_path, content_type, original_filename):
+    size = display_cache.size_for(
+        max(
+            request.args.get("width", 0, type=int),
+            request.args.get("height", 0, type=int),
         )
-        hosting.info("Generated video thumbnail.")
-        return generate_image_thumbnail(out)
-    except ffmpeg.Error as e:
-        hosting.error(f"Error generating video thumbnail: {video_path}: {e.stderr}")
-        return abort(500)
+    )
+    format = negotiate_format(list(request.accept_mimetypes.values()))
+    try:
+        data = display_cache.get(unique_id, size, format, file_path, content_type)
     except Exception as e:
-        hosting.error(f"Unexpected error generating video thumbnail: {video_path}: {e}")
+        hosting.error(f"Error rendering display image: {file_path}: {e}")
         return abort(500)
 
+    hosting.debug(
+        f"Serving {format} display image of {original_filename} at {size or 'full'}."
+    )
+    response = send_file(
+        io.BytesIO(data),
+        mimetype=MIMETYPES[format],
+        as_attachment=True,
+        download_name=os.path.basename(original_filename),
+    )
+    response.vary.add("Accept")
+    return response
+
 
 # Route to download or get thumbnail of image or video
 @app.route("/download/<unique_id>", methods=["GET"])
 # TODO: @auth.login_required
 def download_file(unique_id):
-    hosting.info(f"Download request for file with unique_id: {unique_id}")
+    hosting.debug(f"Download request for file with unique_id: {unique_id}")
 
     if len(unique_id) != 32:
         hosting.warning("Invalid media ID received.")
@@ -376,105 +787,136 @@ def download_file(unique_id):
     thumbnail = request.args.get("thumbnail", "false").lower() == "true"
     downloadable = request.args.get("downloadable", "false").lower() == "true"
 
-    for file_path in os.listdir(
-        os.path.join(app.config["DRIVE_LOCATION"], "media", "media")
-    ):
-        if file_path.startswith(unique_id):
-            if os.path.exists(
-                os.path.join(app.config["DRIVE_LOCATION"], "media", "media", file_path)
-            ):
-                original_filename = filename_mapping.get(file_path)
-                if not original_filename:
-                    hosting.error(f"Original filename not found for file: {file_path}")
-                    return abort(404)
-
-                file_path = os.path.join(
-                    app.config["DRIVE_LOCATION"], "media", "media", file_path
-                )
-                content_type = metadata[os.path.basename(file_path)]["MIMEType"]
-
-                with open(file_path, "rb") as f:
-                    file_data = f.read()
-
-                    if thumbnail:
-                        if content_type.startswith("image/"):
-                            hosting.info("Generating thumbnail for image file.")
-                            file_data = generate_image_thumbnail(
-                                file_data, os.path.basename(file_path)
-                            )
-                            content_type = "image/jpeg"
-                        elif content_type.startswith("video/"):
-                            hosting.info("Generating thumbnail for video file.")
-                            file_data = generate_video_thumbnail(file_path)
-                            content_type = "image/jpeg"
-                        else:
-                            hosting.warning(
-                                f"Unsupported content type for thumbnail: {content_type}"
-                            )
-                            return abort(415)
-                    elif not downloadable:
-                        hosting.info("Serving JPEG version of full res file")
-                        if content_type.startswith("image/"):
-                            with Image.open(io.BytesIO(file_data)) as img:
-                                rgb_v = img.convert("RGB")
-                                img_io = io.BytesIO()
-                                rgb_v.save(img_io, format="JPEG")
-                                img_io.seek(0)
-                            file_data = img_io.getvalue()
-                            content_type = "image/jpeg"
-                        elif content_type.startswith("video/"):
-                            pass
-                        else:
-                            hosting.warning(f"Unsupported content type: {content_type}")
-                            return abort(415)
-
-                hosting.info(f"File {original_filename} served for download.")
-                return (
-                    file_data,
-                    200,
-                    {
-                        "Content-Type": content_type,
-                        "Content-Disposition": f"attachment; filename={os.path.basename(original_filename)}",
-                    },
-                )
-            else:
-                hosting.error(f"File not found: {file_path}")
-                return abort(404)
-
-    hosting.warning(f"File ID not found: {unique_id}")
-    return abort(404)
+    entry = media_index.get(unique_id)
+    if entry is None:
+        hosting.warning(f"File ID not found: {unique_id}")
+        return abort(404)
+
+    file_path = media_index.path(entry)
+    original_filename = entry.original_name
+    content_type = entry.mimetype
+
+    if thumbnail:
+        return send_thumbnail(unique_id, file_path, content_type, original_filename)
+
+    if not os.path.isfile(file_path):
+        hosting.error(f"File not found: {file_path}")
+        media_index.discard(unique_id)
+        return abort(404)
+
+    if not downloadable and content_type.startswith("image/"):
+        return send_display_image(unique_id, file_path, content_type, original_filename)
+    elif not downloadable and not content_type.startswith("video/"):
+        hosting.warning(f"Unsupported content type: {content_type}")
+        return abort(415)
+
+    # Originals and videos are streamed from disk in chunks (or handed to the
+    # server's sendfile), with Range/If-Range support so players can seek
+    hosting.debug(f"File {original_filename} served for download.")
+    return send_file(
+        file_path,
+        mimetype=content_type,
+        as_attachment=True,
+        download_name=os.path.basename(original_filename),
+        conditional=True,
+    )
 
 
-# Route to list files and folders with metadata
+# Route to list files and folders with metadata.
+# Without parameters every item is returned in upload order. With any of
+# limit, cursor, type, from, to or order, items are returned a page at a time
+# sorted by CreateDate; with since=<token>, only items added or changed since
+# the token of an earlier response.
 @app.route("/list", methods=["GET"])
 @auth.login_required
 def list_files():
-    hosting.info("List request received.")
-    hosting.info(f"{len(filename_mapping) - len(trash)} items listed.")
-    return (
-        jsonify(
-            [
+    hosting.debug("List request received.")
+    paged = ("limit", "cursor", "type", "from", "to", "order", "since")
+    if not any(arg in request.args for arg in paged):
+        items = [item for item in catalog.items() if item["name"][:32] in media_index]
+        hosting.debug(f"{len(items)} items listed.")
+        return jsonify([list_entry(item) for item in items]), 200
+
+    with_metadata = request.args.get("metadata", "true").lower() == "true"
+    limit = max(1, min(request.args.get("limit", LIST_PAGE_SIZE, type=int), 1000))
+    if "since" in request.args:
+        since = request.args.get("since", type=int)
+        if since is None:
+            return {"status": "Invalid since token"}, 400
+        items, token = catalog.changes(since, limit)
+        hosting.debug(f"{len(items)} changed items listed since {since}.")
+        return (
+            jsonify(
                 {
-                    "id": item[:32],
-                    "name": filename_mapping.get(item),
-                    "url": url_for(
-                        "download_file", unique_id=item[:32], _external=True
-                    ),
-                    "width": metadata.get(item)["Width"],
-                    "height": metadata.get(item)["Height"],
-                    "metadata": metadata.get(item),
+                    "items": [
+                        {
+                            **list_entry(item, with_metadata),
+                            "trashed": item["trash_expiry"] is not None,
+                            "expiry": item["trash_expiry"],
+                        }
+                        for item in items
+                    ],
+                    "token": token,
+                    "more": len(items) == limit,
                 }
-                for item in filename_mapping
-                if os.path.exists(
-                    os.path.join(app.config["DRIVE_LOCATION"], "media", "media", item)
-                )
-                and item not in trash
-            ]
+            ),
+            200,
+        )
+
+    try:
+        cursor = request.args.get("cursor")
+        cursor = decode_cursor(cursor) if cursor else None
+        date_from, date_to = (
+            (
+                datetime.strptime(request.args[arg], "%Y-%m-%d").strftime(fmt)
+                if request.args.get(arg)
+                else None
+            )
+            for arg, fmt in (("from", "%Y:%m:%d 00:00:00"), ("to", "%Y:%m:%d 23:59:59"))
+        )
+    except ValueError as e:
+        return {"status": f"Invalid parameter: {e}"}, 400
+    # Read the token first so no change made while listing is missed
+    token = catalog.latest_seq()
+    items, next_cursor = catalog.page(
+        limit,
+        cursor=cursor,
+        mimetype=request.args.get("type"),
+        date_from=date_from,
+        date_to=date_to,
+        descending=request.args.get("order", "desc").lower() != "asc",
+    )
+    hosting.debug(f"{len(items)} items listed.")
+    return (
+        jsonify(
+            {
+                "items": [
+                    list_entry(item, with_metadata)
+                    for item in items
+                    if item["name"][:32] in media_index
+                ],
+                "cursor": encode_cursor(next_cursor) if next_cursor else None,
+                "token": token,
+            }
         ),
         200,
     )
 
 
+# JSON of one item in /list responses
+def list_entry(item, with_metadata=True):
+    entry = {
+        "id": item["name"][:32],
+        "name": item["original_name"],
+        "url": url_for("download_file", unique_id=item["name"][:32], _external=True),
+        "width": item["metadata"]["Width"],
+        "height": item["metadata"]["Height"],
+    }
+    if with_metadata:
+        entry["metadata"] = item["metadata"]
+    return entry
+
+
 # Route get similar.json file
 @app.route("/similar", methods=["GET"])
 @auth.login_required
@@ -483,7 +925,7 @@ def get_similar_json():
         with open(
             os.path.join(app.config["DRIVE_LOCATION"], "media", "similar.json")
         ) as f:
-            hosting.info("Returning similar.json file.")
+            hosting.debug("Returning similar.json file.")
             return jsonify(json.load(f)), 200
     except FileNotFoundError:
         hosting.warning("similar.json file not found.")
@@ -497,24 +939,15 @@ def get_similar_json():
 @app.route("/trash", methods=["GET"])
 @auth.login_required
 def get_trash():
-    hosting.info("Trash request received.")
-    hosting.info(f"Return {len(trash)} items.")
+    hosting.debug("Trash request received.")
+    items = catalog.items(trashed=True)
+    hosting.debug(f"Return {len(items)} items.")
     return (
         jsonify(
             [
-                {
-                    "id": id[:32],
-                    "name": filename_mapping.get(id),
-                    "url": url_for("download_file", unique_id=id[:32], _external=True),
-                    "width": metadata.get(id)["Width"],
-                    "height": metadata.get(id)["Height"],
-                    "metadata": metadata.get(id),
-                    "expiry": expiry,
-                }
-                for id, expiry in trash.items()
-                if os.path.exists(
-                    os.path.join(app.config["DRIVE_LOCATION"], "media", "media", id)
-                )
+                {**list_entry(item), "expiry": item["trash_expiry"]}
+                for item in items
+                if item["name"][:32] in media_index
             ]
         ),
         200,
@@ -531,24 +964,44 @@ def trash_file(unique_id):
         hosting.warning("Invalid media ID received.")
         return {"status": "Invalid media ID"}, 400
 
-    for file_path in os.listdir(
-        os.path.join(app.config["DRIVE_LOCATION"], "media", "media")
-    ):
-        if file_path.startswith(unique_id):
-            if file_path in trash:
-                hosting.info("Removing file from trash")
-                trash.pop(file_path)
-            else:
-                hosting.info("Adding file to trash")
-                trash[file_path] = (
-                    datetime.now().replace(hour=23, minute=59) + timedelta(days=30)
-                ).strftime("%Y-%m-%d %H:%M:00")
-            save_dictionary(TRASH_FILE, trash)
+    entry = media_index.get(unique_id)
+    if entry is None:
+        hosting.info("Resource not found. No action taken.")
+        return {"status": "Resource not found. No action taken."}, 204
+
+    if entry.trashed:
+        hosting.info("Removing file from trash")
+        catalog.set_trash(entry.name, None)
+    else:
+        hosting.info("Adding file to trash")
+        catalog.set_trash(
+            entry.name,
+            (datetime.now().replace(hour=23, minute=59) + timedelta(days=30)).strftime(
+                "%Y-%m-%d %H:%M:00"
+            ),
+        )
+    media_index.set_trashed(unique_id, not entry.trashed)
+
+    return {"status": "Complete"}, 200
+
+
+# Route to export metrics in the Prometheus text format
+@app.route("/metrics", methods=["GET"])
+@auth.login_required
+def export_metrics():
+    for depth_name, depth in job_queue.depths().items():
+        metrics.QUEUE_DEPTH.set(depth, queue=depth_name)
+    return Response(
+        metrics.render(METRICS_FOLDER),
+        mimetype="text/plain; version=0.0.4; charset=utf-8",
+    )
 
-            return {"status": "Complete"}, 200
 
-    hosting.info("Resource not found. No action taken.")
-    return {"status": "Resource not found. No action taken."}, 204
+# Route to get display cache statistics
+@app.route("/cache", methods=["GET"])
+@auth.login_required
+def cache_stats():
+    return jsonify({"display": display_cache.stats()}), 200
 
 
 @app.route("/usage", methods=["GET"])
@@ -569,3 +1022,27 @@ def storage_usage():
         )
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+
+
+# Queue an automatic import for a micro-batch of new uploads. The queue
+# holds at most one waiting job, which absorbs batches while a job runs.
+def queue_uploads(names):
+    failed = job_queue.failed_names()
+    names = [name for name in names if name not in failed]
+    if not names:
+        return
+    job_id = job_queue.create(pull_uploads=True, automatic=True)
+    job_wakeup.set()
+    processing.info(f"{len(names)} new uploads queued in job {job_id}.")
+
+
+# Start running jobs, including any interrupted by a restart. The dedicated
+# processor runs them in its main thread instead (processor.py).
+if MIRAGE_ROLE == "all":
+    threading.Thread(target=run_jobs, name="job-runner", daemon=True).start()
+
+# Import new uploads without waiting for /start
+if PROCESSES and os.getenv("WATCH_UPLOADS", "true").lower() == "true":
+    UploadWatcher(
+        os.path.join(app.config["DRIVE_LOCATION"], "uploads"), on_batch=queue_uploads
+    ).start()
@@ -1,3 +1,6 @@
+import base64
+import hashlib
+import time
 import requests
 from requests.auth import HTTPBasicAuth
 from requests_toolbelt.multipart.encoder import (
@@ -75,6 +78,88 @@ def create_multipart_with_progress(file_path, progress_bar):
 HOSTNAME = os.getenv("HOSTNAME")
 PORT = os.getenv("PORT")
 
+# Files larger than this are sent in resumable chunks
+RESUMABLE_THRESHOLD = 64 * 1024 * 1024
+CHUNK_SIZE = 8 * 1024 * 1024
+MAX_RETRIES = 5
+
+
+def already_uploaded(file_path):
+    """
+    Ask the server whether it already has the content of a file.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    response = requests.head(
+        f"http://{HOSTNAME}:{PORT}/hash/{digest.hexdigest()}",
+        auth=HTTPBasicAuth(os.getenv("USERNAME"), os.getenv("PASSWORD")),
+    )
+    return response.status_code == 200
+
+
+def upload_file_resumable(file_path, file_size, progress_bar):
+    """
+    Upload a large file in chunks, resuming from the server's offset after
+    a failed chunk.
+    """
+    auth = HTTPBasicAuth(os.getenv("USERNAME"), os.getenv("PASSWORD"))
+    name = base64.b64encode(os.path.basename(file_path).encode()).decode()
+    response = requests.post(
+        f"http://{HOSTNAME}:{PORT}/uploads",
+        headers={
+            "Upload-Length": str(file_size),
+            "Upload-Metadata": f"filename {name}",
+            "Tus-Resumable": "1.0.0",
+        },
+        auth=auth,
+    )
+    if response.status_code != 201:
+        return response
+    session_url = response.headers["Location"]
+
+    offset = 0
+    retries = 0
+    with open(file_path, "rb") as f:
+        while True:
+            f.seek(offset)
+            chunk = f.read(CHUNK_SIZE)
+            try:
+                response = requests.patch(
+                    session_url,
+                    data=chunk,
+                    headers={
+                        "Content-Type": "application/offset+octet-stream",
+                        "Upload-Offset": str(offset),
+                        "Tus-Resumable": "1.0.0",
+                    },
+                    auth=auth,
+                )
+                if response.status_code == 409 and "url" not in response.json():
+                    # Out of sync with the server: continue from its offset
+                    offset = int(
+                        requests.head(session_url, auth=auth).headers["Upload-Offset"]
+                    )
+                    continue
+                if response.status_code not in (200, 201, 204, 409):
+                    return response
+                if response.status_code != 204:
+                    progress_bar.update(file_size - progress_bar.n)
+                    return response
+                offset = int(response.headers["Upload-Offset"])
+                retries = 0
+            except requests.exceptions.ConnectionError:
+                retries += 1
+                if retries > MAX_RETRIES:
+                    raise
+                time.sleep(2**retries)
+                # Continue from whatever the server kept
+                offset = int(
+                    requests.head(session_url, auth=auth).headers["Upload-Offset"]
+                )
+            progress_bar.update(offset - progress_bar.n)
+
 
 def upload_file(file_path):
     """
@@ -83,6 +168,21 @@ def upload_file(file_path):
     # Get the file size for progress tracking
     file_size = os.path.getsize(file_path)
 
+    if file_size > RESUMABLE_THRESHOLD:
+        with tqdm(
+            total=file_size,
+            unit="B",
+            unit_scale=True,
+            desc=os.path.basename(file_path),
+            leave=False,
+        ) as progress_bar:
+            response = upload_file_resumable(file_path, file_size, progress_bar)
+        if response.status_code not in (200, 201, 409):
+            print(
+                f"Failed to upload: {file_path} (Status code: {response.status_code})"
+            )
+        return
+
     with tqdm(
         total=file_size,
         unit="B",
@@ -101,22 +201,28 @@ def upload_file(file_path):
             auth=HTTPBasicAuth(os.getenv("USERNAME"), os.getenv("PASSWORD")),
         )
 
-    # Check if the upload was successful
-    if response.status_code != 201:
+    # Check if the upload was successful (200/409: the server already had it)
+    if response.status_code not in (200, 201, 409):
         print(f"Failed to upload: {file_path} (Status code: {response.status_code})")
 
 
+skipped = 0
 for file in tqdm(list_of_files, desc="Uploading", unit="files"):
     try:
+        if already_uploaded(file):
+            skipped += 1
+            continue
         upload_file(file)
     except Exception as e:
         print(f"Error uploading {file}: {e}")
         continue
 
+if skipped:
+    print(f"Skipped {skipped} files already on the server.")
 
 response = requests.request(
     "POST",
-    f"http://{HOSTNAME}:{PORT}/start?pulluploads=true",
+    f"http://{HOSTNAME}:{PORT}/start?pull_uploads=true",
     auth=HTTPBasicAuth(os.getenv("USERNAME"), os.getenv("PASSWORD")),
 )
 